@@ -0,0 +1,223 @@
+import asyncio
+import logging
+import math
+import time
+from typing import Tuple
+
+from fastapi.responses import JSONResponse
+from starlette.routing import Match
+
+from . import database
+from .keys import rate_limit_key
+from .metrics import SHED_REQUESTS
+from .utils import settings
+
+logger = logging.getLogger(__name__)
+
+# Refills a client's bucket for the time elapsed since its last request and
+# takes one token if available. Returns {allowed, seconds until next token};
+# the wait is a string because Redis truncates Lua numbers to integers.
+_TOKEN_BUCKET_SCRIPT = """
+local rate = tonumber(ARGV[1])
+local burst = tonumber(ARGV[2])
+local time = redis.call("TIME")
+local now = tonumber(time[1]) + tonumber(time[2]) / 1000000
+local state = redis.call("HMGET", KEYS[1], "tokens", "ts")
+local tokens = tonumber(state[1]) or burst
+local ts = tonumber(state[2]) or now
+tokens = math.min(burst, tokens + math.max(0, now - ts) * rate)
+local allowed = 0
+local wait = 0
+if tokens >= 1 then
+    tokens = tokens - 1
+    allowed = 1
+else
+    wait = (1 - tokens) / rate
+end
+redis.call("HSET", KEYS[1], "tokens", tokens, "ts", now)
+redis.call("PEXPIRE", KEYS[1], math.ceil(burst / rate * 1000) + 1000)
+return {allowed, tostring(wait)}
+"""
+
+
+class RedisTokenBuckets:
+    """
+    Per-client token buckets in Redis, shared by every worker.
+    """
+
+    async def take(self, client_id: str) -> Tuple[bool, float]:
+        allowed, wait = await database.redis.eval(
+            _TOKEN_BUCKET_SCRIPT,
+            1,
+            rate_limit_key(client_id),
+            settings.RATE_LIMIT_PER_SECOND,
+            settings.RATE_LIMIT_BURST,
+        )
+        return bool(allowed), float(wait)
+
+
+class LocalTokenBuckets:
+    """
+    Per-client token buckets in process memory, for the in-memory storage backend.
+    """
+
+    def __init__(self):
+        self._buckets = {}  # client ID -> (tokens, monotonic time of last update)
+
+    async def take(self, client_id: str) -> Tuple[bool, float]:
+        rate, burst = settings.RATE_LIMIT_PER_SECOND, settings.RATE_LIMIT_BURST
+        now = time.monotonic()
+        tokens, updated = self._buckets.get(client_id, (burst, now))
+        tokens = min(burst, tokens + (now - updated) * rate)
+        if tokens >= 1:
+            self._buckets[client_id] = (tokens - 1, now)
+            return True, 0.0
+        self._buckets[client_id] = (tokens, now)
+        return False, (1 - tokens) / rate
+
+
+token_buckets = (
+    LocalTokenBuckets() if settings.STORAGE_BACKEND == "memory" else RedisTokenBuckets()
+)
+
+
+class AdmissionMiddleware:
+    """
+    ASGI middleware shedding excess write requests before they reach the routes.
+
+    Requests using one of ADMISSION_METHODS, except those to the read-only
+    ADMISSION_EXEMPT_ROUTES, pass, in order:
+    - a token bucket per client (RATE_LIMIT_PER_SECOND, RATE_LIMIT_BURST),
+      answered with 429 when empty;
+    - a cap on this worker's in-flight requests (ADMISSION_MAX_IN_FLIGHT) and
+      per-route caps (ADMISSION_ROUTE_LIMITS), answered with 503 when no slot
+      frees up within ADMISSION_MAX_QUEUE_DELAY seconds.
+
+    Both responses carry Retry-After, and every shed request is counted in
+    shed_requests_total. Limits set to 0 are disabled; if Redis is unreachable
+    the token bucket lets requests through.
+    """
+
+    def __init__(self, app, router):
+        self.app = app
+        self.router = router
+        self.worker_slots = (
+            asyncio.Semaphore(settings.ADMISSION_MAX_IN_FLIGHT)
+            if settings.ADMISSION_MAX_IN_FLIGHT
+            else None
+        )
+        self.route_slots = {
+            route: asyncio.Semaphore(limit)
+            for route, limit in settings.ADMISSION_ROUTE_LIMITS.items()
+            if limit
+        }
+
+    def route_name(self, scope) -> str:
+        """
+        Return "<METHOD> <route template>", e.g. "PATCH /allocation/{allocation_id}/".
+        """
+        for route in self.router.routes:
+            match, _ = route.matches(scope)
+            if match == Match.FULL:
+                return f"{scope['method']} {route.path}"
+        return f"{scope['method']} unmatched"
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["method"] not in settings.ADMISSION_METHODS:
+            await self.app(scope, receive, send)
+            return
+
+        route = (
+            self.route_name(scope)
+            if self.route_slots or settings.ADMISSION_EXEMPT_ROUTES
+            else None
+        )
+        if route in settings.ADMISSION_EXEMPT_ROUTES:
+            await self.app(scope, receive, send)
+            return
+        if settings.RATE_LIMIT_PER_SECOND:
+            allowed, wait = await self.take_token(scope)
+            if not allowed:
+                await self.shed(scope, receive, send, route, "rate_limited", wait)
+                return
+
+        acquired = []
+        deadline = time.monotonic() + settings.ADMISSION_MAX_QUEUE_DELAY
+        try:
+            for slots, reason in (
+                (self.worker_slots, "worker_overloaded"),
+                (self.route_slots.get(route), "route_overloaded"),
+            ):
+                if slots is None:
+                    continue
+                if not await acquire_before(slots, deadline):
+                    await self.shed(
+                        scope,
+                        receive,
+                        send,
+                        route,
+                        reason,
+                        settings.ADMISSION_RETRY_AFTER,
+                    )
+                    return
+                acquired.append(slots)
+            await self.app(scope, receive, send)
+        finally:
+            for slots in acquired:
+                slots.release()
+
+    async def take_token(self, scope) -> Tuple[bool, float]:
+        """
+        Take a token from the bucket of the client sending the request.
+        """
+        client_id = client_identity(scope)
+        try:
+            return await token_buckets.take(client_id)
+        except Exception:
+            logger.warning("Rate limiter unavailable, admitting request", exc_info=True)
+            return True, 0.0
+
+    async def shed(self, scope, receive, send, route, reason, retry_after):
+        """
+        Reject a request with 429 (rate limited) or 503 (overloaded).
+        """
+        SHED_REQUESTS.labels(route or self.route_name(scope), reason).inc()
+        status_code = 429 if reason == "rate_limited" else 503
+        detail = "Too many requests" if status_code == 429 else "Server is overloaded"
+        response = JSONResponse(
+            {"detail": detail},
+            status_code=status_code,
+            headers={"Retry-After": str(max(1, math.ceil(retry_after)))},
+        )
+        await response(scope, receive, send)
+
+
+async def acquire_before(slots: asyncio.Semaphore, deadline: float) -> bool:
+    """
+    Acquire a slot, waiting in line until the monotonic deadline at most.
+
+    Returns:
+    - bool: True if the slot was acquired.
+    """
+    if not slots.locked():
+        await slots.acquire()
+        return True
+    try:
+        await asyncio.wait_for(slots.acquire(), deadline - time.monotonic())
+    except asyncio.TimeoutError:
+        return False
+    return True
+
+
+def client_identity(scope) -> str:
+    """
+    Identify the client of a request for rate limiting.
+
+    Uses the RATE_LIMIT_CLIENT_HEADER header when present, else the client address.
+    """
+    header = settings.RATE_LIMIT_CLIENT_HEADER.lower().encode("latin-1")
+    for name, value in scope["headers"]:
+        if name == header:
+            return value.decode("latin-1")
+    client = scope.get("client")
+    return client[0] if client else "unknown"
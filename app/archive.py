@@ -0,0 +1,345 @@
+import asyncio
+import heapq
+import logging
+import re
+from collections import defaultdict
+from datetime import date, datetime, timedelta, timezone
+from typing import AsyncIterator, Callable, Iterable, List, Set, Tuple
+
+from bson import ObjectId
+from pymongo import ReplaceOne
+from pymongo.errors import BulkWriteError
+
+from . import database
+from .keys import ARCHIVE_LOCK_KEY, ARCHIVE_MONTHS_KEY, as_date
+from .metrics import ARCHIVED_ALLOCATIONS
+from .models import allocation_schema, midnight
+from .utils import settings
+
+logger = logging.getLogger(__name__)
+
+# Allocations can no longer be changed once their date has come, so past ones
+# are moved out of the live ("hot") collection into one archive collection per
+# month. Writes only ever target the hot collection, which keeps archived
+# allocations immutable; lookups, conflict checks and history queries read an
+# archive only when the dates involved are in the past.
+
+
+# Member of the cached month set telling it was loaded from MongoDB
+COMPLETE_MONTHS = "complete"
+MONTH_PATTERN = re.compile(r"^\d{4}_\d{2}$")
+
+
+def month_of(day) -> str:
+    """
+    Return the archive month ("YYYY_MM") of a date or datetime.
+    """
+    return as_date(day).strftime("%Y_%m")
+
+
+def archive_collection(month: str):
+    """
+    Return the archive collection of a month, e.g. allocations_archive_2024_10.
+    """
+    name = f"{database.allocations_collection.name}_archive_{month}"
+    return database.database.get_collection(name)
+
+
+def today() -> date:
+    return datetime.now(timezone.utc).date()
+
+
+def archive_cutoff() -> date:
+    """
+    Return the first date kept in the hot collection by the archiver.
+    """
+    return today() - timedelta(days=settings.ARCHIVE_KEEP_DAYS)
+
+
+async def archived_months() -> List[str]:
+    """
+    Return the months that have an archive collection, oldest first.
+
+    The collections in MongoDB are the source of truth. Their months are
+    cached in a Redis set, along with a COMPLETE_MONTHS marker, so that a set
+    emptied by a flush or eviction, or rebuilt by the archiver alone, is
+    reloaded from MongoDB instead of hiding archived months.
+    """
+    months = await database.redis.smembers(ARCHIVE_MONTHS_KEY)
+    if COMPLETE_MONTHS in months:
+        return sorted(months - {COMPLETE_MONTHS})
+    prefix = f"{database.allocations_collection.name}_archive_"
+    months = {
+        name[len(prefix) :]
+        for name in await database.database.list_collection_names()
+        if name.startswith(prefix) and MONTH_PATTERN.match(name[len(prefix) :])
+    }
+    await database.redis.sadd(ARCHIVE_MONTHS_KEY, COMPLETE_MONTHS, *months)
+    return sorted(months)
+
+
+async def history_partitions(start_date: date = None, end_date: date = None) -> list:
+    """
+    Return the collections that may hold allocations dated within a history filter.
+
+    Parameters:
+    - start_date (date, optional): First day of the filter.
+    - end_date (date, optional): Last day of the filter.
+
+    Returns:
+    - list: The archive collections of the filtered months, oldest first,
+      followed by the hot collection; only the latter for filters on or after today.
+    """
+    if start_date and start_date >= today():
+        return [database.allocations_collection]
+    months = await archived_months()
+    if start_date:
+        months = [month for month in months if month >= month_of(start_date)]
+    if end_date:
+        months = [month for month in months if month <= month_of(end_date)]
+    return [archive_collection(month) for month in months] + [
+        database.allocations_collection
+    ]
+
+
+async def find_archived_allocation(vehicle_id: str, allocation_date: date):
+    """
+    Read a past allocation from the archive of its month.
+
+    Returns:
+    - dict: The allocation in the API shape, or None if not archived.
+    """
+    return allocation_schema.from_document(
+        await archive_collection(month_of(allocation_date)).find_one(
+            allocation_schema.match(
+                vehicle_id=vehicle_id, allocation_date=allocation_date
+            ),
+            allocation_schema.projection(),
+        )
+    )
+
+
+async def find_archived_allocations(
+    pairs: Iterable[Tuple[str, date]], *fields: str
+) -> List[dict]:
+    """
+    Read the archived allocations of the given vehicle/date pairs.
+
+    Only past dates are looked up, with one query per month involved, so
+    upcoming dates cost nothing.
+
+    Parameters:
+    - pairs (Iterable[Tuple[str, date]]): Vehicle IDs and dates (or datetimes).
+    - fields (str): API fields to read; all of them by default.
+
+    Returns:
+    - List[dict]: The archived allocations, in the API shape.
+    """
+    by_month = defaultdict(set)
+    for vehicle_id, day in pairs:
+        if as_date(day) < today():
+            by_month[month_of(day)].add((vehicle_id, midnight(day)))
+    if not by_month:
+        return []
+    results = await asyncio.gather(
+        *(
+            archive_collection(month)
+            .find(
+                {
+                    "$or": [
+                        allocation_schema.match(
+                            vehicle_id=vehicle_id, allocation_date=day
+                        )
+                        for vehicle_id, day in month_pairs
+                    ]
+                },
+                allocation_schema.projection(*fields),
+            )
+            .to_list(length=None)
+            for month, month_pairs in by_month.items()
+        )
+    )
+    return [
+        allocation_schema.from_document(document)
+        for documents in results
+        for document in documents
+    ]
+
+
+async def find_archived(pairs: Iterable[Tuple[str, date]]) -> Set[Tuple[str, datetime]]:
+    """
+    Find which vehicle/date pairs are booked in the archive.
+
+    Parameters:
+    - pairs (Iterable[Tuple[str, date]]): Vehicle IDs and dates (or datetimes).
+
+    Returns:
+    - Set[Tuple[str, datetime]]: The archived pairs, with midnight datetimes.
+    """
+    allocations = await find_archived_allocations(
+        pairs, "vehicle_id", "allocation_date"
+    )
+    return {
+        (allocation["vehicle_id"], allocation["allocation_date"])
+        for allocation in allocations
+    }
+
+
+async def is_archived(allocation_id: str) -> bool:
+    """
+    Tell whether an allocation ID belongs to an archived allocation.
+
+    Checks every archive month, so use it on error paths only.
+    """
+    counts = await asyncio.gather(
+        *(
+            archive_collection(month).count_documents(
+                {"_id": ObjectId(allocation_id)}, limit=1
+            )
+            for month in await archived_months()
+        )
+    )
+    return any(counts)
+
+
+async def merge_sorted(
+    iterators: List[AsyncIterator[dict]], key: Callable[[dict], tuple]
+) -> AsyncIterator[dict]:
+    """
+    Merge async iterators that are each sorted by key into one sorted stream.
+
+    Documents present in several partitions, as between the two steps of a
+    move, are yielded once.
+    """
+    heap = []
+    for index, iterator in enumerate(iterators):
+        document = await anext(iterator, None)
+        if document is not None:
+            heap.append((key(document), index, document))
+    heapq.heapify(heap)
+    last_id = None
+    while heap:
+        _, index, document = heap[0]
+        if document["_id"] != last_id:
+            last_id = document["_id"]
+            yield document
+        following = await anext(iterators[index], None)
+        if following is None:
+            heapq.heappop(heap)
+        else:
+            heapq.heapreplace(heap, (key(following), index, following))
+
+
+async def archive_allocations(batch_size: int = None) -> int:
+    """
+    Move allocations dated before the archive cutoff into their monthly archives.
+
+    The cutoff is ARCHIVE_KEEP_DAYS days before today. Each batch is copied to
+    the archives with idempotent upserts before it is deleted from the hot
+    collection, so an interrupted run loses nothing and the next one finishes
+    the move. Cached lookups, availability bitmaps and rollups stay valid
+    because the allocations themselves do not change.
+
+    Parameters:
+    - batch_size (int, optional): Allocations moved per batch; defaults to ARCHIVE_BATCH_SIZE.
+
+    Returns:
+    - int: Number of allocations archived.
+    """
+    batch_size = batch_size or settings.ARCHIVE_BATCH_SIZE
+    cutoff = archive_cutoff()
+    date_field = allocation_schema.field("allocation_date")
+    query = {date_field: {"$lt": allocation_schema.value("allocation_date", cutoff)}}
+    prepared = set()  # months whose archive has its indexes
+    stuck = []  # allocations conflicting with an archived one; left in place
+    archived = 0
+    while True:
+        batch = (
+            await database.allocations_collection.find(
+                {**query, "_id": {"$nin": stuck}} if stuck else query
+            )
+            .sort([(date_field, 1), ("_id", 1)])
+            .limit(batch_size)
+            .to_list(length=batch_size)
+        )
+        if not batch:
+            return archived
+
+        by_month = defaultdict(list)
+        for document in batch:
+            allocation = allocation_schema.from_document(document)
+            by_month[month_of(allocation["allocation_date"])].append(document)
+        # Create the archives (with their indexes) and register their months
+        # first, so history queries read them from now on
+        for month in by_month:
+            if month not in prepared:
+                await database.ensure_allocation_indexes(archive_collection(month))
+                prepared.add(month)
+        await database.redis.sadd(ARCHIVE_MONTHS_KEY, *by_month)
+
+        moved = []
+        for month, documents in by_month.items():
+            archive = archive_collection(month)
+            failed = set()
+            try:
+                await archive.bulk_write(
+                    [
+                        ReplaceOne({"_id": document["_id"]}, document, upsert=True)
+                        for document in documents
+                    ],
+                    ordered=False,
+                )
+            except BulkWriteError as exc:
+                for error in exc.details["writeErrors"]:
+                    if error["code"] != 11000:
+                        raise
+                    failed.add(error["index"])
+            for index, document in enumerate(documents):
+                if index in failed:
+                    logger.warning(
+                        "Allocation %s double books an archived one; not archived",
+                        document["_id"],
+                    )
+                    stuck.append(document["_id"])
+                else:
+                    moved.append(document["_id"])
+
+        if moved:
+            await database.allocations_collection.delete_many({"_id": {"$in": moved}})
+        ARCHIVED_ALLOCATIONS.inc(len(moved))
+        archived += len(moved)
+
+
+async def run_archiver() -> None:
+    """
+    Run archive_allocations every ARCHIVE_INTERVAL seconds.
+
+    Runs for the lifetime of the worker. A Redis lock held for one interval
+    lets a single worker archive per interval however many are running.
+    """
+    while True:
+        try:
+            if await database.redis.set(
+                ARCHIVE_LOCK_KEY, "1", nx=True, ex=settings.ARCHIVE_INTERVAL
+            ):
+                archived = await archive_allocations()
+                logger.info("Archived %d past allocations", archived)
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            logger.exception("Archiving past allocations failed")
+        await asyncio.sleep(settings.ARCHIVE_INTERVAL)
+
+
+async def main():
+    await database.connect()
+    try:
+        archived = await archive_allocations()
+    finally:
+        await database.disconnect()
+    print(f"Archived {archived} past allocations")
+
+
+if __name__ == "__main__":
+    # Usage: python -m app.archive
+    asyncio.run(main())
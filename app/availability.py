@@ -0,0 +1,153 @@
+import asyncio
+from collections import defaultdict
+from datetime import date, datetime, timedelta
+from typing import Dict, Iterable, List, Union
+
+from . import database
+from .archive import history_partitions
+from .keys import FLEET_KEY, as_date, availability_key
+from .models import allocation_schema
+
+# Bit N of a vehicle's bitmap is set when it is booked on EPOCH + N days
+EPOCH = date(1970, 1, 1)
+
+
+def day_offset(allocation_date: Union[date, datetime]) -> int:
+    """
+    Convert a date into its bit offset in the availability bitmaps.
+
+    Parameters:
+    - allocation_date (date | datetime): The allocation date.
+
+    Returns:
+    - int: Number of days since EPOCH.
+    """
+    return (as_date(allocation_date) - EPOCH).days
+
+
+def queue_booking(pipe, vehicle_id: str, allocation_date, booked: bool = True):
+    """
+    Queue the bitmap update for one booking on an existing Redis pipeline.
+
+    Parameters:
+    - pipe: A pipeline from the binary Redis client.
+    - vehicle_id (str): The ID of the vehicle.
+    - allocation_date (date | datetime): The booked date.
+    - booked (bool): True to mark the day booked, False to free it.
+    """
+    pipe.setbit(availability_key(vehicle_id), day_offset(allocation_date), int(booked))
+    if booked:
+        pipe.sadd(FLEET_KEY, vehicle_id)
+
+
+async def get_fleet() -> List[str]:
+    """
+    Return the IDs of every known vehicle, sorted.
+    """
+    members = await database.redis_binary.smembers(FLEET_KEY)
+    return sorted(member.decode() for member in members)
+
+
+def _decode_bits(raw: bytes, first_bit: int, days: int) -> List[bool]:
+    """
+    Read `days` consecutive bits starting at `first_bit` of `raw`.
+
+    Redis numbers bits from the most significant bit of the first byte, and
+    bytes missing from the end of the bitmap are zero.
+    """
+    booked = []
+    for bit in range(first_bit, first_bit + days):
+        byte = bit // 8
+        booked.append(byte < len(raw) and bool(raw[byte] & (0x80 >> (bit % 8))))
+    return booked
+
+
+async def get_calendars(
+    vehicle_ids: Iterable[str], start_date: date, end_date: date
+) -> Dict[str, List[bool]]:
+    """
+    Fetch the booked/free calendar of several vehicles over a date range.
+
+    Each bitmap is read with one GETRANGE covering only the bytes of the range,
+    and all reads share a single pipeline round trip.
+
+    Parameters:
+    - vehicle_ids (Iterable[str]): The vehicles to fetch.
+    - start_date (date): First day of the range.
+    - end_date (date): Last day of the range (inclusive).
+
+    Returns:
+    - dict: Maps each vehicle ID to one "booked" flag per day of the range.
+    """
+    vehicle_ids = list(vehicle_ids)
+    first, last = day_offset(start_date), day_offset(end_date)
+    first_byte = first // 8
+    async with database.redis_binary.pipeline(transaction=False) as pipe:
+        for vehicle_id in vehicle_ids:
+            pipe.getrange(availability_key(vehicle_id), first_byte, last // 8)
+        ranges = await pipe.execute()
+    days = last - first + 1
+    return {
+        vehicle_id: _decode_bits(raw, first - first_byte * 8, days)
+        for vehicle_id, raw in zip(vehicle_ids, ranges)
+    }
+
+
+async def rebuild_availability(batch_size: int = 10000) -> int:
+    """
+    Rebuild every availability bitmap from the allocations collection and its archives.
+
+    Bitmaps are assembled in memory and swapped in with one pipeline, so readers
+    never see a partially rebuilt calendar.
+
+    Parameters:
+    - batch_size (int): Cursor batch size used while scanning allocations.
+
+    Returns:
+    - int: Number of vehicles written.
+    """
+    bitmaps = defaultdict(bytearray)
+    projection = allocation_schema.projection("vehicle_id", "allocation_date")
+    for collection in await history_partitions():
+        cursor = collection.find({}, {"_id": 0, **projection}).batch_size(batch_size)
+        async for document in cursor:
+            allocation = allocation_schema.from_document(document)
+            bitmap = bitmaps[allocation["vehicle_id"]]
+            bit = day_offset(allocation["allocation_date"])
+            if len(bitmap) <= bit // 8:
+                bitmap.extend(bytes(bit // 8 + 1 - len(bitmap)))
+            bitmap[bit // 8] |= 0x80 >> (bit % 8)
+
+    stale = set(await get_fleet()) - set(bitmaps)
+    async with database.redis_binary.pipeline(transaction=True) as pipe:
+        pipe.delete(FLEET_KEY, *(availability_key(vehicle) for vehicle in stale))
+        for vehicle_id, bitmap in bitmaps.items():
+            pipe.set(availability_key(vehicle_id), bytes(bitmap))
+        if bitmaps:
+            pipe.sadd(FLEET_KEY, *bitmaps)
+        await pipe.execute()
+    return len(bitmaps)
+
+
+def date_range(start_date: date, end_date: date) -> List[date]:
+    """
+    Return every date from start_date to end_date inclusive.
+    """
+    return [
+        start_date + timedelta(days=offset)
+        for offset in range((end_date - start_date).days + 1)
+    ]
+
+
+async def main():
+    await database.connect()
+    try:
+        vehicles = await rebuild_availability()
+    finally:
+        await database.disconnect()
+    print(f"Rebuilt availability bitmaps for {vehicles} vehicles")
+
+
+if __name__ == "__main__":
+    # Usage: python -m app.availability
+    asyncio.run(main())
@@ -0,0 +1,228 @@
+import asyncio
+import json
+import logging
+import time
+from collections import OrderedDict
+from typing import Any, Iterable
+
+from . import database
+from .keys import INVALIDATION_CHANNEL, invalidation_mark_key, stale_key
+from .metrics import CACHE_INVALIDATIONS, LOCAL_CACHE_EVICTIONS
+from .singleflight import lookup_flights
+from .utils import settings
+
+logger = logging.getLogger(__name__)
+
+# Returned by LocalCache.get when a key is absent or expired
+MISSING = object()
+
+# A load that read MongoDB before a write could otherwise cache the old value
+# after the write's invalidation, where it would stay until it expired. So
+# each invalidation records the Redis time in a mark key next to the entry,
+# loads read the Redis time before querying MongoDB, and fills are skipped
+# when the entry was invalidated since. Within a worker, LocalCache.generation
+# plays the same role for the local cache.
+
+# Records the current time (microseconds, as a string so Lua keeps every
+# digit) in the first ARGV[1] keys for ARGV[2] seconds, then deletes the
+# other keys. Marking and deleting at once leaves no gap for a fill.
+_INVALIDATE_SCRIPT = """
+local time = redis.call("TIME")
+local now = time[1] .. string.format("%06d", tonumber(time[2]))
+local marks = tonumber(ARGV[1])
+for index = 1, marks do
+    redis.call("SET", KEYS[index], now, "EX", ARGV[2])
+end
+for index = marks + 1, #KEYS do
+    redis.call("DEL", KEYS[index])
+end
+return marks
+"""
+
+# Sets KEYS[1] (and KEYS[3], the stale copy, if given) to ARGV[2] unless the
+# mark KEYS[2] is at or after ARGV[1], the time the load began. Returns 1 if
+# the entry was written.
+CACHE_FILL_SCRIPT = """
+local mark = redis.call("GET", KEYS[2])
+if mark and tonumber(mark) >= tonumber(ARGV[1]) then
+    return 0
+end
+redis.call("SET", KEYS[1], ARGV[2], "EX", ARGV[3])
+if KEYS[3] then
+    redis.call("SET", KEYS[3], ARGV[2], "EX", ARGV[4])
+end
+return 1
+"""
+
+
+class LocalCache:
+    """
+    Bounded in-process LRU cache with a per-entry TTL.
+
+    Sits in front of Redis so repeated lookups within a worker skip the network.
+    Entries are dropped when another worker publishes an invalidation, and the
+    TTL bounds staleness if an invalidation message is ever missed.
+
+    Attributes:
+    - max_size (int): Maximum number of entries before the least recently used is evicted.
+    - ttl (float): Seconds an entry stays valid.
+    - generation (int): Bumped by every invalidation; see set().
+    - hits, misses, evictions, invalidations (int): Counters for sizing the cache.
+    """
+
+    def __init__(self, max_size: int, ttl: float):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries: OrderedDict = OrderedDict()
+        self.generation = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def get(self, key: str) -> Any:
+        """
+        Return the cached value for a key, or MISSING.
+        """
+        entry = self._entries.get(key)
+        if entry is None or entry[0] < time.monotonic():
+            if entry is not None:
+                del self._entries[key]
+            self.misses += 1
+            return MISSING
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return entry[1]
+
+    def set(self, key: str, value: Any, generation: int = None) -> None:
+        """
+        Store a value, evicting the least recently used entry when full.
+
+        Parameters:
+        - key (str): The cache key.
+        - value (Any): The value to cache.
+        - generation (int, optional): The generation read before the value was
+          loaded; the value is not stored if an invalidation happened since.
+        """
+        if self.max_size <= 0:
+            return
+        if generation is not None and generation != self.generation:
+            return
+        self._entries[key] = (time.monotonic() + self.ttl, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+            LOCAL_CACHE_EVICTIONS.inc()
+
+    def invalidate(self, keys: Iterable[str]) -> None:
+        """
+        Drop the given keys from this worker's cache.
+        """
+        self.generation += 1
+        for key in keys:
+            if self._entries.pop(key, None) is not None:
+                self.invalidations += 1
+
+    def clear(self) -> None:
+        """
+        Drop every entry, e.g. after invalidation messages may have been missed.
+        """
+        self.generation += 1
+        self.invalidations += len(self._entries)
+        self._entries.clear()
+
+    def stats(self) -> dict:
+        """
+        Return the cache counters and current size.
+        """
+        return {
+            "size": len(self._entries),
+            "max_size": self.max_size,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "invalidations": self.invalidations,
+        }
+
+
+local_cache = LocalCache(settings.L1_CACHE_MAX_SIZE, settings.L1_CACHE_TTL)
+
+
+def queue_invalidation(pipe, keys: Iterable[str]) -> None:
+    """
+    Invalidate cache keys in this worker and queue the Redis side on a pipeline.
+
+    The pipeline marks the keys as invalidated, so that loads which began
+    earlier do not cache them again, deletes them and their stale copies from
+    Redis, and publishes them so that every other worker drops its local copy.
+
+    Parameters:
+    - pipe: A Redis pipeline; the caller executes it.
+    - keys (Iterable[str]): The cache keys to invalidate.
+    """
+    keys = list(keys)
+    if not keys:
+        return
+    local_cache.invalidate(keys)
+    lookup_flights.forget(keys)
+    CACHE_INVALIDATIONS.inc(len(keys))
+    pipe.eval(
+        _INVALIDATE_SCRIPT,
+        3 * len(keys),
+        *(invalidation_mark_key(key) for key in keys),
+        *keys,
+        *(stale_key(key) for key in keys),
+        len(keys),
+        settings.INVALIDATION_MARK_TTL,
+    )
+    pipe.publish(INVALIDATION_CHANNEL, json.dumps(keys))
+
+
+async def server_time() -> int:
+    """
+    Return the Redis server time in microseconds, the clock of invalidation marks.
+
+    Read it before loading an entry from MongoDB and pass it to
+    CACHE_FILL_SCRIPT, so the fill is skipped if the entry is invalidated meanwhile.
+    """
+    seconds, microseconds = await database.redis_binary.time()
+    return seconds * 1_000_000 + microseconds
+
+
+async def invalidate(*keys: str) -> None:
+    """
+    Invalidate cache keys in Redis and in every worker's local cache.
+
+    Parameters:
+    - keys (str): The cache keys to invalidate.
+    """
+    async with database.redis.pipeline(transaction=False) as pipe:
+        queue_invalidation(pipe, keys)
+        await pipe.execute()
+
+
+async def listen_for_invalidations() -> None:
+    """
+    Drop local cache entries invalidated by other workers.
+
+    Runs for the lifetime of the worker. If the subscription is lost, the local
+    cache is cleared before resubscribing because messages may have been missed.
+    """
+    while True:
+        pubsub = database.redis.pubsub()
+        try:
+            await pubsub.subscribe(INVALIDATION_CHANNEL)
+            local_cache.clear()
+            async for message in pubsub.listen():
+                if message["type"] == "message":
+                    keys = json.loads(message["data"])
+                    local_cache.invalidate(keys)
+                    lookup_flights.forget(keys)
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            logger.exception("Cache invalidation listener failed, resubscribing")
+            await asyncio.sleep(1)
+        finally:
+            await pubsub.close()
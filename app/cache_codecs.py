@@ -0,0 +1,127 @@
+import json
+import struct
+from datetime import date, datetime
+from typing import Optional, Union
+
+from bson import ObjectId
+
+from .utils import CustomJSONEncoder, settings
+
+# Codecs for allocation documents cached under vehicle/date keys. Every codec
+# decodes to the shape read from MongoDB: "_id" as an ObjectId and
+# "allocation_date" as a midnight datetime, so a lookup returns the same
+# document whether it hit a cache or not. A cached miss is None.
+
+EPOCH = date(1970, 1, 1)
+EPOCH_ORDINAL = EPOCH.toordinal()
+
+
+class JSONCodec:
+    """
+    Text JSON encoding, the original cache format.
+    """
+
+    name = "json"
+
+    def encode(self, allocation: Optional[dict]) -> bytes:
+        return json.dumps(allocation, cls=CustomJSONEncoder).encode()
+
+    def decode(self, data: Union[bytes, str]) -> Optional[dict]:
+        allocation = json.loads(data)
+        if allocation is None:
+            return None
+        # JSON holds the ObjectId and the datetime as strings
+        allocation["_id"] = ObjectId(allocation["_id"])
+        allocation["allocation_date"] = datetime.fromisoformat(
+            allocation["allocation_date"]
+        )
+        return allocation
+
+
+class BinaryCodec:
+    """
+    Compact binary encoding of an allocation document.
+
+    Layout (big-endian):
+    - version (1 byte): VERSION; never a valid first byte of JSON text.
+    - present (1 byte): 0 for a cached miss, in which case nothing follows.
+    - _id (12 bytes): the raw ObjectId.
+    - allocation_date (4 bytes): days since 1970-01-01.
+    - employee_id, vehicle_id: each a 2-byte length followed by UTF-8 bytes.
+
+    Only the allocation fields above are kept.
+    """
+
+    name = "binary"
+    VERSION = 1
+    _header = struct.Struct(">BB")
+    _body = struct.Struct(">12sI")
+    _length = struct.Struct(">H")
+
+    def encode(self, allocation: Optional[dict]) -> bytes:
+        if allocation is None:
+            return self._header.pack(self.VERSION, 0)
+        allocation_date = allocation["allocation_date"]
+        if isinstance(allocation_date, str):
+            allocation_date = datetime.fromisoformat(allocation_date)
+        if isinstance(allocation_date, datetime):
+            allocation_date = allocation_date.date()
+        parts = [
+            self._header.pack(self.VERSION, 1),
+            self._body.pack(
+                ObjectId(allocation["_id"]).binary, (allocation_date - EPOCH).days
+            ),
+        ]
+        for field in ("employee_id", "vehicle_id"):
+            value = allocation[field].encode()
+            parts.append(self._length.pack(len(value)))
+            parts.append(value)
+        return b"".join(parts)
+
+    def decode(self, data: bytes) -> Optional[dict]:
+        version, present = self._header.unpack_from(data)
+        if version != self.VERSION:
+            raise ValueError(f"Unsupported cache entry version {version}")
+        if not present:
+            return None
+        offset = self._header.size
+        object_id, days = self._body.unpack_from(data, offset)
+        offset += self._body.size
+        (length,) = self._length.unpack_from(data, offset)
+        offset += self._length.size
+        employee_id = data[offset : offset + length].decode()
+        offset += length
+        (length,) = self._length.unpack_from(data, offset)
+        offset += self._length.size
+        vehicle_id = data[offset : offset + length].decode()
+        allocation_date = date.fromordinal(EPOCH_ORDINAL + days)
+        return {
+            "_id": ObjectId(object_id),
+            "employee_id": employee_id,
+            "vehicle_id": vehicle_id,
+            "allocation_date": datetime.combine(allocation_date, datetime.min.time()),
+        }
+
+
+CODECS = {codec.name: codec for codec in (JSONCodec(), BinaryCodec())}
+
+# Codec used for new cache entries
+cache_codec = CODECS[settings.CACHE_CODEC]
+
+
+def decode_cached(data: bytes) -> Optional[dict]:
+    """
+    Decode a cache entry written by any codec.
+
+    Binary entries start with their version byte; anything else is legacy JSON,
+    so entries written before a codec switch remain readable.
+
+    Parameters:
+    - data (bytes): The raw cache entry.
+
+    Returns:
+    - dict: The cached allocation, or None for a cached miss.
+    """
+    if data[:1] == bytes([BinaryCodec.VERSION]):
+        return CODECS["binary"].decode(data)
+    return CODECS["json"].decode(data)
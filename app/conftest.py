@@ -0,0 +1,4 @@
+def pytest_configure(config):
+    config.addinivalue_line(
+        "markers", "no_services: the test runs without MongoDB and Redis"
+    )
@@ -1,22 +1,91 @@
+import asyncio
+import csv
+import heapq
+import io
 import json
+from collections import Counter
 from datetime import date, datetime, timezone
+from typing import AsyncIterator, List, Tuple
 from fastapi import HTTPException
 from bson import ObjectId
+from pymongo import ReturnDocument
+from pymongo.errors import BulkWriteError, DuplicateKeyError
 
-from .database import allocations_collection, redis
+from .archive import (
+    archive_cutoff,
+    find_archived,
+    find_archived_allocation,
+    find_archived_allocations,
+    history_partitions,
+    is_archived,
+    merge_sorted,
+    today,
+)
+from .availability import (
+    date_range,
+    get_calendars,
+    get_fleet,
+    queue_booking,
+)
+from .cache import (
+    CACHE_FILL_SCRIPT,
+    MISSING,
+    local_cache,
+    queue_invalidation,
+    server_time,
+)
+from .cache_codecs import cache_codec, decode_cached
+from . import database
+from .history_cache import (
+    encode_history_page,
+    get_cached_history,
+    history_cache_key,
+    queue_generation_bump,
+    store_history,
+)
+from .keys import (
+    as_date,
+    history_count_key,
+    invalidation_mark_key,
+    stale_key,
+    vehicle_date_key,
+)
+from .metrics import CACHE_LOOKUPS
+from .rollups import apply_rollups, rollup_keys
+from .singleflight import (
+    acquire_lookup_lock,
+    lookup_flights,
+    release_lookup_lock,
+    wait_for_fill,
+)
 from .models import (
+    AllocationLookup,
+    AllocationLookupResponse,
+    AllocationLookupResult,
     AllocationModel,
     AllocationUpdateModel,
-    PaginatedResponse,
+    AvailabilityResponse,
+    BulkAllocationResponse,
+    BulkAllocationResult,
     CreateResponseModel,
+    RangeAllocationModel,
+    RangeAllocationResponse,
+    VehicleCalendar,
+    allocation_schema,
 )
-from .utils import CustomJSONEncoder
+from .utils import settings, encode_cursor, decode_cursor
 
 
 # Helper to retrieve allocation by vehicle and date
 async def get_allocation_by_vehicle_date(vehicle_id: str, allocation_date: date):
     """
-    Retrieve allocation by vehicle ID and allocation date, checking the cache first.
+    Retrieve allocation by vehicle ID and allocation date, checking the caches first.
+
+    The in-process cache is consulted before Redis; both are filled on a miss.
+    A vehicle that is free on the date is cached too, as a short-lived negative
+    entry that create_allocation clears. Concurrent misses for the same key are
+    coalesced into a single MongoDB query, which reads the hot collection and,
+    for past dates only, the archive of the month.
 
     Parameters:
     - vehicle_id (str): The ID of the vehicle.
@@ -25,23 +94,249 @@ async def get_allocation_by_vehicle_date(vehicle_id: str, allocation_date: date)
     Returns:
     - dict: The allocation details or None if not found.
     """
-    # Create cache key
-    cache_key = f"vehicle:{vehicle_id}:date:{allocation_date}"
+    cache_key = vehicle_date_key(vehicle_id, allocation_date)
 
-    # Check in Redis cache first
-    cached_allocation = await redis.get(cache_key)
-    if cached_allocation:
-        return json.loads(cached_allocation)
+    # Check this worker's local cache, then Redis; misses are cached as None
+    cached_allocation = local_cache.get(cache_key)
+    if cached_allocation is not MISSING:
+        CACHE_LOOKUPS.labels("local", "hit").inc()
+        return cached_allocation
+    CACHE_LOOKUPS.labels("local", "miss").inc()
+    generation = local_cache.generation
+    cached_allocation = await database.redis_binary.get(cache_key)
+    if cached_allocation is not None:
+        CACHE_LOOKUPS.labels("redis", "hit").inc()
+        allocation = decode_cached(cached_allocation)
+        local_cache.set(cache_key, allocation, generation)
+        return allocation
+    CACHE_LOOKUPS.labels("redis", "miss").inc()
 
-    allocation = await allocations_collection.find_one(
-        {"vehicle_id": vehicle_id, "allocation_date": allocation_date}
+    return await lookup_flights.run(
+        cache_key, lambda: load_allocation(vehicle_id, allocation_date, cache_key)
     )
-    # Cache the result in Redis
-    if allocation:
-        await redis.set(
-            cache_key, json.dumps(allocation, cls=CustomJSONEncoder), ex=3600
-        )  # Set cache expiry for 1 hour
-        return allocation
+
+
+async def load_allocation(vehicle_id: str, allocation_date: date, cache_key: str):
+    """
+    Read an allocation from MongoDB and store it in both cache tiers.
+
+    With LOOKUP_LOCK_TTL set, only the worker holding the key's Redis lock
+    queries MongoDB; the others serve the stale copy of an expired entry, or
+    wait for the lock holder's result, and query MongoDB only if it never comes.
+    Neither cache is filled if the key is invalidated while the load runs.
+
+    Parameters:
+    - vehicle_id (str): The ID of the vehicle.
+    - allocation_date (date): The date of the allocation.
+    - cache_key (str): The vehicle/date cache key.
+
+    Returns:
+    - dict: The allocation details or None if not found.
+    """
+    generation = local_cache.generation
+    token = None
+    if settings.LOOKUP_LOCK_TTL:
+        token = await acquire_lookup_lock(cache_key)
+        if token is None:
+            cached_allocation = await wait_for_fill(cache_key)
+            if cached_allocation is not None:
+                allocation = decode_cached(cached_allocation)
+                local_cache.set(cache_key, allocation, generation)
+                return allocation
+
+    try:
+        started = await server_time()
+        allocation = allocation_schema.from_document(
+            await database.allocations_collection.find_one(
+                allocation_schema.match(
+                    vehicle_id=vehicle_id, allocation_date=allocation_date
+                ),
+                allocation_schema.projection(),
+            )
+        )
+        if allocation is None and as_date(allocation_date) < today():
+            allocation = await find_archived_allocation(vehicle_id, allocation_date)
+        async with database.redis_binary.pipeline(transaction=False) as pipe:
+            queue_cache_fill(pipe, cache_key, allocation, started)
+            (filled,) = await pipe.execute()
+    finally:
+        if token is not None:
+            await release_lookup_lock(cache_key, token)
+    if filled:
+        local_cache.set(cache_key, allocation, generation)
+    return allocation
+
+
+def queue_cache_fill(pipe, cache_key: str, allocation, started: int) -> None:
+    """
+    Queue caching a lookup result in Redis on a pipeline.
+
+    Misses are cached too, for NEGATIVE_CACHE_TTL seconds only. With the lookup
+    lock enabled, a longer-lived stale copy is written alongside. Nothing is
+    written if the key was invalidated after the load began; the pipeline
+    result of the fill is 1 if it was written and 0 otherwise.
+
+    Parameters:
+    - pipe: A Redis pipeline of the binary client; the caller executes it.
+    - cache_key (str): The vehicle/date cache key.
+    - allocation (dict): The allocation, or None if the vehicle is free.
+    - started (int): The server_time() read before loading the allocation.
+    """
+    encoded = cache_codec.encode(allocation)
+    ttl = 3600 if allocation else settings.NEGATIVE_CACHE_TTL
+    keys = [cache_key, invalidation_mark_key(cache_key)]
+    if settings.LOOKUP_LOCK_TTL:
+        keys.append(stale_key(cache_key))
+    pipe.eval(
+        CACHE_FILL_SCRIPT,
+        len(keys),
+        *keys,
+        started,
+        encoded,
+        ttl,
+        ttl + settings.LOOKUP_STALE_TTL,
+    )
+
+
+# Look up many vehicle/date pairs at once
+async def get_allocations_by_vehicle_dates(
+    lookups: List[AllocationLookup],
+) -> AllocationLookupResponse:
+    """
+    Retrieve the allocations of many vehicle/date pairs with a fixed number of round trips.
+
+    Pairs found in this worker's local cache cost nothing, the others are read
+    from Redis with one MGET, and those missing there too are read from MongoDB
+    with one $or query (plus one query per archive month for past dates) and
+    cached with one pipeline.
+
+    Parameters:
+    - lookups (List[AllocationLookup]): The vehicle/date pairs to look up.
+
+    Returns:
+    - AllocationLookupResponse: The allocation of each pair, in request order.
+    """
+    pairs = {
+        vehicle_date_key(lookup.vehicle_id, lookup.allocation_date): (
+            lookup.vehicle_id,
+            lookup.allocation_date,
+        )
+        for lookup in lookups
+    }
+    found = {}
+    remote_keys = []
+    for cache_key in pairs:
+        cached_allocation = local_cache.get(cache_key)
+        if cached_allocation is MISSING:
+            CACHE_LOOKUPS.labels("local", "miss").inc()
+            remote_keys.append(cache_key)
+        else:
+            CACHE_LOOKUPS.labels("local", "hit").inc()
+            found[cache_key] = cached_allocation
+
+    missing_keys = []
+    if remote_keys:
+        generation = local_cache.generation
+        cached_allocations = await database.redis_binary.mget(*remote_keys)
+        for cache_key, cached_allocation in zip(remote_keys, cached_allocations):
+            if cached_allocation is None:
+                CACHE_LOOKUPS.labels("redis", "miss").inc()
+                missing_keys.append(cache_key)
+                continue
+            CACHE_LOOKUPS.labels("redis", "hit").inc()
+            found[cache_key] = decode_cached(cached_allocation)
+            local_cache.set(cache_key, found[cache_key], generation)
+
+    if missing_keys:
+        found.update(await load_allocations([pairs[key] for key in missing_keys]))
+
+    return AllocationLookupResponse(
+        results=[
+            AllocationLookupResult(
+                vehicle_id=lookup.vehicle_id,
+                allocation_date=lookup.allocation_date,
+                allocation=found[
+                    vehicle_date_key(lookup.vehicle_id, lookup.allocation_date)
+                ],
+            )
+            for lookup in lookups
+        ]
+    )
+
+
+async def load_allocations(pairs: List[Tuple[str, date]]) -> dict:
+    """
+    Read the allocations of vehicle/date pairs from MongoDB and cache them.
+
+    Pairs invalidated while they were being read are returned but not cached.
+
+    Parameters:
+    - pairs (List[Tuple[str, date]]): The vehicle IDs and dates to read.
+
+    Returns:
+    - dict: The allocation, or None, of each pair by vehicle/date cache key.
+    """
+    generation = local_cache.generation
+    started = await server_time()
+    documents, archived = await asyncio.gather(
+        database.allocations_collection.find(
+            {
+                "$or": [
+                    allocation_schema.match(
+                        vehicle_id=vehicle_id, allocation_date=allocation_date
+                    )
+                    for vehicle_id, allocation_date in pairs
+                ]
+            },
+            allocation_schema.projection(),
+        ).to_list(length=None),
+        find_archived_allocations(pairs),
+    )
+    loaded = {
+        vehicle_date_key(vehicle_id, allocation_date): None
+        for vehicle_id, allocation_date in pairs
+    }
+    for allocation in [*map(allocation_schema.from_document, documents), *archived]:
+        cache_key = vehicle_date_key(
+            allocation["vehicle_id"], allocation["allocation_date"]
+        )
+        loaded[cache_key] = allocation
+
+    async with database.redis_binary.pipeline(transaction=False) as pipe:
+        for cache_key, allocation in loaded.items():
+            queue_cache_fill(pipe, cache_key, allocation, started)
+        filled = await pipe.execute()
+    for (cache_key, allocation), written in zip(loaded.items(), filled):
+        if written:
+            local_cache.set(cache_key, allocation, generation)
+    return loaded
+
+
+async def invalidate_allocations(
+    cache_keys: List[str],
+    employee_ids: List[str],
+    vehicle_ids: List[str],
+    bookings: List[Tuple[str, datetime, bool]] = (),
+) -> None:
+    """
+    Invalidate everything a write affects in a single Redis round trip.
+
+    The lookup keys, history generations and availability bitmaps all go
+    out on one pipeline.
+
+    Parameters:
+    - cache_keys (List[str]): Vehicle/date lookup keys to invalidate.
+    - employee_ids (List[str]): Employees whose cached history is now stale.
+    - vehicle_ids (List[str]): Vehicles whose cached history is now stale.
+    - bookings (List[Tuple[str, datetime, bool]]): Vehicle, date and whether it
+      is now booked (True) or free (False), for the availability bitmaps.
+    """
+    async with database.redis_binary.pipeline(transaction=False) as pipe:
+        queue_invalidation(pipe, cache_keys)
+        queue_generation_bump(pipe, employee_ids, vehicle_ids)
+        for vehicle_id, allocation_date, booked in bookings:
+            queue_booking(pipe, vehicle_id, allocation_date, booked)
+        await pipe.execute()
 
 
 # Create allocation
@@ -58,71 +353,438 @@ async def create_allocation(allocation: AllocationModel) -> CreateResponseModel:
     Raises:
     - HTTPException: If the vehicle is already allocated for the date.
     """
-    existing_allocation = await get_allocation_by_vehicle_date(
-        allocation.vehicle_id,
-        datetime.combine(allocation.allocation_date, datetime.min.time()),
-    )
-    if existing_allocation:
+    # The unique vehicle/date index rejects double bookings, so the insert
+    # itself is the conflict check; past dates are also checked in the archive.
+    if await find_archived([(allocation.vehicle_id, allocation.allocation_date)]):
+        raise HTTPException(
+            status_code=400, detail="Vehicle already allocated for this date"
+        )
+    try:
+        result = await database.allocations_collection.insert_one(
+            allocation_schema.to_document(allocation.model_dump())
+        )
+    except DuplicateKeyError:
         raise HTTPException(
             status_code=400, detail="Vehicle already allocated for this date"
         )
-
-    new_allocation = allocation.model_dump()
-    new_allocation["allocation_date"] = datetime.combine(
-        new_allocation["allocation_date"], datetime.min.time()
-    )
-    result = await allocations_collection.insert_one(new_allocation)
     # Invalidate Redis cache for this vehicle and date
-    cache_key = f"vehicle:{allocation.vehicle_id}:date:{allocation.allocation_date}"
-    await redis.delete(cache_key)
+    cache_key = vehicle_date_key(allocation.vehicle_id, allocation.allocation_date)
+    await invalidate_allocations(
+        [cache_key],
+        [allocation.employee_id],
+        [allocation.vehicle_id],
+        [(allocation.vehicle_id, allocation.allocation_date, True)],
+    )
+    await apply_rollups(
+        Counter(
+            rollup_keys(
+                allocation.employee_id,
+                allocation.vehicle_id,
+                allocation.allocation_date,
+            )
+        )
+    )
     return CreateResponseModel(id=str(result.inserted_id))
 
 
+async def record_created(documents: List[dict]) -> None:
+    """
+    Update the caches, availability bitmaps and rollups after inserting allocations.
+
+    Cache invalidation and availability bitmaps share one Redis pipeline, and
+    the rollup counts are adjusted with one bulk write.
+
+    Parameters:
+    - documents (List[dict]): The inserted allocation documents.
+    """
+    if not documents:
+        return
+    increments = Counter()
+    async with database.redis_binary.pipeline(transaction=False) as pipe:
+        for document in documents:
+            queue_booking(pipe, document["vehicle_id"], document["allocation_date"])
+            increments.update(
+                rollup_keys(
+                    document["employee_id"],
+                    document["vehicle_id"],
+                    document["allocation_date"],
+                )
+            )
+        queue_invalidation(
+            pipe,
+            [
+                vehicle_date_key(document["vehicle_id"], document["allocation_date"])
+                for document in documents
+            ],
+        )
+        queue_generation_bump(
+            pipe,
+            [document["employee_id"] for document in documents],
+            [document["vehicle_id"] for document in documents],
+        )
+        await pipe.execute()
+    await apply_rollups(increments)
+
+
+# Create many allocations at once
+async def create_allocations_bulk(
+    allocations: List[AllocationModel],
+) -> BulkAllocationResponse:
+    """
+    Create a batch of vehicle allocations, reporting conflicts per item.
+
+    Existing bookings for the whole batch are found with a single query, the
+    remaining items are written with one unordered insert_many, and the cache
+    entries and availability bitmaps of every created allocation are updated in
+    one Redis pipeline.
+
+    Parameters:
+    - allocations (List[AllocationModel]): The allocations to create.
+
+    Returns:
+    - BulkAllocationResponse: Per-item results in request order.
+    """
+    conflict_detail = "Vehicle already allocated for this date"
+    documents = []
+    for allocation in allocations:
+        document = allocation.model_dump()
+        document["_id"] = ObjectId()
+        document["allocation_date"] = datetime.combine(
+            document["allocation_date"], datetime.min.time()
+        )
+        documents.append(document)
+
+    pairs = {(doc["vehicle_id"], doc["allocation_date"]) for doc in documents}
+    existing, archived = await asyncio.gather(
+        database.allocations_collection.find(
+            {
+                "$or": [
+                    allocation_schema.match(
+                        vehicle_id=vehicle_id, allocation_date=allocation_date
+                    )
+                    for vehicle_id, allocation_date in pairs
+                ]
+            },
+            allocation_schema.projection("vehicle_id", "allocation_date"),
+        ).to_list(length=None),
+        find_archived(pairs),
+    )
+    taken = archived | {
+        (doc["vehicle_id"], doc["allocation_date"])
+        for doc in map(allocation_schema.from_document, existing)
+    }
+
+    results = [None] * len(documents)
+    to_insert = []  # (request index, document)
+    for index, document in enumerate(documents):
+        pair = (document["vehicle_id"], document["allocation_date"])
+        if pair in taken:
+            results[index] = BulkAllocationResult(
+                index=index, status="conflict", detail=conflict_detail
+            )
+            continue
+        # Later duplicates inside the same batch conflict with the first one
+        taken.add(pair)
+        to_insert.append((index, document))
+
+    failed = set()
+    if to_insert:
+        try:
+            await database.allocations_collection.insert_many(
+                [allocation_schema.to_document(document) for _, document in to_insert],
+                ordered=False,
+            )
+        except BulkWriteError as exc:
+            for error in exc.details["writeErrors"]:
+                if error["code"] != 11000:
+                    raise
+                # Lost a race with a concurrent booking for the same vehicle/date
+                failed.add(error["index"])
+
+    created_documents = []
+    for position, (index, document) in enumerate(to_insert):
+        if position in failed:
+            results[index] = BulkAllocationResult(
+                index=index, status="conflict", detail=conflict_detail
+            )
+            continue
+        results[index] = BulkAllocationResult(
+            index=index, status="created", id=str(document["_id"])
+        )
+        created_documents.append(document)
+    await record_created(created_documents)
+
+    created = sum(result.status == "created" for result in results)
+    return BulkAllocationResponse(
+        results=results, created=created, conflicts=len(results) - created
+    )
+
+
+def check_allocation_range(start_date: date, end_date: date) -> List[date]:
+    """
+    Validate the date range of a range allocation.
+
+    Parameters:
+    - start_date (date): The first day of the range.
+    - end_date (date): The last day of the range (inclusive).
+
+    Returns:
+    - List[date]: Every day of the range.
+
+    Raises:
+    - HTTPException: If the range is inverted or too long.
+    """
+    if end_date < start_date:
+        raise HTTPException(status_code=400, detail="end_date is before start_date")
+    if (end_date - start_date).days + 1 > settings.RANGE_ALLOCATION_MAX_DAYS:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Date range exceeds {settings.RANGE_ALLOCATION_MAX_DAYS} days",
+        )
+    return date_range(start_date, end_date)
+
+
+# Allocate a vehicle for every day of a date range, or not at all
+async def create_range_allocation(
+    allocation: RangeAllocationModel,
+) -> RangeAllocationResponse:
+    """
+    Allocate a vehicle to an employee on every day of a date range.
+
+    The whole range is checked with one $in query and written with one ordered
+    insert_many. If a concurrent booking takes one of the days in between, the
+    days already inserted are deleted again, so the range is booked entirely or
+    not at all.
+
+    Parameters:
+    - allocation (RangeAllocationModel): The employee, vehicle and date range.
+
+    Returns:
+    - RangeAllocationResponse: The IDs of the created allocations, in date order.
+
+    Raises:
+    - HTTPException: If the range is invalid or the vehicle is taken on any day.
+    """
+    days = [
+        datetime.combine(day, datetime.min.time())
+        for day in check_allocation_range(allocation.start_date, allocation.end_date)
+    ]
+    existing, archived = await asyncio.gather(
+        database.allocations_collection.find(
+            {
+                allocation_schema.field("vehicle_id"): allocation.vehicle_id,
+                allocation_schema.field("allocation_date"): {
+                    "$in": [
+                        allocation_schema.value("allocation_date", day) for day in days
+                    ]
+                },
+            },
+            {"_id": 0, **allocation_schema.projection("allocation_date")},
+        ).to_list(length=None),
+        find_archived((allocation.vehicle_id, day) for day in days),
+    )
+    if existing or archived:
+        raise range_conflict(
+            [
+                allocation_schema.from_document(document)["allocation_date"]
+                for document in existing
+            ]
+            + [day for _, day in archived]
+        )
+
+    documents = [
+        {
+            "_id": ObjectId(),
+            "employee_id": allocation.employee_id,
+            "vehicle_id": allocation.vehicle_id,
+            "allocation_date": day,
+        }
+        for day in days
+    ]
+    try:
+        await database.allocations_collection.insert_many(
+            [allocation_schema.to_document(document) for document in documents],
+            ordered=True,
+        )
+    except BulkWriteError as exc:
+        # Roll back the days inserted before the failure
+        await database.allocations_collection.delete_many(
+            {"_id": {"$in": [document["_id"] for document in documents]}}
+        )
+        # Readers may have cached the rolled back days in the meantime
+        await invalidate_allocations(
+            [vehicle_date_key(allocation.vehicle_id, day) for day in days],
+            [allocation.employee_id],
+            [allocation.vehicle_id],
+        )
+        error = exc.details["writeErrors"][0]
+        if error["code"] != 11000:
+            raise
+        raise range_conflict([documents[error["index"]]["allocation_date"]])
+
+    await record_created(documents)
+    return RangeAllocationResponse(ids=[str(document["_id"]) for document in documents])
+
+
+def range_conflict(dates: List[datetime]) -> HTTPException:
+    """
+    Build the error returned when a range allocation hits booked days.
+    """
+    booked = ", ".join(sorted(as_date(day).isoformat() for day in dates))
+    return HTTPException(
+        status_code=400, detail=f"Vehicle already allocated on {booked}"
+    )
+
+
+def changeable_filter(allocation_id: str) -> dict:
+    """
+    Build the filter matching an allocation that may still be changed.
+
+    Allocations can be updated or deleted only before their date, so the rule
+    is part of the filter and the check and the write are a single operation.
+
+    Parameters:
+    - allocation_id (str): The ID of the allocation.
+
+    Returns:
+    - dict: The MongoDB filter.
+
+    Raises:
+    - HTTPException: If the ID is not a valid ObjectId.
+    """
+    if not ObjectId.is_valid(allocation_id):
+        raise HTTPException(status_code=404, detail="Allocation not found")
+    return {
+        "_id": ObjectId(allocation_id),
+        allocation_schema.field("allocation_date"): {
+            "$gt": allocation_schema.value(
+                "allocation_date", datetime.now(timezone.utc).date()
+            )
+        },
+    }
+
+
+async def raise_unchangeable(allocation_id: str, action: str) -> None:
+    """
+    Explain why a conditional update or delete matched nothing.
+
+    Only runs on the failure path, so successful writes stay a single round trip.
+
+    Raises:
+    - HTTPException: 400 if the allocation is past or current, 404 if it does not exist.
+    """
+    if await database.allocations_collection.count_documents(
+        {"_id": ObjectId(allocation_id)}, limit=1
+    ) or await is_archived(allocation_id):
+        raise HTTPException(
+            status_code=400, detail=f"Cannot {action} past or current date allocations"
+        )
+    raise HTTPException(status_code=404, detail="Allocation not found")
+
+
 # Update allocation (only before the allocation date)
 async def update_allocation(
     allocation_id: str, update_data: AllocationUpdateModel
-) -> None:
+) -> dict:
     """
     Update an existing vehicle allocation.
 
+    The date rule is checked and the update applied by one find_one_and_update.
+    Moving the allocation onto a date on which the vehicle is already booked is
+    rejected by the unique vehicle/date index.
+
     Parameters:
     - allocation_id (str): The ID of the allocation to update.
     - update_data (AllocationUpdateModel): The updated allocation details.
 
+    Returns:
+    - dict: The allocation as stored after the update.
+
     Raises:
-    - HTTPException: If the allocation does not exist or if trying to update a past allocation.
+    - HTTPException: If the allocation does not exist, if trying to update a past
+      allocation, or if the vehicle is already allocated on the new date.
     """
-    allocation = await allocations_collection.find_one({"_id": ObjectId(allocation_id)})
-    if not allocation:
-        raise HTTPException(status_code=404, detail="Allocation not found")
-
-    if allocation["allocation_date"] <= datetime.combine(
-        datetime.now(timezone.utc).date(), datetime.min.time()
-    ):
-        raise HTTPException(
-            status_code=400, detail="Cannot update past or current date allocations"
-        )
-
+    query = changeable_filter(allocation_id)
     update_data = {k: v for k, v in update_data.model_dump().items() if v is not None}
     if update_data.get("allocation_date", None):
         update_data["allocation_date"] = datetime.combine(
             update_data["allocation_date"], datetime.min.time()
         )
 
-    if update_data:
-        await allocations_collection.update_one(
-            {"_id": ObjectId(allocation_id)}, {"$set": update_data}
+    new_date = update_data.get("allocation_date")
+    if new_date and as_date(new_date) < today():
+        # The unique vehicle/date index does not cover the archive
+        current = allocation_schema.from_document(
+            await database.allocations_collection.find_one(
+                query, allocation_schema.projection("vehicle_id")
+            )
+        )
+        if current and await find_archived([(current["vehicle_id"], new_date)]):
+            raise HTTPException(
+                status_code=400, detail="Vehicle already allocated for this date"
+            )
+
+    if not update_data:
+        allocation = await database.allocations_collection.find_one(
+            query, allocation_schema.projection()
         )
-    # Invalidate Redis cache for the old and new dates
-    old_cache_key = (
-        f"vehicle:{allocation['vehicle_id']}:date:{allocation['allocation_date']}"
+        if not allocation:
+            await raise_unchangeable(allocation_id, "update")
+        return allocation_schema.from_document(allocation)
+
+    try:
+        # The document before the update tells which cache entries to clear
+        allocation = await database.allocations_collection.find_one_and_update(
+            query,
+            {"$set": allocation_schema.to_document(update_data)},
+            projection=allocation_schema.projection(),
+            return_document=ReturnDocument.BEFORE,
+        )
+    except DuplicateKeyError:
+        raise HTTPException(
+            status_code=400, detail="Vehicle already allocated for this date"
+        )
+    allocation = allocation_schema.from_document(allocation)
+    if not allocation:
+        await raise_unchangeable(allocation_id, "update")
+    updated = {**allocation, **update_data}
+
+    # Invalidate Redis cache for the old and new dates, and move the booking
+    cache_keys = [
+        vehicle_date_key(allocation["vehicle_id"], allocation["allocation_date"])
+    ]
+    bookings = []
+    if updated["allocation_date"] != allocation["allocation_date"]:
+        cache_keys.append(
+            vehicle_date_key(updated["vehicle_id"], updated["allocation_date"])
+        )
+        bookings = [
+            (allocation["vehicle_id"], allocation["allocation_date"], False),
+            (updated["vehicle_id"], updated["allocation_date"], True),
+        ]
+    await invalidate_allocations(
+        cache_keys,
+        [allocation["employee_id"], updated["employee_id"]],
+        [allocation["vehicle_id"]],
+        bookings,
     )
-    await redis.delete(old_cache_key)
-    if "allocation_date" in update_data:
-        new_cache_key = (
-            f"vehicle:{allocation['vehicle_id']}:date:{update_data['allocation_date']}"
+    # Move the allocation between rollup buckets; unchanged buckets cancel out
+    increments = Counter(
+        rollup_keys(
+            updated["employee_id"],
+            updated["vehicle_id"],
+            updated["allocation_date"],
         )
-        await redis.delete(new_cache_key)
+    )
+    increments.subtract(
+        rollup_keys(
+            allocation["employee_id"],
+            allocation["vehicle_id"],
+            allocation["allocation_date"],
+        )
+    )
+    await apply_rollups(increments)
+    return updated
 
 
 # Delete allocation (only before the allocation date)
@@ -130,29 +792,163 @@ async def delete_allocation(allocation_id: str) -> None:
     """
     Delete an existing vehicle allocation.
 
+    The date rule is checked and the document removed by one find_one_and_delete.
+
     Parameters:
     - allocation_id (str): The ID of the allocation to delete.
 
     Raises:
     - HTTPException: If the allocation does not exist or if trying to delete a past allocation.
     """
-    allocation = await allocations_collection.find_one({"_id": ObjectId(allocation_id)})
+    allocation = allocation_schema.from_document(
+        await database.allocations_collection.find_one_and_delete(
+            changeable_filter(allocation_id), projection=allocation_schema.projection()
+        )
+    )
     if not allocation:
-        raise HTTPException(status_code=404, detail="Allocation not found")
+        await raise_unchangeable(allocation_id, "delete")
 
-    if allocation["allocation_date"] <= datetime.combine(
-        datetime.now(timezone.utc).date(), datetime.min.time()
-    ):
+    # Invalidate Redis cache for the allocation date
+    cache_key = vehicle_date_key(
+        allocation["vehicle_id"], allocation["allocation_date"]
+    )
+    await invalidate_allocations(
+        [cache_key],
+        [allocation["employee_id"]],
+        [allocation["vehicle_id"]],
+        [(allocation["vehicle_id"], allocation["allocation_date"], False)],
+    )
+    increments = Counter()
+    increments.subtract(
+        rollup_keys(
+            allocation["employee_id"],
+            allocation["vehicle_id"],
+            allocation["allocation_date"],
+        )
+    )
+    await apply_rollups(increments)
+
+
+async def get_availability(
+    start_date: date, end_date: date = None, vehicle_ids: List[str] = None
+) -> AvailabilityResponse:
+    """
+    Answer availability questions from the per-vehicle Redis bitmaps.
+
+    Parameters:
+    - start_date (date): The date to check, or the first day of a range.
+    - end_date (date, optional): Last day of the range; a single day if omitted.
+    - vehicle_ids (List[str], optional): Vehicles to check; defaults to the whole fleet.
+
+    Returns:
+    - AvailabilityResponse: Vehicles free for the whole range, plus per-vehicle
+      calendars when a range was requested.
+
+    Raises:
+    - HTTPException: If the range is inverted or too long.
+    """
+    end_date = check_availability_range(start_date, end_date)
+    vehicle_ids = vehicle_ids or await get_fleet()
+    calendars = await get_calendars(vehicle_ids, start_date, end_date)
+    return build_availability_response(start_date, end_date, calendars)
+
+
+def check_availability_range(start_date: date, end_date: date = None) -> date:
+    """
+    Validate the date range of an availability query.
+
+    Parameters:
+    - start_date (date): The first day of the range.
+    - end_date (date, optional): The last day of the range; a single day if omitted.
+
+    Returns:
+    - date: The last day of the range.
+
+    Raises:
+    - HTTPException: If the range is inverted or too long.
+    """
+    end_date = end_date or start_date
+    days = (end_date - start_date).days + 1
+    if days < 1:
+        raise HTTPException(status_code=400, detail="end_date is before start_date")
+    if days > settings.AVAILABILITY_MAX_DAYS:
         raise HTTPException(
-            status_code=400, detail="Cannot delete past or current date allocations"
+            status_code=400,
+            detail=f"Date range exceeds {settings.AVAILABILITY_MAX_DAYS} days",
         )
+    return end_date
 
-    await allocations_collection.delete_one({"_id": ObjectId(allocation_id)})
-    # Invalidate Redis cache for the allocation date
-    cache_key = (
-        f"vehicle:{allocation['vehicle_id']}:date:{allocation['allocation_date']}"
+
+def build_availability_response(
+    start_date: date, end_date: date, calendars: dict
+) -> AvailabilityResponse:
+    """
+    Build an availability response from per-vehicle calendars.
+
+    Parameters:
+    - start_date (date): The first day of the range.
+    - end_date (date): The last day of the range.
+    - calendars (dict): One list of booked flags per day for each vehicle ID.
+
+    Returns:
+    - AvailabilityResponse: Vehicles free for the whole range, plus per-vehicle
+      calendars when the range spans more than one day.
+    """
+    free_vehicles = [
+        vehicle_id for vehicle_id, booked in calendars.items() if not any(booked)
+    ]
+
+    # A single day only needs the free list; ranges also return each calendar
+    vehicle_calendars = None
+    if end_date > start_date:
+        dates = date_range(start_date, end_date)
+        vehicle_calendars = [
+            VehicleCalendar(
+                vehicle_id=vehicle_id,
+                booked_dates=[day for day, flag in zip(dates, booked) if flag],
+            )
+            for vehicle_id, booked in calendars.items()
+        ]
+
+    return AvailabilityResponse(
+        start_date=start_date,
+        end_date=end_date,
+        free_vehicles=free_vehicles,
+        calendars=vehicle_calendars,
     )
-    await redis.delete(cache_key)
+
+
+def build_history_query(
+    employee_id: str = None,
+    vehicle_id: str = None,
+    start_date: date = None,
+    end_date: date = None,
+) -> dict:
+    """
+    Build the MongoDB filter shared by the history endpoints.
+
+    Parameters:
+    - employee_id (str, optional): Filter by employee ID.
+    - vehicle_id (str, optional): Filter by vehicle ID.
+    - start_date (date, optional): Filter for allocations on or after this date.
+    - end_date (date, optional): Filter for allocations on or before this date.
+
+    Returns:
+    - dict: The MongoDB query.
+    """
+    query = {}
+    if employee_id:
+        query.update(allocation_schema.match(employee_id=employee_id))
+    if vehicle_id:
+        query.update(allocation_schema.match(vehicle_id=vehicle_id))
+    date_range = {}
+    if start_date:
+        date_range["$gte"] = allocation_schema.value("allocation_date", start_date)
+    if end_date:
+        date_range["$lte"] = allocation_schema.value("allocation_date", end_date)
+    if date_range:
+        query[allocation_schema.field("allocation_date")] = date_range
+    return query
 
 
 async def get_allocation_history(
@@ -162,10 +958,15 @@ async def get_allocation_history(
     end_date: date = None,
     skip: int = 0,
     limit: int = 10,
-):
+) -> bytes:
     """
     Retrieve allocation history based on provided filters.
-    This is not cached , as frequent read and update may cause overhead
+
+    Pages are cached in Redis under a key versioned by the generation counters
+    of the filtered employee/vehicle, which every write bumps. Documents are
+    projected to the API fields and the page is encoded to JSON once, for the
+    cache and the response alike.
+
     Parameters:
     - employee_id (str, optional): Filter by employee ID.
     - vehicle_id (str, optional): Filter by vehicle ID.
@@ -175,43 +976,402 @@ async def get_allocation_history(
     - limit (int, optional): Maximum number of records to return (default is 10).
 
     Returns:
-    - PaginatedResponse: Contains the allocation history and pagination info.
+    - bytes: The JSON of a PaginatedResponse with the history and pagination info.
     """
-    # This is not cached , as frequent read and update may cause overhead.
-    query = {}
-    if employee_id:
-        query["employee_id"] = employee_id
-    if vehicle_id:
-        query["vehicle_id"] = vehicle_id
-    if start_date and end_date:
-        query["allocation_date"] = {
-            "$gte": datetime.combine(start_date, datetime.min.time()),
-            "$lte": datetime.combine(end_date, datetime.min.time()),
-        }
-    elif start_date:
-        query["allocation_date"] = {"$gte": start_date}
-    elif end_date:
-        query["allocation_date"] = {"$lte": end_date}
+    cache_key = await history_cache_key(
+        "offset",
+        {
+            "employee_id": employee_id,
+            "vehicle_id": vehicle_id,
+            "start_date": start_date,
+            "end_date": end_date,
+            "skip": skip,
+            "limit": limit,
+        },
+    )
+    cached_page = await get_cached_history(cache_key)
+    if cached_page:
+        return cached_page
 
-    # Use aggregation to count and fetch results
-    pipeline = [
+    query = build_history_query(employee_id, vehicle_id, start_date, end_date)
+    partitions = await history_partitions(start_date, end_date)
+    if len(partitions) > 1:
+        total_count, history = await read_partitioned_page(
+            partitions, query, skip, limit
+        )
+    else:
+        total_count, history = await read_page(query, skip, limit)
+    # Determine if there's a next page
+    has_more = (skip + limit) < total_count
+
+    page = encode_history_page(
+        history, total=total_count, skip=skip, limit=limit, has_more=has_more
+    )
+    await store_history(cache_key, page)
+    return page
+
+
+def page_pipeline(query: dict, skip: int, limit: int) -> list:
+    """
+    Build the aggregation that reads one offset page and counts the matches.
+
+    The sort on (allocation_date, _id) is that of the keyset path, and is
+    served by the history indexes rather than sorting the matches in memory.
+
+    Parameters:
+    - query (dict): The MongoDB query built by build_history_query.
+    - skip (int): Number of records to skip.
+    - limit (int): Maximum number of records to return.
+
+    Returns:
+    - list: The aggregation pipeline.
+    """
+    return [
         {"$match": query},  # Filter based on query
+        # Order as the keyset path does, so offset pages are stable
+        {"$sort": {allocation_schema.field("allocation_date"): 1, "_id": 1}},
         {
             "$facet": {  # Use facet to separate counting and fetching
                 "count": [{"$count": "total"}],  # Count total matching documents
-                "data": [{"$skip": skip}, {"$limit": limit}],  # Paginate results
+                "data": [  # Paginate results, reading only the API fields
+                    {"$skip": skip},
+                    {"$limit": limit},
+                    {"$project": allocation_schema.projection()},
+                ],
             }
         },
     ]
 
-    result = await allocations_collection.aggregate(pipeline).to_list(length=None)
+
+async def read_page(query: dict, skip: int, limit: int) -> Tuple[int, List[dict]]:
+    """
+    Read one offset page of history and the total number of matches in one query.
+
+    Parameters:
+    - query (dict): The MongoDB query built by build_history_query.
+    - skip (int): Number of records to skip.
+    - limit (int): Maximum number of records to return.
+
+    Returns:
+    - Tuple[int, List[dict]]: The total number of matches and the page.
+    """
+    # Use aggregation to count and fetch results
+    result = await database.allocations_collection.aggregate(
+        page_pipeline(query, skip, limit)
+    ).to_list(length=None)
 
     # Extract total count and data
     total_count = result[0]["count"][0]["total"] if result and result[0]["count"] else 0
-    history = result[0]["data"]
-    # Determine if there's a next page
-    has_more = (skip + limit) < total_count
+    return total_count, [
+        allocation_schema.from_document(doc) for doc in result[0]["data"]
+    ]
 
-    return PaginatedResponse(
-        data=history, total=total_count, skip=skip, limit=limit, has_more=has_more
+
+async def read_partitioned_page(
+    partitions: list, query: dict, skip: int, limit: int
+) -> Tuple[int, List[dict]]:
+    """
+    Read one offset page of history spread over the archive and hot collections.
+
+    Like the cursor and export paths, each partition is read in (allocation_date,
+    _id) order and the partitions are merged on that key, so the hot
+    collection's past allocations land in date order and an allocation caught
+    in the middle of a move is returned once. Each partition reads at most
+    skip + limit documents.
+
+    Parameters:
+    - partitions (list): Collections returned by history_partitions.
+    - query (dict): The MongoDB query built by build_history_query.
+    - skip (int): Number of records to skip.
+    - limit (int): Maximum number of records to return.
+
+    Returns:
+    - Tuple[int, List[dict]]: The total number of matches and the page.
+    """
+    date_field = allocation_schema.field("allocation_date")
+    cursors = [
+        partition.find(query, allocation_schema.projection())
+        .sort([(date_field, 1), ("_id", 1)])
+        .limit(skip + limit)
+        for partition in partitions
+    ]
+    history = []
+    position = 0
+    async for document in merge_sorted(
+        cursors, key=lambda doc: (doc[date_field], doc["_id"])
+    ):
+        if position >= skip:
+            history.append(allocation_schema.from_document(document))
+        position += 1
+        if len(history) == limit:
+            break
+    return await count_partitions(query, partitions), history
+
+
+async def count_partitions(query: dict, partitions: list) -> int:
+    """
+    Count the allocations matching a query in the archive and hot collections.
+
+    An allocation being moved is in an archive and still in the hot collection
+    until the archiver deletes it there; it is counted once. Only hot
+    allocations dated before the archive cutoff can be in that window, so
+    only their IDs are looked up in the archives.
+
+    Parameters:
+    - query (dict): The MongoDB query built by build_history_query.
+    - partitions (list): Collections returned by history_partitions.
+
+    Returns:
+    - int: The number of distinct matching allocations.
+    """
+    counts = await asyncio.gather(
+        *(partition.count_documents(query) for partition in partitions)
+    )
+    *archives, hot = partitions
+    if not archives:
+        return sum(counts)
+    date_field = allocation_schema.field("allocation_date")
+    cutoff = allocation_schema.value("allocation_date", archive_cutoff())
+    moving = await hot.distinct("_id", {"$and": [query, {date_field: {"$lt": cutoff}}]})
+    if not moving:
+        return sum(counts)
+    copies = await asyncio.gather(
+        *(
+            archive.count_documents({"$and": [query, {"_id": {"$in": moving}}]})
+            for archive in archives
+        )
+    )
+    return sum(counts) - sum(copies)
+
+
+async def count_allocations(query: dict, partitions: list) -> int:
+    """
+    Count allocations matching a history query, reusing a recent count from the cache.
+
+    Unfiltered queries use the collection metadata estimate instead of a scan.
+
+    Parameters:
+    - query (dict): The MongoDB query built by build_history_query.
+    - partitions (list): Collections returned by history_partitions.
+
+    Returns:
+    - int: The (possibly slightly stale) number of matching allocations.
+    """
+    if not query:
+        counts = await asyncio.gather(
+            *(partition.estimated_document_count() for partition in partitions)
+        )
+        return sum(counts)
+
+    cache_key = history_count_key(query)
+    cached_count = await database.redis.get(cache_key)
+    if cached_count is not None:
+        return int(cached_count)
+
+    total = await count_partitions(query, partitions)
+    await database.redis.set(cache_key, total, ex=settings.HISTORY_COUNT_TTL)
+    return total
+
+
+async def get_allocation_history_page(
+    employee_id: str = None,
+    vehicle_id: str = None,
+    start_date: date = None,
+    end_date: date = None,
+    cursor: str = None,
+    limit: int = 10,
+    include_total: bool = False,
+) -> bytes:
+    """
+    Retrieve allocation history using keyset pagination.
+
+    Results are ordered by (allocation_date, _id) and each page starts after the
+    position encoded in the cursor, so deep pages cost the same as the first one.
+    Pages are cached like those of get_allocation_history.
+
+    Parameters:
+    - employee_id (str, optional): Filter by employee ID.
+    - vehicle_id (str, optional): Filter by vehicle ID.
+    - start_date (date, optional): Filter for allocations on or after this date.
+    - end_date (date, optional): Filter for allocations on or before this date.
+    - cursor (str, optional): The next_cursor returned by the previous page.
+    - limit (int, optional): Maximum number of records to return (default is 10).
+    - include_total (bool, optional): Include a cached count of matching allocations.
+
+    Returns:
+    - bytes: The JSON of a CursorPaginatedResponse with the history and next cursor.
+
+    Raises:
+    - HTTPException: If the cursor is malformed.
+    """
+    cache_key = await history_cache_key(
+        "cursor",
+        {
+            "employee_id": employee_id,
+            "vehicle_id": vehicle_id,
+            "start_date": start_date,
+            "end_date": end_date,
+            "cursor": cursor,
+            "limit": limit,
+            "include_total": include_total,
+        },
+    )
+    cached_page = await get_cached_history(cache_key)
+    if cached_page:
+        return cached_page
+
+    query = build_history_query(employee_id, vehicle_id, start_date, end_date)
+    page_query = query
+    if cursor:
+        try:
+            last_date, last_id = decode_cursor(cursor)
+        except ValueError:
+            raise HTTPException(status_code=400, detail="Invalid cursor")
+        date_field = allocation_schema.field("allocation_date")
+        last_date = allocation_schema.value("allocation_date", last_date)
+        page_query = {
+            "$and": [
+                query,
+                {
+                    "$or": [
+                        {date_field: {"$gt": last_date}},
+                        {date_field: last_date, "_id": {"$gt": last_id}},
+                    ]
+                },
+            ]
+        }
+
+    # Fetch one extra document to find out whether another page exists; each
+    # partition returns its first rows and the merge keeps the overall first
+    partitions = await history_partitions(start_date, end_date)
+    date_field = allocation_schema.field("allocation_date")
+    pages = await asyncio.gather(
+        *(
+            partition.find(page_query, allocation_schema.projection())
+            .sort([(date_field, 1), ("_id", 1)])
+            .limit(limit + 1)
+            .to_list(length=limit + 1)
+            for partition in partitions
+        )
+    )
+    history = []
+    for doc in heapq.merge(*pages, key=lambda doc: (doc[date_field], doc["_id"])):
+        # Skip the second copy of an allocation caught in the middle of a move
+        if not history or doc["_id"] != history[-1]["_id"]:
+            history.append(allocation_schema.from_document(doc))
+    has_more = len(history) > limit
+    history = history[:limit]
+    next_cursor = (
+        encode_cursor(history[-1]["allocation_date"], history[-1]["_id"])
+        if has_more
+        else None
+    )
+    total = await count_allocations(query, partitions) if include_total else None
+
+    page = encode_history_page(
+        history,
+        total=total,
+        limit=limit,
+        next_cursor=next_cursor,
+        has_more=has_more,
     )
+    await store_history(cache_key, page)
+    return page
+
+
+# Columns available to history exports, in output order
+EXPORT_FIELDS = ("id", "employee_id", "vehicle_id", "allocation_date")
+
+
+async def export_allocation_history(
+    employee_id: str = None,
+    vehicle_id: str = None,
+    start_date: date = None,
+    end_date: date = None,
+    fields: List[str] = None,
+    export_format: str = "ndjson",
+) -> AsyncIterator[str]:
+    """
+    Stream the allocation history matching the filters as NDJSON or CSV.
+
+    Documents are read through a Motor cursor with a projection and emitted one
+    batch at a time, so memory use does not depend on the size of the export.
+
+    Parameters:
+    - employee_id (str, optional): Filter by employee ID.
+    - vehicle_id (str, optional): Filter by vehicle ID.
+    - start_date (date, optional): Filter for allocations on or after this date.
+    - end_date (date, optional): Filter for allocations on or before this date.
+    - fields (List[str], optional): Columns to export; defaults to EXPORT_FIELDS.
+    - export_format (str, optional): "ndjson" (default) or "csv".
+
+    Yields:
+    - str: Chunks of the export, each holding up to EXPORT_BATCH_SIZE rows.
+    """
+    fields = [field for field in EXPORT_FIELDS if field in (fields or EXPORT_FIELDS)]
+    projection = {
+        allocation_schema.field(field): 1 for field in fields if field != "id"
+    }
+    projection["_id"] = "id" in fields
+
+    query = build_history_query(employee_id, vehicle_id, start_date, end_date)
+    partitions = await history_partitions(start_date, end_date)
+    date_field = allocation_schema.field("allocation_date")
+    if len(partitions) > 1:
+        # Partitions are read concurrently and merged on the sort key
+        projection.update({date_field: 1, "_id": 1})
+    cursors = [
+        partition.find(query, projection)
+        .sort([(date_field, 1), ("_id", 1)])
+        .batch_size(settings.EXPORT_BATCH_SIZE)
+        for partition in partitions
+    ]
+    if len(cursors) > 1:
+        cursors = [merge_sorted(cursors, key=lambda doc: (doc[date_field], doc["_id"]))]
+    documents = (
+        allocation_schema.from_document(document) async for document in cursors[0]
+    )
+    async for chunk in write_export(documents, fields, export_format):
+        yield chunk
+
+
+async def write_export(
+    documents: AsyncIterator[dict], fields: List[str], export_format: str
+) -> AsyncIterator[str]:
+    """
+    Format allocation documents as NDJSON or CSV, one chunk per batch of rows.
+
+    Parameters:
+    - documents (AsyncIterator[dict]): Allocation documents in export order.
+    - fields (List[str]): Columns to export, in output order.
+    - export_format (str): "ndjson" or "csv".
+
+    Yields:
+    - str: Chunks of the export, each holding up to EXPORT_BATCH_SIZE rows.
+    """
+    buffer = io.StringIO()
+    writer = None
+    if export_format == "csv":
+        writer = csv.DictWriter(buffer, fieldnames=fields, lineterminator="\n")
+        writer.writeheader()
+
+    rows = 0
+    async for document in documents:
+        row = {field: document.get(field) for field in fields if field != "id"}
+        if "id" in fields:
+            row["id"] = str(document["_id"])
+        if "allocation_date" in row:
+            row["allocation_date"] = as_date(row["allocation_date"]).isoformat()
+        if writer:
+            writer.writerow(row)
+        else:
+            buffer.write(json.dumps({field: row[field] for field in fields}) + "\n")
+
+        rows += 1
+        if rows % settings.EXPORT_BATCH_SIZE == 0:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+
+    if buffer.tell():
+        yield buffer.getvalue()
@@ -1,20 +1,285 @@
+import asyncio
+
 import aioredis
 import motor.motor_asyncio
+from pymongo import ASCENDING, IndexModel
+from pymongo.errors import OperationFailure
 
+from app.metrics import MongoCommandMetrics
+from app.profiling import ProfiledRedis, ProfilingCommandListener
 from app.utils import settings
 
 # MongoDB and Redis URLs are dynamically loaded from environment variables
 MONGO_URL = settings.MONGO_URL
 REDIS_URL = settings.REDIS_URL
 
-# Create an asynchronous MongoDB client
-client = motor.motor_asyncio.AsyncIOMotorClient(MONGO_URL)
+# The clients below are created by connect() from the application lifespan,
+# inside each worker process, and closed by disconnect(). Modules must read
+# them through this module (database.redis) rather than importing the names.
+
+# Asynchronous MongoDB client
+client = None
+
+# The database named in MONGO_URL
+database = None
+
+# The 'allocations' collection within the database
+allocations_collection = None
+
+# Weekly and monthly allocation counts maintained by app.rollups
+rollups_collection = None
+
+# Redis client with UTF-8 encoding and response decoding
+redis = None
+
+# Redis client returning raw bytes, for binary values such as bitmaps
+redis_binary = None
+
+
+async def connect():
+    """
+    Create the MongoDB and Redis clients and warm their connection pools.
+
+    Pool sizes and timeouts come from Settings. Both services are pinged, and
+    REDIS_WARM_CONNECTIONS Redis connections are opened up front, so the first
+    burst of requests reuses connections instead of opening them all at once.
+
+    Raises:
+    - Exception: If either service is unreachable.
+    """
+    global client, database, allocations_collection, rollups_collection
+    global redis, redis_binary
+
+    # Profiled requests record the time they wait on each service
+    listeners = [MongoCommandMetrics()]
+    redis_class = aioredis.Redis
+    if settings.PROFILE_DIR:
+        listeners.append(ProfilingCommandListener())
+        redis_class = ProfiledRedis
+
+    # Create an asynchronous MongoDB client, timing every command it sends
+    client = motor.motor_asyncio.AsyncIOMotorClient(
+        MONGO_URL,
+        maxPoolSize=settings.MONGO_MAX_POOL_SIZE,
+        minPoolSize=settings.MONGO_MIN_POOL_SIZE,
+        maxConnecting=settings.MONGO_MAX_CONNECTING,
+        connectTimeoutMS=settings.MONGO_CONNECT_TIMEOUT_MS,
+        serverSelectionTimeoutMS=settings.MONGO_SERVER_SELECTION_TIMEOUT_MS,
+        waitQueueTimeoutMS=settings.MONGO_WAIT_QUEUE_TIMEOUT_MS,
+        event_listeners=listeners,
+    )
+    database = client.get_default_database()
+    allocations_collection = database.get_collection("allocations")
+    rollups_collection = database.get_collection("utilization_rollups")
+
+    # Requests wait for a free connection instead of failing when the pool is full
+    pool_options = dict(
+        max_connections=settings.REDIS_MAX_CONNECTIONS,
+        timeout=settings.REDIS_POOL_TIMEOUT,
+        socket_timeout=settings.REDIS_SOCKET_TIMEOUT,
+        socket_connect_timeout=settings.REDIS_CONNECT_TIMEOUT,
+    )
+    redis = redis_class(
+        connection_pool=aioredis.BlockingConnectionPool.from_url(
+            REDIS_URL, encoding="utf-8", decode_responses=True, **pool_options
+        )
+    )
+    redis_binary = redis_class(
+        connection_pool=aioredis.BlockingConnectionPool.from_url(
+            REDIS_URL, **pool_options
+        )
+    )
+
+    await client.admin.command("ping")
+    # Concurrent pings each check out their own connection
+    await asyncio.gather(
+        *(redis.ping() for _ in range(settings.REDIS_WARM_CONNECTIONS)),
+        *(redis_binary.ping() for _ in range(settings.REDIS_WARM_CONNECTIONS)),
+    )
+
+
+async def disconnect():
+    """
+    Close the MongoDB and Redis clients created by connect().
+    """
+    global client, database, allocations_collection, rollups_collection
+    global redis, redis_binary
+    if client is not None:
+        client.close()
+    for redis_client in (redis, redis_binary):
+        if redis_client is not None:
+            await redis_client.close()
+            await redis_client.connection_pool.disconnect()
+    client = database = allocations_collection = rollups_collection = None
+    redis = redis_binary = None
+
+
+# Indexes backing conflict detection and the history filters, per schema.
+# History pages are sorted on (allocation_date, _id), so the history indexes
+# end with both and every page is read in index order, without a sort stage.
+LEGACY_ALLOCATION_INDEXES = [
+    # One allocation per vehicle per day; inserts that collide raise DuplicateKeyError
+    IndexModel(
+        [("vehicle_id", ASCENDING), ("allocation_date", ASCENDING)],
+        name="vehicle_date_unique",
+        unique=True,
+    ),
+    IndexModel(
+        [("vehicle_id", ASCENDING), ("allocation_date", ASCENDING), ("_id", ASCENDING)],
+        name="vehicle_date_id",
+    ),
+    IndexModel(
+        [
+            ("employee_id", ASCENDING),
+            ("allocation_date", ASCENDING),
+            ("_id", ASCENDING),
+        ],
+        name="employee_date_id",
+    ),
+    IndexModel(
+        [("allocation_date", ASCENDING), ("_id", ASCENDING)], name="allocation_date_id"
+    ),
+]
+
+COMPACT_ALLOCATION_INDEXES = [
+    IndexModel([("v", ASCENDING), ("d", ASCENDING)], name="v_d_unique", unique=True),
+    IndexModel([("v", ASCENDING), ("d", ASCENDING), ("_id", ASCENDING)], name="v_d_id"),
+    IndexModel([("e", ASCENDING), ("d", ASCENDING), ("_id", ASCENDING)], name="e_d_id"),
+    IndexModel([("d", ASCENDING), ("_id", ASCENDING)], name="d_id"),
+]
+
+# History indexes without the _id suffix, replaced by those above
+SUPERSEDED_INDEXES = ["employee_date", "allocation_date", "e_d", "d"]
+
+# While migrating, documents not converted yet lack the compact fields; a
+# sparse index skips them, and still rejects double bookings among the others
+DUAL_UNIQUE_INDEX = "v_d_unique_sparse"
+DUAL_ALLOCATION_INDEXES = LEGACY_ALLOCATION_INDEXES + [
+    IndexModel(
+        [("v", ASCENDING), ("d", ASCENDING)],
+        name=DUAL_UNIQUE_INDEX,
+        unique=True,
+        sparse=True,
+    ),
+]
+
+ALLOCATION_INDEXES = {
+    "legacy": LEGACY_ALLOCATION_INDEXES,
+    "dual": DUAL_ALLOCATION_INDEXES,
+    "compact": COMPACT_ALLOCATION_INDEXES,
+}
+
+# Duplicate key error code, raised when a unique index cannot be built
+DUPLICATE_KEY = 11000
+
+# Groups of duplicates listed when a unique index cannot be built
+DUPLICATES_REPORTED = 10
+
+# One document per entity and week or month bucket
+ROLLUP_INDEXES = [
+    IndexModel(
+        [
+            ("dimension", ASCENDING),
+            ("granularity", ASCENDING),
+            ("entity_id", ASCENDING),
+            ("period", ASCENDING),
+        ],
+        name="rollup_bucket_unique",
+        unique=True,
+    ),
+]
+
+
+async def ensure_indexes():
+    """
+    Create the indexes required by the allocations and rollups collections.
+
+    Index creation is idempotent, so this is safe to run on every startup.
+    History indexes created before the _id suffix was added are replaced.
+    Allocation indexes follow ALLOCATION_SCHEMA; those of a previous schema are
+    dropped by `python -m app.migrate_schema contract`.
+    """
+    await ensure_allocation_indexes(allocations_collection)
+    await rollups_collection.create_indexes(ROLLUP_INDEXES)
+
+
+async def ensure_allocation_indexes(collection) -> None:
+    """
+    Create the indexes of ALLOCATION_SCHEMA on an allocations collection.
+
+    In compact mode the legacy unique index is dropped as well: documents
+    written with only the compact fields would all index as (null, null) in it
+    and collide, while v_d_unique rejects double bookings in its place. The
+    sparse (v, d) index of dual mode is dropped before v_d_unique is built,
+    since MongoDB refuses a second index on the same keys with other options.
+
+    A unique index cannot be built while the collection holds double bookings,
+    e.g. ones written before the index existed. They are then reported with
+    their document IDs, to be removed before starting again.
+
+    Parameters:
+    - collection: The hot collection or an archive collection.
+
+    Raises:
+    - RuntimeError: If a unique index is blocked by duplicate bookings.
+    """
+    indexes = ALLOCATION_INDEXES[settings.ALLOCATION_SCHEMA]
+    if settings.ALLOCATION_SCHEMA == "compact":
+        await drop_index(collection, DUAL_UNIQUE_INDEX)
+    try:
+        await collection.create_indexes(indexes)
+    except OperationFailure as error:
+        if error.code != DUPLICATE_KEY:
+            raise
+        duplicates = []
+        for index in indexes:
+            if index.document.get("unique"):
+                duplicates += await find_duplicates(collection, index)
+        raise RuntimeError(
+            f"Cannot create the unique allocation indexes on {collection.name}: "
+            f"remove the duplicate bookings first ({'; '.join(duplicates)})"
+        ) from error
+    for name in SUPERSEDED_INDEXES:
+        await drop_index(collection, name)
+    if settings.ALLOCATION_SCHEMA == "compact":
+        await drop_index(collection, "vehicle_date_unique")
+
+
+async def find_duplicates(collection, index: IndexModel) -> list:
+    """
+    Find documents sharing the keys of a unique index.
+
+    Parameters:
+    - collection: The collection to search.
+    - index (IndexModel): The unique index.
 
-# Access the 'vehicle_allocation' database from MongoDB
-database = client.get_default_database()
+    Returns:
+    - list: Up to DUPLICATES_REPORTED descriptions, "key=value, ...: [ids]".
+    """
+    fields = list(index.document["key"])
+    pipeline = [
+        {"$match": {field: {"$exists": True} for field in fields}},
+        {
+            "$group": {
+                "_id": {field: f"${field}" for field in fields},
+                "ids": {"$push": "$_id"},
+                "count": {"$sum": 1},
+            }
+        },
+        {"$match": {"count": {"$gt": 1}}},
+        {"$limit": DUPLICATES_REPORTED},
+    ]
+    groups = await collection.aggregate(pipeline).to_list(length=None)
+    return [
+        ", ".join(f"{field}={group['_id'][field]}" for field in fields)
+        + f": {[str(_id) for _id in group['ids']]}"
+        for group in groups
+    ]
 
-# Access the 'allocations' collection within the database
-allocations_collection = database.get_collection("allocations")
 
-# Create an asynchronous Redis client with UTF-8 encoding and response decoding
-redis = aioredis.from_url(REDIS_URL, encoding="utf-8", decode_responses=True)
+async def drop_index(collection, name: str) -> None:
+    """
+    Drop an index by name, if it exists.
+    """
+    if name in await collection.index_information():
+        await collection.drop_index(name)
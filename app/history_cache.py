@@ -0,0 +1,103 @@
+import json
+from typing import Iterable, Optional
+
+from . import database
+from .keys import (
+    HISTORY_GLOBAL_GENERATION_KEY,
+    as_date,
+    employee_generation_key,
+    history_generation_keys,
+    history_result_key,
+    vehicle_generation_key,
+)
+from .utils import settings
+
+# History pages are cached under a key that embeds the current generation of
+# every employee/vehicle counter the query depends on. Writes bump those
+# counters, which orphans stale pages instead of searching for them; orphaned
+# pages simply expire.
+#
+# Pages are handled as JSON bytes from the database to the client: they are
+# encoded once, cached as is and returned without another validation pass.
+
+
+def encode_history_page(allocations: Iterable[dict], **fields) -> bytes:
+    """
+    Encode a history page exactly as its response model would serialize it.
+
+    Parameters:
+    - allocations (Iterable[dict]): Allocations in the API shape.
+    - fields: The other fields of the page (total, skip, ...), in model order.
+
+    Returns:
+    - bytes: The JSON of PaginatedResponse or CursorPaginatedResponse.
+    """
+    data = [
+        {
+            "employee_id": allocation["employee_id"],
+            "vehicle_id": allocation["vehicle_id"],
+            "allocation_date": as_date(allocation["allocation_date"]).isoformat(),
+            "_id": str(allocation["_id"]),
+        }
+        for allocation in allocations
+    ]
+    return json.dumps(
+        {"data": data, **fields}, ensure_ascii=False, separators=(",", ":")
+    ).encode()
+
+
+async def history_cache_key(kind: str, params: dict) -> Optional[str]:
+    """
+    Resolve the cache key of a history page for the current generations.
+
+    Parameters:
+    - kind (str): The pagination mode, e.g. "offset" or "cursor".
+    - params (dict): The query parameters; employee_id and vehicle_id select
+      the generation counters.
+
+    Returns:
+    - str: The cache key, or None if the history cache is disabled.
+    """
+    if settings.HISTORY_CACHE_TTL <= 0:
+        return None
+    generation_keys = history_generation_keys(
+        params.get("employee_id"), params.get("vehicle_id")
+    )
+    generations = await database.redis.mget(generation_keys)
+    return history_result_key(kind, params, [int(g or 0) for g in generations])
+
+
+async def get_cached_history(cache_key: Optional[str]) -> Optional[bytes]:
+    """
+    Return the JSON of a cached history page, or None on a miss.
+    """
+    if cache_key is None:
+        return None
+    return await database.redis_binary.get(cache_key)
+
+
+async def store_history(cache_key: Optional[str], page: bytes) -> None:
+    """
+    Cache the JSON of a history page under a key from history_cache_key.
+    """
+    if cache_key is None:
+        return
+    await database.redis_binary.set(cache_key, page, ex=settings.HISTORY_CACHE_TTL)
+
+
+def queue_generation_bump(
+    pipe, employee_ids: Iterable[str], vehicle_ids: Iterable[str]
+) -> None:
+    """
+    Queue the generation bumps for a write on an existing Redis pipeline.
+
+    Parameters:
+    - pipe: A Redis pipeline; the caller executes it.
+    - employee_ids (Iterable[str]): Employees whose history changed; None is ignored.
+    - vehicle_ids (Iterable[str]): Vehicles whose history changed.
+    """
+    pipe.incr(HISTORY_GLOBAL_GENERATION_KEY)
+    for employee_id in set(filter(None, employee_ids)):
+        pipe.incr(employee_generation_key(employee_id))
+    for vehicle_id in set(filter(None, vehicle_ids)):
+        pipe.incr(vehicle_generation_key(vehicle_id))
@@ -0,0 +1,287 @@
+import asyncio
+import base64
+import hashlib
+import json
+import logging
+import math
+import time
+import uuid
+from contextlib import suppress
+from typing import Optional
+
+from fastapi.responses import JSONResponse
+
+from . import database
+from .keys import idempotency_key
+from .metrics import IDEMPOTENT_REPLAYS
+from .utils import settings
+
+logger = logging.getLogger(__name__)
+
+# Requests carrying this header are executed at most once per key; retries get
+# the stored response of the first attempt, byte for byte.
+IDEMPOTENCY_HEADER = b"idempotency-key"
+IDEMPOTENT_METHODS = ("POST", "PATCH", "DELETE")
+# Covers /allocate/, /allocate/bulk, /allocate/range and /allocation/{id}/
+IDEMPOTENT_PATH_PREFIXES = ("/allocate", "/allocation/")
+MAX_KEY_LENGTH = 255
+# Seconds between checks for the result of a concurrent duplicate
+POLL_INTERVAL = 0.01
+
+# Extends a pending reservation by ARGV[2] milliseconds if KEYS[1] still holds
+# it (ARGV[1]), and not the response or another request's reservation
+_EXTEND_SCRIPT = """
+if redis.call("GET", KEYS[1]) == ARGV[1] then
+    return redis.call("PEXPIRE", KEYS[1], ARGV[2])
+end
+return 0
+"""
+
+
+class RedisIdempotencyStore:
+    """
+    Idempotency records in Redis, shared by every worker.
+
+    A key is first reserved with a "pending" record that expires after
+    IDEMPOTENCY_LOCK_TTL unless extended, so a crashed worker cannot block its
+    key forever, and is then overwritten with the response for IDEMPOTENCY_TTL
+    seconds.
+    """
+
+    async def reserve(self, key: str, record: dict) -> bool:
+        return bool(
+            await database.redis.set(
+                key,
+                json.dumps(record),
+                nx=True,
+                px=math.ceil(settings.IDEMPOTENCY_LOCK_TTL * 1000),
+            )
+        )
+
+    async def extend(self, key: str, record: dict) -> None:
+        await database.redis.eval(
+            _EXTEND_SCRIPT,
+            1,
+            key,
+            json.dumps(record),
+            math.ceil(settings.IDEMPOTENCY_LOCK_TTL * 1000),
+        )
+
+    async def get(self, key: str) -> Optional[dict]:
+        data = await database.redis.get(key)
+        return json.loads(data) if data is not None else None
+
+    async def complete(self, key: str, record: dict) -> None:
+        await database.redis.set(key, json.dumps(record), ex=settings.IDEMPOTENCY_TTL)
+
+    async def release(self, key: str) -> None:
+        await database.redis.delete(key)
+
+
+class MemoryIdempotencyStore:
+    """
+    Idempotency records in process memory, for the in-memory storage backend.
+    """
+
+    def __init__(self):
+        self._records = {}  # key -> (expires at, record)
+
+    async def reserve(self, key: str, record: dict) -> bool:
+        if await self.get(key) is not None:
+            return False
+        self._records[key] = (time.monotonic() + settings.IDEMPOTENCY_LOCK_TTL, record)
+        return True
+
+    async def extend(self, key: str, record: dict) -> None:
+        if await self.get(key) == record:
+            self._records[key] = (
+                time.monotonic() + settings.IDEMPOTENCY_LOCK_TTL,
+                record,
+            )
+
+    async def get(self, key: str) -> Optional[dict]:
+        entry = self._records.get(key)
+        if entry is None or entry[0] < time.monotonic():
+            self._records.pop(key, None)
+            return None
+        return entry[1]
+
+    async def complete(self, key: str, record: dict) -> None:
+        self._records[key] = (time.monotonic() + settings.IDEMPOTENCY_TTL, record)
+
+    async def release(self, key: str) -> None:
+        self._records.pop(key, None)
+
+
+idempotency_store = (
+    MemoryIdempotencyStore()
+    if settings.STORAGE_BACKEND == "memory"
+    else RedisIdempotencyStore()
+)
+
+
+class IdempotencyMiddleware:
+    """
+    ASGI middleware replaying the first response of requests with an Idempotency-Key.
+
+    Only write requests to the allocation endpoints are covered. Responses with
+    a status below 500 are stored; server errors release the key so the client
+    can retry. The reservation of a key is extended while its request runs,
+    however long it takes. A duplicate arriving meanwhile waits for the
+    response instead of running again, and gets a 409 if none comes within
+    IDEMPOTENCY_LOCK_TTL. Reusing a key for a different request (method, path
+    or body) is rejected with 422.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if (
+            scope["type"] != "http"
+            or scope["method"] not in IDEMPOTENT_METHODS
+            or not scope["path"].startswith(IDEMPOTENT_PATH_PREFIXES)
+        ):
+            await self.app(scope, receive, send)
+            return
+        header = dict(scope["headers"]).get(IDEMPOTENCY_HEADER)
+        if header is None:
+            await self.app(scope, receive, send)
+            return
+        if not header or len(header) > MAX_KEY_LENGTH:
+            response = JSONResponse(
+                {"detail": f"Idempotency-Key must be 1-{MAX_KEY_LENGTH} characters"},
+                status_code=400,
+            )
+            await response(scope, receive, send)
+            return
+
+        body = await read_body(receive)
+        fingerprint = hashlib.sha256(
+            b"\n".join([scope["method"].encode(), scope["path"].encode(), body])
+        ).hexdigest()
+        key = idempotency_key(header.decode("latin-1"))
+
+        # The token tells this request's reservation apart from a later one
+        reservation = {"fingerprint": fingerprint, "token": uuid.uuid4().hex}
+        deadline = time.monotonic() + settings.IDEMPOTENCY_LOCK_TTL
+        while True:
+            if await idempotency_store.reserve(key, reservation):
+                await self._run_and_store(scope, body, receive, send, key, reservation)
+                return
+            record = await idempotency_store.get(key)
+            if record is None:
+                # Released or expired in between; try to reserve it again
+                continue
+            if record["fingerprint"] != fingerprint:
+                response = JSONResponse(
+                    {"detail": "Idempotency-Key was already used for another request"},
+                    status_code=422,
+                )
+                await response(scope, receive, send)
+                return
+            if "status" in record:
+                IDEMPOTENT_REPLAYS.inc()
+                await replay(record, send)
+                return
+            if time.monotonic() >= deadline:
+                response = JSONResponse(
+                    {"detail": "A request with this Idempotency-Key is in progress"},
+                    status_code=409,
+                    headers={"Retry-After": "1"},
+                )
+                await response(scope, receive, send)
+                return
+            await asyncio.sleep(POLL_INTERVAL)
+
+    async def _run_and_store(self, scope, body, receive, send, key, reservation):
+        """
+        Run the request, then store its response under the reserved key.
+        """
+        fingerprint = reservation["fingerprint"]
+        consumed = False
+
+        async def receive_body():
+            nonlocal consumed
+            if not consumed:
+                consumed = True
+                return {"type": "http.request", "body": body, "more_body": False}
+            return await receive()
+
+        response = {"fingerprint": fingerprint, "headers": [], "body": []}
+
+        async def capture(message):
+            if message["type"] == "http.response.start":
+                response["status"] = message["status"]
+                response["headers"] = [
+                    [name.decode("latin-1"), value.decode("latin-1")]
+                    for name, value in message.get("headers", [])
+                ]
+            elif message["type"] == "http.response.body":
+                response["body"].append(message.get("body", b""))
+            await send(message)
+
+        heartbeat = asyncio.create_task(keep_reserved(key, reservation))
+        try:
+            await self.app(scope, receive_body, capture)
+        except BaseException:
+            await stop(heartbeat)
+            await idempotency_store.release(key)
+            raise
+        await stop(heartbeat)
+        if response.get("status", 500) >= 500:
+            await idempotency_store.release(key)
+            return
+        response["body"] = base64.b64encode(b"".join(response["body"])).decode()
+        await idempotency_store.complete(key, response)
+
+
+async def keep_reserved(key: str, reservation: dict) -> None:
+    """
+    Extend a reservation every third of IDEMPOTENCY_LOCK_TTL until cancelled,
+    so it cannot expire while its request is still running.
+    """
+    while True:
+        await asyncio.sleep(settings.IDEMPOTENCY_LOCK_TTL / 3)
+        try:
+            await idempotency_store.extend(key, reservation)
+        except Exception:
+            logger.warning("Could not extend idempotency reservation", exc_info=True)
+
+
+async def stop(task: asyncio.Task) -> None:
+    """
+    Cancel a task and wait for it to finish.
+    """
+    task.cancel()
+    with suppress(asyncio.CancelledError):
+        await task
+
+
+async def read_body(receive) -> bytes:
+    """
+    Read the whole request body from an ASGI receive channel.
+    """
+    chunks = []
+    while True:
+        message = await receive()
+        chunks.append(message.get("body", b""))
+        if not message.get("more_body", False):
+            return b"".join(chunks)
+
+
+async def replay(record: dict, send) -> None:
+    """
+    Send a stored response exactly as it was first sent.
+    """
+    await send(
+        {
+            "type": "http.response.start",
+            "status": record["status"],
+            "headers": [
+                (name.encode("latin-1"), value.encode("latin-1"))
+                for name, value in record["headers"]
+            ],
+        }
+    )
+    await send({"type": "http.response.body", "body": base64.b64decode(record["body"])})
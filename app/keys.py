@@ -0,0 +1,154 @@
+import hashlib
+import json
+from datetime import date, datetime
+from typing import Union
+
+from .utils import CustomJSONEncoder
+
+# Every Redis key used by the application is built here, so reads and
+# invalidations can never disagree on the format.
+
+# Bitmap with one bit per day, set when the vehicle is booked
+AVAILABILITY_KEY = "availability:vehicle:{vehicle_id}"
+# Set of every vehicle that has ever been allocated, i.e. the known fleet
+FLEET_KEY = "availability:vehicles"
+# Pub/sub channel used to broadcast invalidated keys to every worker
+INVALIDATION_CHANNEL = "cache:invalidate"
+# Cache of the months ("YYYY_MM") that have an archive collection in MongoDB
+ARCHIVE_MONTHS_KEY = "archive:months"
+# Held by the worker running the scheduled archiver, for one interval
+ARCHIVE_LOCK_KEY = "archive:lock"
+# Held by the worker that last warmed the lookup cache, for one interval
+WARMUP_LOCK_KEY = "warmup:lock"
+# Generation counter bumped by every write; versions unfiltered history queries
+HISTORY_GLOBAL_GENERATION_KEY = "history:gen:all"
+
+
+def as_date(value: Union[date, datetime]) -> date:
+    """
+    Normalize a date or a midnight datetime (as stored in MongoDB) to a date.
+    """
+    return value.date() if isinstance(value, datetime) else value
+
+
+def vehicle_date_key(vehicle_id: str, allocation_date: Union[date, datetime]) -> str:
+    """
+    Build the cache key of the allocation for a vehicle on a date.
+
+    Parameters:
+    - vehicle_id (str): The ID of the vehicle.
+    - allocation_date (date | datetime): The allocation date.
+
+    Returns:
+    - str: A key such as "vehicle:ABC:date:2024-10-26".
+    """
+    return f"vehicle:{vehicle_id}:date:{as_date(allocation_date).isoformat()}"
+
+
+def stale_key(cache_key: str) -> str:
+    """
+    Build the key of the stale copy kept for a vehicle/date cache entry.
+    """
+    return f"stale:{cache_key}"
+
+
+def invalidation_mark_key(cache_key: str) -> str:
+    """
+    Build the key holding the Redis time a vehicle/date entry was last invalidated.
+    """
+    return f"invalidated:{cache_key}"
+
+
+def lookup_lock_key(cache_key: str) -> str:
+    """
+    Build the key of the lock held by the worker reloading a cache entry.
+    """
+    return f"lock:{cache_key}"
+
+
+def idempotency_key(header: str) -> str:
+    """
+    Build the key of the stored response for an Idempotency-Key header value.
+    """
+    return f"idempotency:{hashlib.sha1(header.encode()).hexdigest()}"
+
+
+def rate_limit_key(client_id: str) -> str:
+    """
+    Build the key of a client's rate limiting token bucket.
+    """
+    return f"ratelimit:{client_id}"
+
+
+def availability_key(vehicle_id: str) -> str:
+    """
+    Build the key of a vehicle's availability bitmap.
+    """
+    return AVAILABILITY_KEY.format(vehicle_id=vehicle_id)
+
+
+def history_count_key(query: dict) -> str:
+    """
+    Build the key of a cached history count from its MongoDB query.
+    """
+    digest = hashlib.sha1(
+        json.dumps(query, cls=CustomJSONEncoder, sort_keys=True).encode()
+    ).hexdigest()
+    return f"history:count:{digest}"
+
+
+def employee_generation_key(employee_id: str) -> str:
+    """
+    Build the key of the history generation counter of an employee.
+    """
+    return f"history:gen:employee:{employee_id}"
+
+
+def vehicle_generation_key(vehicle_id: str) -> str:
+    """
+    Build the key of the history generation counter of a vehicle.
+    """
+    return f"history:gen:vehicle:{vehicle_id}"
+
+
+def history_generation_keys(employee_id: str = None, vehicle_id: str = None) -> list:
+    """
+    Build the generation counter keys a cached history query depends on.
+
+    Queries filtered by employee and/or vehicle depend on those entities'
+    counters; any other query depends on the global counter, which every
+    write bumps.
+
+    Parameters:
+    - employee_id (str, optional): The employee filter of the query.
+    - vehicle_id (str, optional): The vehicle filter of the query.
+
+    Returns:
+    - list: The generation counter keys.
+    """
+    keys = []
+    if employee_id:
+        keys.append(employee_generation_key(employee_id))
+    if vehicle_id:
+        keys.append(vehicle_generation_key(vehicle_id))
+    return keys or [HISTORY_GLOBAL_GENERATION_KEY]
+
+
+def history_result_key(kind: str, params: dict, generations: list) -> str:
+    """
+    Build the key of a cached history page.
+
+    Parameters:
+    - kind (str): The pagination mode, e.g. "offset" or "cursor".
+    - params (dict): The query parameters of the request.
+    - generations (list): Current values of the query's generation counters.
+
+    Returns:
+    - str: A key that changes whenever any relevant generation is bumped.
+    """
+    digest = hashlib.sha1(
+        json.dumps(
+            [kind, params, generations], cls=CustomJSONEncoder, sort_keys=True
+        ).encode()
+    ).hexdigest()
+    return f"history:result:{digest}"
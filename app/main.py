@@ -1,21 +1,61 @@
+from contextlib import asynccontextmanager
 from datetime import date
-from fastapi import FastAPI, Query
+from typing import List, Literal, Union
+from fastapi import Body, FastAPI, HTTPException, Query
+from fastapi.responses import Response, StreamingResponse
 
 from .models import (
+    AllocationLookup,
+    AllocationLookupResponse,
     AllocationModel,
+    AllocationResponseModel,
     AllocationUpdateModel,
+    AvailabilityResponse,
+    BulkAllocationResponse,
     PaginatedResponse,
+    CursorPaginatedResponse,
     CreateResponseModel,
+    RangeAllocationModel,
+    RangeAllocationResponse,
+    UtilizationResponse,
 )
-from .crud import (
-    create_allocation,
-    update_allocation,
-    delete_allocation,
-    get_allocation_history,
-)
+from .crud import EXPORT_FIELDS
+from .cache import local_cache
+from . import storage
+from .admission import AdmissionMiddleware
+from .idempotency import IdempotencyMiddleware
+from .metrics import METRICS_CONTENT_TYPE, MetricsMiddleware, render_metrics
+from .profiling import ProfilingMiddleware, router as profiling_router
+from .utils import settings
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """
+    Application lifespan handler.
+
+    Starts the storage backend selected by STORAGE_BACKEND before the
+    application starts serving requests; for MongoDB this connects to MongoDB
+    and Redis, bootstraps the indexes and subscribes this worker's local cache
+    to invalidations. On shutdown the backend is stopped.
+    """
+    await storage.backend.start()
+    yield
+    await storage.backend.stop()
+
 
 # Create an instance of the FastAPI application
-app = FastAPI()
+app = FastAPI(lifespan=lifespan)
+# Middleware added last runs first: shed and replayed responses are measured
+# too, and shed requests never reach the idempotency store
+app.add_middleware(IdempotencyMiddleware)
+app.add_middleware(AdmissionMiddleware, router=app.router)
+# Profiling is installed only when enabled, so it costs nothing otherwise; the
+# request latency metric includes its overhead
+if settings.PROFILE_DIR:
+    app.add_middleware(ProfilingMiddleware)
+    app.include_router(profiling_router)
+app.add_middleware(MetricsMiddleware)
 
 
 @app.post("/allocate/", status_code=201, response_model=CreateResponseModel)
@@ -29,11 +69,62 @@ async def allocate_vehicle(allocation: AllocationModel):
     Returns:
     - CreateResponseModel: The response model containing the ID of the newly created allocation.
     """
-    allocation = await create_allocation(allocation)
+    allocation = await storage.backend.create_allocation(allocation)
     return allocation
 
 
-@app.patch("/allocation/{allocation_id}/", response_model=AllocationUpdateModel)
+@app.post("/allocate/bulk", response_model=BulkAllocationResponse)
+async def allocate_vehicles_bulk(
+    allocations: List[AllocationModel] = Body(
+        ..., min_length=1, max_length=settings.BULK_ALLOCATION_MAX
+    ),
+):
+    """
+    Allocate many vehicles in a single request.
+
+    Parameters:
+    - allocations (List[AllocationModel]): The allocations to create.
+
+    Returns:
+    - BulkAllocationResponse: Per-item success or conflict results.
+    """
+    return await storage.backend.create_allocations_bulk(allocations)
+
+
+@app.post("/allocate/range", status_code=201, response_model=RangeAllocationResponse)
+async def allocate_vehicle_range(allocation: RangeAllocationModel):
+    """
+    Allocate a vehicle to an employee on every day of a date range, or on none.
+
+    Parameters:
+    - allocation (RangeAllocationModel): The employee, vehicle and inclusive date range.
+
+    Returns:
+    - RangeAllocationResponse: The IDs of the created allocations, one per day.
+    """
+    return await storage.backend.create_range_allocation(allocation)
+
+
+@app.post("/allocations/lookup", response_model=AllocationLookupResponse)
+async def lookup_allocations(
+    lookups: List[AllocationLookup] = Body(
+        ..., min_length=1, max_length=settings.LOOKUP_BATCH_MAX
+    ),
+):
+    """
+    Look up the allocations of many vehicle/date pairs in a single request.
+
+    Parameters:
+    - lookups (List[AllocationLookup]): The vehicle/date pairs to check.
+
+    Returns:
+    - AllocationLookupResponse: The allocation of each pair, or null if the
+      vehicle is free, in request order.
+    """
+    return await storage.backend.get_allocations_by_vehicle_dates(lookups)
+
+
+@app.patch("/allocation/{allocation_id}/", response_model=AllocationResponseModel)
 async def modify_allocation(allocation_id: str, update_data: AllocationUpdateModel):
     """
     Modify an existing vehicle allocation.
@@ -43,10 +134,9 @@ async def modify_allocation(allocation_id: str, update_data: AllocationUpdateMod
     - update_data (AllocationUpdateModel): The updated allocation details.
 
     Returns:
-    - AllocationUpdateModel: The updated allocation details.
+    - AllocationResponseModel: The allocation as stored after the update.
     """
-    await update_allocation(allocation_id, update_data)
-    return update_data
+    return await storage.backend.update_allocation(allocation_id, update_data)
 
 
 @app.delete("/allocation/{allocation_id}/", status_code=204)
@@ -60,11 +150,45 @@ async def remove_allocation(allocation_id: str):
     Returns:
     - None: A successful deletion returns no content.
     """
-    await delete_allocation(allocation_id)
+    await storage.backend.delete_allocation(allocation_id)
+
+
+@app.get("/history/export")
+async def export_history(
+    employee_id: str = Query(None),
+    vehicle_id: str = Query(None),
+    start_date: date = Query(None),
+    end_date: date = Query(None),
+    export_format: Literal["ndjson", "csv"] = Query("ndjson", alias="format"),
+    fields: List[Literal[EXPORT_FIELDS]] = Query(None),  # defaults to all fields
+):
+    """
+    Stream the allocation history as NDJSON or CSV.
+
+    Parameters:
+    - employee_id (str, optional): Filter by employee ID.
+    - vehicle_id (str, optional): Filter by vehicle ID.
+    - start_date (date, optional): Filter for allocations on or after this date.
+    - end_date (date, optional): Filter for allocations on or before this date.
+    - format (str, optional): "ndjson" (default) or "csv".
+    - fields (List[str], optional): Columns to include, in any order.
+
+    Returns:
+    - StreamingResponse: The export, ordered by allocation date.
+    """
+    media_type = "text/csv" if export_format == "csv" else "application/x-ndjson"
+    filename = f"allocations.{export_format}"
+    return StreamingResponse(
+        storage.backend.export_allocation_history(
+            employee_id, vehicle_id, start_date, end_date, fields, export_format
+        ),
+        media_type=media_type,
+        headers={"Content-Disposition": f"attachment; filename={filename}"},
+    )
 
 
 # Get allocation history with filters
-@app.get("/history/", response_model=PaginatedResponse)
+@app.get("/history/", response_model=Union[PaginatedResponse, CursorPaginatedResponse])
 async def fetch_allocation_history(
     employee_id: str = Query(None),
     vehicle_id: str = Query(None),
@@ -72,6 +196,9 @@ async def fetch_allocation_history(
     end_date: date = Query(None),
     skip: int = Query(0, ge=0),  # starting point for pagination
     limit: int = Query(10, ge=1),  # number of items per page
+    pagination: Literal["offset", "cursor"] = Query("offset"),
+    cursor: str = Query(None),  # next_cursor from the previous page
+    include_total: bool = Query(False),  # cursor mode only
 ):
     """
     Fetch the allocation history with optional filters.
@@ -83,11 +210,97 @@ async def fetch_allocation_history(
     - end_date (date, optional): Filter for allocations on or before this date.
     - skip (int, optional): Number of records to skip for pagination (default is 0).
     - limit (int, optional): Maximum number of records to return (default is 10).
+    - pagination (str, optional): "offset" (default) or "cursor" for keyset pagination.
+    - cursor (str, optional): Cursor returned by the previous page; implies cursor mode.
+    - include_total (bool, optional): Include a cached total count in cursor mode.
 
     Returns:
     - PaginatedResponse: Contains the allocation history and pagination info.
+    - CursorPaginatedResponse: Returned instead in cursor mode.
+
+    The page arrives already encoded as JSON and is returned as is; the
+    response models only document it.
+    """
+    if pagination == "cursor" or cursor:
+        page = await storage.backend.get_allocation_history_page(
+            employee_id, vehicle_id, start_date, end_date, cursor, limit, include_total
+        )
+    else:
+        page = await storage.backend.get_allocation_history(
+            employee_id, vehicle_id, start_date, end_date, skip, limit
+        )
+    return Response(page, media_type="application/json")
+
+
+@app.get("/availability/", response_model=AvailabilityResponse)
+async def fetch_availability(
+    day: date = Query(None, alias="date"),  # shorthand for a one-day range
+    start_date: date = Query(None),
+    end_date: date = Query(None),
+    vehicle_id: List[str] = Query(None),
+):
+    """
+    Fetch free vehicles for a date, or per-vehicle calendars over a date range.
+
+    Parameters:
+    - date (date, optional): The day to check.
+    - start_date (date, optional): First day of the range to check.
+    - end_date (date, optional): Last day of the range to check (inclusive).
+    - vehicle_id (List[str], optional): Vehicles to check; defaults to the whole fleet.
+
+    Returns:
+    - AvailabilityResponse: Free vehicles and, for ranges, per-vehicle calendars.
     """
-    history = await get_allocation_history(
-        employee_id, vehicle_id, start_date, end_date, skip, limit
+    start_date = start_date or day
+    if start_date is None:
+        raise HTTPException(status_code=422, detail="date or start_date is required")
+    return await storage.backend.get_availability(start_date, end_date, vehicle_id)
+
+
+@app.get("/stats/utilization", response_model=UtilizationResponse)
+async def fetch_utilization(
+    start_date: date = Query(...),
+    end_date: date = Query(...),
+    group_by: Literal["vehicle", "employee"] = Query("vehicle"),
+    bucket: Literal["week", "month"] = Query("week"),
+    entity_id: List[str] = Query(None),
+):
+    """
+    Fetch allocation counts and utilization per vehicle or employee by week or month.
+
+    Parameters:
+    - start_date (date): First day of the range; widened to the start of its bucket.
+    - end_date (date): Last day of the range; widened to the end of its bucket.
+    - group_by (str, optional): "vehicle" (default) or "employee".
+    - bucket (str, optional): "week" (default, starting on Monday) or "month".
+    - entity_id (List[str], optional): Vehicles or employees to report; defaults
+      to all with allocations in the range.
+
+    Returns:
+    - UtilizationResponse: One series of buckets per vehicle or employee.
+    """
+    return await storage.backend.get_utilization(
+        group_by, bucket, start_date, end_date, entity_id
     )
-    return history
+
+
+@app.get("/cache/stats/")
+async def fetch_cache_stats():
+    """
+    Fetch the in-process cache counters of the worker serving the request.
+
+    Returns:
+    - dict: Size, hits, misses, evictions and invalidations of the local cache.
+    """
+    return local_cache.stats()
+
+
+@app.get("/metrics", include_in_schema=False)
+async def fetch_metrics():
+    """
+    Expose request, MongoDB and cache metrics in the Prometheus text format.
+
+    Returns:
+    - Response: The metrics of every worker process when multiprocess mode is enabled.
+    """
+    return Response(render_metrics(), media_type=METRICS_CONTENT_TYPE)
@@ -0,0 +1,418 @@
+from collections import Counter, defaultdict
+from datetime import date, datetime, timedelta, timezone
+from typing import AsyncIterator, Iterator, List, Optional
+
+from bson import ObjectId
+from fastapi import HTTPException
+from sortedcontainers import SortedList
+
+from .availability import date_range
+from .crud import (
+    EXPORT_FIELDS,
+    build_availability_response,
+    check_allocation_range,
+    check_availability_range,
+    range_conflict,
+    write_export,
+)
+from .models import (
+    AllocationLookup,
+    AllocationLookupResponse,
+    AllocationLookupResult,
+    AllocationModel,
+    AllocationUpdateModel,
+    AvailabilityResponse,
+    BulkAllocationResponse,
+    BulkAllocationResult,
+    CreateResponseModel,
+    RangeAllocationModel,
+    RangeAllocationResponse,
+    UtilizationResponse,
+)
+from .history_cache import encode_history_page
+from .rollups import (
+    build_utilization_response,
+    check_utilization_range,
+    rollup_keys,
+)
+from .storage import StorageBackend
+from .utils import decode_cursor, encode_cursor
+
+
+def _midnight(day: date) -> datetime:
+    return datetime.combine(day, datetime.min.time())
+
+
+class MemoryBackend(StorageBackend):
+    """
+    In-process storage engine for single-node deployments and tests.
+
+    Allocations live in a dict keyed by ID, with a hash index on
+    (vehicle_id, allocation_date) for lookups and conflict checks, and sorted
+    (allocation_date, _id) indexes per employee, per vehicle and overall for
+    history, exports and availability. Weekly and monthly utilization counts
+    are kept up to date alongside the indexes. Every operation runs without awaiting,
+    so it is atomic on the event loop.
+
+    Data is not persisted and is not shared between processes: run a single
+    worker and expect an empty store after a restart.
+    """
+
+    def __init__(self):
+        self._allocations = {}  # _id -> document
+        self._vehicle_date = {}  # (vehicle_id, allocation_date) -> _id
+        self._by_employee = defaultdict(SortedList)
+        self._by_vehicle = defaultdict(SortedList)  # every vehicle ever booked
+        self._by_date = SortedList()
+        self._rollups = Counter()  # rollup key -> allocation count
+
+    def _index(self, document: dict) -> None:
+        key = (document["allocation_date"], document["_id"])
+        self._allocations[document["_id"]] = document
+        self._vehicle_date[(document["vehicle_id"], document["allocation_date"])] = (
+            document["_id"]
+        )
+        self._by_employee[document["employee_id"]].add(key)
+        self._by_vehicle[document["vehicle_id"]].add(key)
+        self._by_date.add(key)
+        self._rollups.update(
+            rollup_keys(
+                document["employee_id"],
+                document["vehicle_id"],
+                document["allocation_date"],
+            )
+        )
+
+    def _unindex(self, document: dict) -> None:
+        key = (document["allocation_date"], document["_id"])
+        del self._allocations[document["_id"]]
+        del self._vehicle_date[(document["vehicle_id"], document["allocation_date"])]
+        self._by_employee[document["employee_id"]].remove(key)
+        self._by_vehicle[document["vehicle_id"]].remove(key)
+        self._by_date.remove(key)
+        self._rollups.subtract(
+            rollup_keys(
+                document["employee_id"],
+                document["vehicle_id"],
+                document["allocation_date"],
+            )
+        )
+
+    def _get_future(self, allocation_id: str, action: str) -> dict:
+        """
+        Fetch an allocation that may still be changed, i.e. dated after today.
+        """
+        document = None
+        if ObjectId.is_valid(allocation_id):
+            document = self._allocations.get(ObjectId(allocation_id))
+        if document is None:
+            raise HTTPException(status_code=404, detail="Allocation not found")
+        if document["allocation_date"] <= _midnight(datetime.now(timezone.utc).date()):
+            raise HTTPException(
+                status_code=400,
+                detail=f"Cannot {action} past or current date allocations",
+            )
+        return document
+
+    def _select(
+        self,
+        employee_id: str = None,
+        vehicle_id: str = None,
+        start_date: date = None,
+        end_date: date = None,
+    ):
+        """
+        Pick the index serving a history query and the bounds of its date range.
+
+        Returns:
+        - tuple: The sorted index, the first and last-plus-one positions of the
+          date range in it, and a predicate for a filter the index does not
+          cover (None when it covers them all).
+        """
+        index, residual = self._by_date, None
+        if employee_id and vehicle_id:
+            # Scan the shorter of the two entity indexes and filter on the other
+            by_employee = self._by_employee.get(employee_id, SortedList())
+            by_vehicle = self._by_vehicle.get(vehicle_id, SortedList())
+            if len(by_employee) <= len(by_vehicle):
+                index = by_employee
+                residual = lambda key: (
+                    self._allocations[key[1]]["vehicle_id"] == vehicle_id
+                )
+            else:
+                index = by_vehicle
+                residual = lambda key: (
+                    self._allocations[key[1]]["employee_id"] == employee_id
+                )
+        elif employee_id:
+            index = self._by_employee.get(employee_id, SortedList())
+        elif vehicle_id:
+            index = self._by_vehicle.get(vehicle_id, SortedList())
+
+        low = index.bisect_left((_midnight(start_date),)) if start_date else 0
+        high = (
+            index.bisect_left((_midnight(end_date + timedelta(days=1)),))
+            if end_date
+            else len(index)
+        )
+        return index, low, max(low, high), residual
+
+    def _documents(self, keys: Iterator[tuple]) -> List[dict]:
+        return [dict(self._allocations[allocation_id]) for _, allocation_id in keys]
+
+    async def get_allocation_by_vehicle_date(
+        self, vehicle_id: str, allocation_date: date
+    ) -> Optional[dict]:
+        allocation_id = self._vehicle_date.get((vehicle_id, _midnight(allocation_date)))
+        if allocation_id is None:
+            return None
+        return dict(self._allocations[allocation_id])
+
+    async def get_allocations_by_vehicle_dates(
+        self, lookups: List[AllocationLookup]
+    ) -> AllocationLookupResponse:
+        return AllocationLookupResponse(
+            results=[
+                AllocationLookupResult(
+                    vehicle_id=lookup.vehicle_id,
+                    allocation_date=lookup.allocation_date,
+                    allocation=await self.get_allocation_by_vehicle_date(
+                        lookup.vehicle_id, lookup.allocation_date
+                    ),
+                )
+                for lookup in lookups
+            ]
+        )
+
+    async def create_allocation(
+        self, allocation: AllocationModel
+    ) -> CreateResponseModel:
+        document = {"_id": ObjectId(), **allocation.model_dump()}
+        document["allocation_date"] = _midnight(allocation.allocation_date)
+        if (document["vehicle_id"], document["allocation_date"]) in self._vehicle_date:
+            raise HTTPException(
+                status_code=400, detail="Vehicle already allocated for this date"
+            )
+        self._index(document)
+        return CreateResponseModel(id=str(document["_id"]))
+
+    async def create_allocations_bulk(
+        self, allocations: List[AllocationModel]
+    ) -> BulkAllocationResponse:
+        results = []
+        for index, allocation in enumerate(allocations):
+            try:
+                created = await self.create_allocation(allocation)
+            except HTTPException as exc:
+                results.append(
+                    BulkAllocationResult(
+                        index=index, status="conflict", detail=exc.detail
+                    )
+                )
+            else:
+                results.append(
+                    BulkAllocationResult(index=index, status="created", id=created.id)
+                )
+        created = sum(result.status == "created" for result in results)
+        return BulkAllocationResponse(
+            results=results, created=created, conflicts=len(results) - created
+        )
+
+    async def create_range_allocation(
+        self, allocation: RangeAllocationModel
+    ) -> RangeAllocationResponse:
+        days = [
+            _midnight(day)
+            for day in check_allocation_range(
+                allocation.start_date, allocation.end_date
+            )
+        ]
+        booked = [
+            day for day in days if (allocation.vehicle_id, day) in self._vehicle_date
+        ]
+        if booked:
+            raise range_conflict(booked)
+        documents = [
+            {
+                "_id": ObjectId(),
+                "employee_id": allocation.employee_id,
+                "vehicle_id": allocation.vehicle_id,
+                "allocation_date": day,
+            }
+            for day in days
+        ]
+        for document in documents:
+            self._index(document)
+        return RangeAllocationResponse(
+            ids=[str(document["_id"]) for document in documents]
+        )
+
+    async def update_allocation(
+        self, allocation_id: str, update_data: AllocationUpdateModel
+    ) -> dict:
+        allocation = self._get_future(allocation_id, "update")
+        update_data = {
+            k: v for k, v in update_data.model_dump().items() if v is not None
+        }
+        if update_data.get("allocation_date", None):
+            update_data["allocation_date"] = _midnight(update_data["allocation_date"])
+
+        updated = {**allocation, **update_data}
+        taken_by = self._vehicle_date.get(
+            (updated["vehicle_id"], updated["allocation_date"])
+        )
+        if taken_by not in (None, allocation["_id"]):
+            raise HTTPException(
+                status_code=400, detail="Vehicle already allocated for this date"
+            )
+        self._unindex(allocation)
+        self._index(updated)
+        return dict(updated)
+
+    async def delete_allocation(self, allocation_id: str) -> None:
+        self._unindex(self._get_future(allocation_id, "delete"))
+
+    async def get_availability(
+        self, start_date: date, end_date: date = None, vehicle_ids: List[str] = None
+    ) -> AvailabilityResponse:
+        end_date = check_availability_range(start_date, end_date)
+        dates = date_range(start_date, end_date)
+        calendars = {}
+        for vehicle_id in vehicle_ids or sorted(self._by_vehicle):
+            index, low, high, _ = self._select(
+                vehicle_id=vehicle_id, start_date=start_date, end_date=end_date
+            )
+            booked = {key[0].date() for key in index.islice(low, high)}
+            calendars[vehicle_id] = [day in booked for day in dates]
+        return build_availability_response(start_date, end_date, calendars)
+
+    async def get_allocation_history(
+        self,
+        employee_id: str = None,
+        vehicle_id: str = None,
+        start_date: date = None,
+        end_date: date = None,
+        skip: int = 0,
+        limit: int = 10,
+    ) -> bytes:
+        index, low, high, residual = self._select(
+            employee_id, vehicle_id, start_date, end_date
+        )
+        if residual:
+            keys = [key for key in index.islice(low, high) if residual(key)]
+            total_count = len(keys)
+            page = keys[skip : skip + limit]
+        else:
+            # Positions in a sorted list give the count and page directly
+            total_count = high - low
+            page = index.islice(min(low + skip, high), min(low + skip + limit, high))
+        return encode_history_page(
+            self._documents(page),
+            total=total_count,
+            skip=skip,
+            limit=limit,
+            has_more=(skip + limit) < total_count,
+        )
+
+    async def get_allocation_history_page(
+        self,
+        employee_id: str = None,
+        vehicle_id: str = None,
+        start_date: date = None,
+        end_date: date = None,
+        cursor: str = None,
+        limit: int = 10,
+        include_total: bool = False,
+    ) -> bytes:
+        index, low, high, residual = self._select(
+            employee_id, vehicle_id, start_date, end_date
+        )
+        start = low
+        if cursor:
+            try:
+                last_key = decode_cursor(cursor)
+            except ValueError:
+                raise HTTPException(status_code=400, detail="Invalid cursor")
+            start = min(max(low, index.bisect_right(last_key)), high)
+
+        # Take one extra key to find out whether another page exists
+        keys = []
+        for key in index.islice(start, high):
+            if residual is None or residual(key):
+                keys.append(key)
+                if len(keys) > limit:
+                    break
+        has_more = len(keys) > limit
+        keys = keys[:limit]
+
+        total = None
+        if include_total:
+            total = (
+                sum(1 for key in index.islice(low, high) if residual(key))
+                if residual
+                else high - low
+            )
+        return encode_history_page(
+            self._documents(keys),
+            total=total,
+            limit=limit,
+            next_cursor=encode_cursor(*keys[-1]) if has_more else None,
+            has_more=has_more,
+        )
+
+    async def export_allocation_history(
+        self,
+        employee_id: str = None,
+        vehicle_id: str = None,
+        start_date: date = None,
+        end_date: date = None,
+        fields: List[str] = None,
+        export_format: str = "ndjson",
+    ) -> AsyncIterator[str]:
+        fields = [
+            field for field in EXPORT_FIELDS if field in (fields or EXPORT_FIELDS)
+        ]
+        index, low, high, residual = self._select(
+            employee_id, vehicle_id, start_date, end_date
+        )
+
+        async def documents():
+            # Snapshot the keys so concurrent writes cannot break the iteration
+            for key in list(index.islice(low, high)):
+                document = self._allocations.get(key[1])
+                if document is not None and (residual is None or residual(key)):
+                    yield document
+
+        async for chunk in write_export(documents(), fields, export_format):
+            yield chunk
+
+    async def get_utilization(
+        self,
+        dimension: str,
+        granularity: str,
+        start_date: date,
+        end_date: date,
+        entity_ids: List[str] = None,
+    ) -> UtilizationResponse:
+        starts = check_utilization_range(start_date, end_date, granularity)
+        report_all = not entity_ids
+        if report_all:
+            index = self._by_vehicle if dimension == "vehicle" else self._by_employee
+            entity_ids = sorted(index)
+        counts = {
+            (entity_id, start): self._rollups[
+                (dimension, granularity, entity_id, start)
+            ]
+            for entity_id in entity_ids
+            for start in starts
+        }
+        if report_all:
+            # Like the MongoDB backend, only report entities active in the range
+            entity_ids = [
+                entity_id
+                for entity_id in entity_ids
+                if any(counts[(entity_id, start)] for start in starts)
+            ]
+        return build_utilization_response(
+            dimension, granularity, start_date, end_date, entity_ids, counts
+        )
@@ -0,0 +1,140 @@
+import os
+import time
+
+from prometheus_client import (
+    CONTENT_TYPE_LATEST,
+    REGISTRY,
+    CollectorRegistry,
+    Counter,
+    Histogram,
+    generate_latest,
+    multiprocess,
+)
+from pymongo import monitoring
+
+# Content type of the text exposition served by /metrics
+METRICS_CONTENT_TYPE = CONTENT_TYPE_LATEST
+
+# When PROMETHEUS_MULTIPROC_DIR is set (one directory shared by all worker
+# processes, emptied before the server starts), every worker writes its samples
+# there and /metrics aggregates them, whichever worker serves the scrape.
+
+REQUEST_LATENCY = Histogram(
+    "http_request_duration_seconds",
+    "HTTP request latency by route template",
+    ["method", "route", "status"],
+)
+MONGO_COMMAND_LATENCY = Histogram(
+    "mongodb_command_duration_seconds",
+    "MongoDB command latency as reported by the driver",
+    ["command", "outcome"],
+    buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5),
+)
+CACHE_LOOKUPS = Counter(
+    "cache_lookups_total",
+    "Vehicle/date cache lookups by tier (local, redis) and result (hit, miss)",
+    ["tier", "result"],
+)
+CACHE_INVALIDATIONS = Counter(
+    "cache_invalidations_total",
+    "Vehicle/date cache keys invalidated by writes",
+)
+COALESCED_LOOKUPS = Counter(
+    "coalesced_lookups_total",
+    "Vehicle/date cache misses answered without their own MongoDB query, by how: "
+    "local (joined this worker's in-flight query), redis_wait (another worker's "
+    "result) or redis_stale (stale copy while another worker reloads)",
+    ["source"],
+)
+IDEMPOTENT_REPLAYS = Counter(
+    "idempotent_replays_total",
+    "Write requests answered with the stored response of an earlier attempt",
+)
+SHED_REQUESTS = Counter(
+    "shed_requests_total",
+    "Requests rejected by admission control, by route and reason "
+    "(rate_limited, worker_overloaded, route_overloaded)",
+    ["route", "reason"],
+)
+ARCHIVED_ALLOCATIONS = Counter(
+    "archived_allocations_total",
+    "Past allocations moved from the live collection to the monthly archives",
+)
+WARMED_ALLOCATIONS = Counter(
+    "cache_warmed_allocations_total",
+    "Upcoming allocations written to the vehicle/date cache by the warm-up",
+)
+LOCAL_CACHE_EVICTIONS = Counter(
+    "local_cache_evictions_total",
+    "Entries evicted from the in-process cache because it was full",
+)
+
+
+class MongoCommandMetrics(monitoring.CommandListener):
+    """
+    pymongo command listener recording the duration of every MongoDB command.
+    """
+
+    def started(self, event):
+        pass
+
+    def succeeded(self, event):
+        MONGO_COMMAND_LATENCY.labels(event.command_name, "succeeded").observe(
+            event.duration_micros / 1e6
+        )
+
+    def failed(self, event):
+        MONGO_COMMAND_LATENCY.labels(event.command_name, "failed").observe(
+            event.duration_micros / 1e6
+        )
+
+
+class MetricsMiddleware:
+    """
+    ASGI middleware recording the latency of every HTTP request.
+
+    Requests are labelled with the matched route template (e.g.
+    "/allocation/{allocation_id}/") so that IDs do not create new series.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        status_code = 500
+
+        async def send_with_status(message):
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+            await send(message)
+
+        started = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            # The router stores the matched route in the shared scope
+            route = scope.get("route")
+            REQUEST_LATENCY.labels(
+                scope["method"],
+                route.path if route else "unmatched",
+                status_code,
+            ).observe(time.perf_counter() - started)
+
+
+def render_metrics() -> bytes:
+    """
+    Render all metrics in the Prometheus text format.
+
+    Returns:
+    - bytes: The exposition, aggregated across workers in multiprocess mode.
+    """
+    registry = REGISTRY
+    if os.environ.get("PROMETHEUS_MULTIPROC_DIR"):
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    return generate_latest(registry)
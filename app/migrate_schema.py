@@ -0,0 +1,152 @@
+import argparse
+import asyncio
+
+from pymongo import UpdateOne
+
+from . import database
+from .archive import history_partitions
+from .models import COMPACT_FIELDS, AllocationSchema
+from .utils import settings
+
+# Converting a collection to the compact schema without downtime:
+# 1. run every worker with ALLOCATION_SCHEMA=dual, so new writes carry both layouts;
+# 2. python -m app.migrate_schema expand
+# 3. run every worker with ALLOCATION_SCHEMA=compact, which replaces the
+#    sparse (v, d) index with v_d_unique and drops the legacy unique index so
+#    compact-only documents do not collide in it;
+# 4. python -m app.migrate_schema contract
+
+legacy_schema = AllocationSchema("legacy")
+compact_schema = AllocationSchema("compact")
+
+
+async def expand_allocations(batch_size: int = 1000) -> int:
+    """
+    Add the compact fields to every allocation that only has the legacy ones.
+
+    The hot collection and every monthly archive are converted in turn, in _id
+    order and one bulk write per batch. Each update
+    only matches if the legacy fields are still those it was computed from; a
+    document changed in between was rewritten with both layouts by the dual
+    schema and needs no conversion.
+
+    Parameters:
+    - batch_size (int): Documents converted per bulk write.
+
+    Returns:
+    - int: Number of documents converted.
+    """
+    converted = 0
+    for collection in await history_partitions():
+        converted += await expand_collection(collection, batch_size)
+    return converted
+
+
+async def expand_collection(collection, batch_size: int) -> int:
+    """
+    Add the compact fields to the allocations of one collection.
+    """
+    converted = 0
+    query = {"d": {"$exists": False}}
+    while True:
+        batch = (
+            await collection.find(query, legacy_schema.projection())
+            .sort("_id", 1)
+            .limit(batch_size)
+            .to_list(length=batch_size)
+        )
+        if not batch:
+            return converted
+        requests = []
+        for document in batch:
+            allocation = legacy_schema.from_document(document)
+            requests.append(
+                UpdateOne(document, {"$set": compact_schema.to_document(allocation)})
+            )
+        result = await collection.bulk_write(requests, ordered=False)
+        converted += result.modified_count
+        query = {"d": {"$exists": False}, "_id": {"$gt": batch[-1]["_id"]}}
+
+
+async def contract_allocations(batch_size: int = 1000) -> int:
+    """
+    Remove the legacy fields and indexes once every allocation has the compact ones.
+
+    The compact indexes are built first and the legacy ones dropped before any
+    field is removed, so the legacy unique index never sees documents without
+    its fields. Run only once every worker uses ALLOCATION_SCHEMA=compact.
+
+    Parameters:
+    - batch_size (int): Documents updated per update_many.
+
+    Returns:
+    - int: Number of documents stripped of their legacy fields.
+
+    Raises:
+    - RuntimeError: If workers still read the legacy fields or expand has not completed.
+    """
+    if settings.ALLOCATION_SCHEMA != "compact":
+        raise RuntimeError("Set ALLOCATION_SCHEMA=compact on every worker first")
+    collections = await history_partitions()
+    for collection in collections:
+        if await collection.count_documents({"d": {"$exists": False}}, limit=1):
+            raise RuntimeError("Some allocations lack the compact fields; run expand")
+
+    stripped = 0
+    for collection in collections:
+        stripped += await contract_collection(collection, batch_size)
+    return stripped
+
+
+async def contract_collection(collection, batch_size: int) -> int:
+    """
+    Remove the legacy indexes and fields from one collection.
+    """
+    # v_d_unique has the keys of the dual sparse index, which must go first
+    await database.drop_index(collection, database.DUAL_UNIQUE_INDEX)
+    await collection.create_indexes(database.COMPACT_ALLOCATION_INDEXES)
+    for index in database.DUAL_ALLOCATION_INDEXES:
+        await database.drop_index(collection, index.document["name"])
+    for name in database.SUPERSEDED_INDEXES:
+        await database.drop_index(collection, name)
+
+    stripped = 0
+    query = {"$or": [{name: {"$exists": True}} for name in COMPACT_FIELDS]}
+    while True:
+        batch = (
+            await collection.find(query, {"_id": 1})
+            .limit(batch_size)
+            .to_list(length=batch_size)
+        )
+        if not batch:
+            return stripped
+        result = await collection.update_many(
+            {"_id": {"$in": [document["_id"] for document in batch]}},
+            {"$unset": {name: "" for name in COMPACT_FIELDS}},
+        )
+        stripped += result.modified_count
+
+
+async def main():
+    parser = argparse.ArgumentParser(
+        description="Convert allocations between the legacy and compact schemas."
+    )
+    parser.add_argument("step", choices=["expand", "contract"])
+    parser.add_argument("--batch-size", type=int, default=1000)
+    args = parser.parse_args()
+
+    await database.connect()
+    try:
+        if args.step == "expand":
+            converted = await expand_allocations(args.batch_size)
+            print(f"Added the compact fields to {converted} allocations")
+        else:
+            stripped = await contract_allocations(args.batch_size)
+            print(f"Removed the legacy fields from {stripped} allocations")
+    finally:
+        await database.disconnect()
+
+
+if __name__ == "__main__":
+    # Usage: python -m app.migrate_schema expand|contract [--batch-size N]
+    asyncio.run(main())
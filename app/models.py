@@ -1,10 +1,135 @@
 from pydantic import BaseModel, ConfigDict, Field, BeforeValidator
-from datetime import date
-from typing import Optional, Annotated, List
+from datetime import date, datetime, timedelta
+from typing import Optional, Annotated, List, Literal, Union
+
+from .utils import settings
 
 # Define a custom type for PyObjectId, which is a string validated before use.
 PyObjectId = Annotated[str, BeforeValidator(str)]
 
+# Field names of the compact allocation schema
+COMPACT_FIELDS = {"employee_id": "e", "vehicle_id": "v", "allocation_date": "d"}
+
+# Day 0 of the compact schema's day numbers
+EPOCH = date(1970, 1, 1)
+
+
+def day_number(value: Union[date, datetime]) -> int:
+    """
+    Convert a date or a midnight datetime to days since 1970-01-01.
+    """
+    if isinstance(value, datetime):
+        value = value.date()
+    return (value - EPOCH).days
+
+
+def midnight(value: Union[date, datetime, int]) -> datetime:
+    """
+    Convert a date, datetime or day number to the midnight datetime used by the API.
+    """
+    if isinstance(value, int):
+        value = EPOCH + timedelta(days=value)
+    elif isinstance(value, datetime):
+        value = value.date()
+    return datetime.combine(value, datetime.min.time())
+
+
+class AllocationSchema:
+    """
+    Maps allocations between their API shape and their MongoDB documents.
+
+    In the API shape, allocations have employee_id, vehicle_id and an
+    allocation_date holding a midnight datetime, whatever the stored layout:
+    - legacy: the same field names and values as the API shape;
+    - compact: "e", "v" and "d", the date as a day number, which takes a
+      fraction of the space in both the documents and the indexes;
+    - dual: documents carry both layouts, and reads use the legacy one.
+
+    Attributes:
+    - name (str): The stored layout.
+    - compact (bool): Whether filters, sorts and projections use the compact fields.
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+        self.compact = name == "compact"
+
+    def field(self, name: str) -> str:
+        """
+        Return the stored field read for an API field.
+        """
+        return COMPACT_FIELDS[name] if self.compact else name
+
+    def value(self, name: str, value):
+        """
+        Return the stored value of an API field, for use in filters.
+        """
+        if name != "allocation_date":
+            return value
+        return day_number(value) if self.compact else midnight(value)
+
+    def match(self, **fields) -> dict:
+        """
+        Build a filter matching the given API field values.
+        """
+        return {
+            self.field(name): self.value(name, value) for name, value in fields.items()
+        }
+
+    def projection(self, *names: str) -> dict:
+        """
+        Build a projection reading the given API fields (all of them by default).
+        """
+        return {self.field(name): 1 for name in names or COMPACT_FIELDS}
+
+    def to_document(self, allocation: dict) -> dict:
+        """
+        Convert an allocation, or some of its fields, to the stored layout.
+
+        Parameters:
+        - allocation (dict): API fields, plus "_id" if already assigned.
+
+        Returns:
+        - dict: The document, or the $set of an update when given some fields.
+        """
+        document = {"_id": allocation["_id"]} if "_id" in allocation else {}
+        for name, short in COMPACT_FIELDS.items():
+            if name not in allocation:
+                continue
+            if self.name != "compact":
+                document[name] = self._legacy_value(name, allocation[name])
+            if self.name != "legacy":
+                document[short] = self._compact_value(name, allocation[name])
+        return document
+
+    def from_document(self, document: Optional[dict]) -> Optional[dict]:
+        """
+        Convert a stored document to the API shape, keeping only projected fields.
+        """
+        if document is None:
+            return None
+        allocation = {"_id": document["_id"]} if "_id" in document else {}
+        for name in COMPACT_FIELDS:
+            field = self.field(name)
+            if field in document:
+                value = document[field]
+                allocation[name] = (
+                    midnight(value) if name == "allocation_date" else value
+                )
+        return allocation
+
+    @staticmethod
+    def _legacy_value(name: str, value):
+        return midnight(value) if name == "allocation_date" else value
+
+    @staticmethod
+    def _compact_value(name: str, value):
+        return day_number(value) if name == "allocation_date" else value
+
+
+# The layout every MongoDB read and write goes through
+allocation_schema = AllocationSchema(settings.ALLOCATION_SCHEMA)
+
 
 class AllocationModel(BaseModel):
     """
@@ -54,6 +179,25 @@ class PaginatedResponse(BaseModel):
     has_more: bool
 
 
+class CursorPaginatedResponse(BaseModel):
+    """
+    Model for keyset (cursor) paginated responses containing a list of allocations.
+
+    Attributes:
+    - data (List[AllocationResponseModel]): List of allocation responses.
+    - total (Optional[int]): Cached count of matching allocations, if requested.
+    - limit (int): Number of records per page.
+    - next_cursor (Optional[str]): Cursor for the next page, if there is one.
+    - has_more (bool): Indicates if there are more records available.
+    """
+
+    data: List[AllocationResponseModel]
+    total: Optional[int] = None
+    limit: int
+    next_cursor: Optional[str] = None
+    has_more: bool
+
+
 class AllocationUpdateModel(BaseModel):
     """
     Model for updating vehicle allocation details.
@@ -76,3 +220,176 @@ class CreateResponseModel(BaseModel):
     """
 
     id: str
+
+
+class RangeAllocationModel(BaseModel):
+    """
+    Model for allocating a vehicle to an employee on every day of a date range.
+
+    Attributes:
+    - employee_id (str): The ID of the employee to whom the vehicle is allocated.
+    - vehicle_id (str): The ID of the vehicle being allocated.
+    - start_date (date): The first day of the allocation.
+    - end_date (date): The last day of the allocation (inclusive).
+    """
+
+    employee_id: str
+    vehicle_id: str
+    start_date: date
+    end_date: date
+
+
+class RangeAllocationResponse(BaseModel):
+    """
+    Response model for a range allocation.
+
+    Attributes:
+    - ids (List[str]): The IDs of the allocations created, one per day in date order.
+    """
+
+    ids: List[str]
+
+
+class BulkAllocationResult(BaseModel):
+    """
+    Outcome of a single item in a bulk allocation request.
+
+    Attributes:
+    - index (int): Position of the item in the request body.
+    - status (str): "created" or "conflict".
+    - id (Optional[str]): The ID of the created allocation.
+    - detail (Optional[str]): Why the item was not created.
+    """
+
+    index: int
+    status: Literal["created", "conflict"]
+    id: Optional[str] = None
+    detail: Optional[str] = None
+
+
+class BulkAllocationResponse(BaseModel):
+    """
+    Response model for a bulk allocation request.
+
+    Attributes:
+    - results (List[BulkAllocationResult]): Per-item outcomes, in request order.
+    - created (int): Number of allocations created.
+    - conflicts (int): Number of items rejected because the vehicle was taken.
+    """
+
+    results: List[BulkAllocationResult]
+    created: int
+    conflicts: int
+
+
+class AllocationLookup(BaseModel):
+    """
+    A vehicle and date to look up.
+
+    Attributes:
+    - vehicle_id (str): The ID of the vehicle.
+    - allocation_date (date): The date to check.
+    """
+
+    vehicle_id: str
+    allocation_date: date
+
+
+class AllocationLookupResult(AllocationLookup):
+    """
+    Outcome of a single vehicle/date lookup.
+
+    Attributes:
+    - allocation (Optional[AllocationResponseModel]): The allocation, if the
+      vehicle is booked on the date.
+    """
+
+    allocation: Optional[AllocationResponseModel] = None
+
+
+class AllocationLookupResponse(BaseModel):
+    """
+    Response model for a batch of vehicle/date lookups.
+
+    Attributes:
+    - results (List[AllocationLookupResult]): Per-pair outcomes, in request order.
+    """
+
+    results: List[AllocationLookupResult]
+
+
+class VehicleCalendar(BaseModel):
+    """
+    Booked dates of a single vehicle within a requested range.
+
+    Attributes:
+    - vehicle_id (str): The ID of the vehicle.
+    - booked_dates (List[date]): Dates in the range on which the vehicle is booked.
+    """
+
+    vehicle_id: str
+    booked_dates: List[date]
+
+
+class AvailabilityResponse(BaseModel):
+    """
+    Response model for vehicle availability queries.
+
+    Attributes:
+    - start_date (date): First day of the requested range.
+    - end_date (date): Last day of the requested range.
+    - free_vehicles (List[str]): Vehicles free on every day of the range.
+    - calendars (Optional[List[VehicleCalendar]]): Per-vehicle calendars, for ranges.
+    """
+
+    start_date: date
+    end_date: date
+    free_vehicles: List[str]
+    calendars: Optional[List[VehicleCalendar]] = None
+
+
+class UtilizationBucket(BaseModel):
+    """
+    Allocation count of one entity over one week or month.
+
+    Attributes:
+    - period_start (date): First day of the week (a Monday) or month.
+    - allocations (int): Number of allocations dated within the bucket.
+    - utilization (float): Allocations divided by the number of days in the bucket.
+    """
+
+    period_start: date
+    allocations: int
+    utilization: float
+
+
+class UtilizationSeries(BaseModel):
+    """
+    Utilization buckets of a single vehicle or employee.
+
+    Attributes:
+    - entity_id (str): The ID of the vehicle or employee.
+    - buckets (List[UtilizationBucket]): One entry per bucket, in date order.
+    """
+
+    entity_id: str
+    buckets: List[UtilizationBucket]
+
+
+class UtilizationResponse(BaseModel):
+    """
+    Response model for utilization statistics.
+
+    Attributes:
+    - dimension (Literal["vehicle", "employee"]): What the series are grouped by.
+    - granularity (Literal["week", "month"]): The bucket size.
+    - start_date (date): First day of the requested range.
+    - end_date (date): Last day of the requested range.
+    - series (List[UtilizationSeries]): One series per vehicle or employee.
+    """
+
+    dimension: Literal["vehicle", "employee"]
+    granularity: Literal["week", "month"]
+    start_date: date
+    end_date: date
+    series: List[UtilizationSeries]
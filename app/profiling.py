@@ -0,0 +1,357 @@
+import asyncio
+import cProfile
+import json
+import os
+import random
+import re
+import sys
+import threading
+import time
+import uuid
+from collections import Counter
+from contextvars import ContextVar
+from typing import List, Optional
+
+import aioredis
+from aioredis.client import Pipeline
+from fastapi import APIRouter, HTTPException
+from fastapi.responses import FileResponse
+from pymongo import monitoring
+
+from .utils import settings
+
+# Requests are profiled only when PROFILE_DIR is set: main.py then installs
+# ProfilingMiddleware and the /profiles routes, and database.connect() creates
+# the Redis clients and MongoDB listener below. Otherwise none of this code
+# runs. A profile covers everything its worker ran during the request, so
+# profiles of a busy worker include work done for concurrent requests; one
+# request per worker is profiled at a time.
+
+# Profile files: <id>.collapsed or <id>.pstats, plus <id>.json with its summary
+PROFILE_FILE_PATTERN = re.compile(r"^[\w-]+\.(collapsed|pstats|json)$")
+PROFILE_FORMATS = ("collapsed", "pstats")
+PROFILE_ID_HEADER = b"x-profile-id"
+
+# The profile of the request being handled, if it is profiled
+current_profile: ContextVar[Optional["RequestProfile"]] = ContextVar(
+    "current_profile", default=None
+)
+
+
+class RequestProfile:
+    """
+    The await-time spans of one profiled request.
+
+    Spans are recorded by ProfiledRedis and ProfilingCommandListener while the
+    request is handled; the listener runs in Motor's executor threads, which
+    inherit the request's context.
+    """
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.spans = []
+
+    def add_span(self, kind: str, name: str, started: float, duration: float):
+        self.spans.append(
+            {
+                "kind": kind,
+                "name": name,
+                "start_ms": round((started - self.started) * 1000, 3),
+                "duration_ms": round(duration * 1000, 3),
+            }
+        )
+
+    def totals(self) -> dict:
+        """
+        Return the number of spans and milliseconds spent per kind.
+        """
+        totals = {}
+        for span in self.spans:
+            kind = totals.setdefault(span["kind"], {"count": 0, "ms": 0.0})
+            kind["count"] += 1
+            kind["ms"] = round(kind["ms"] + span["duration_ms"], 3)
+        return totals
+
+
+class ProfiledPipeline(Pipeline):
+    """
+    Redis pipeline recording its round trip in the current request profile.
+    """
+
+    async def execute(self, raise_on_error: bool = True):
+        profile = current_profile.get()
+        if profile is None:
+            return await super().execute(raise_on_error)
+        commands = [args[0] for args, _ in self.command_stack]
+        started = time.perf_counter()
+        try:
+            return await super().execute(raise_on_error)
+        finally:
+            profile.add_span(
+                "redis",
+                "PIPELINE " + " ".join(map(str, commands)),
+                started,
+                time.perf_counter() - started,
+            )
+
+
+class ProfiledRedis(aioredis.Redis):
+    """
+    Redis client recording the await time of each command in the current
+    request profile, including the wait for a pooled connection.
+    """
+
+    async def execute_command(self, *args, **options):
+        profile = current_profile.get()
+        if profile is None:
+            return await super().execute_command(*args, **options)
+        started = time.perf_counter()
+        try:
+            return await super().execute_command(*args, **options)
+        finally:
+            profile.add_span(
+                "redis", str(args[0]), started, time.perf_counter() - started
+            )
+
+    def pipeline(self, transaction: bool = True, shard_hint: Optional[str] = None):
+        return ProfiledPipeline(
+            self.connection_pool, self.response_callbacks, transaction, shard_hint
+        )
+
+
+class ProfilingCommandListener(monitoring.CommandListener):
+    """
+    pymongo command listener recording MongoDB commands in the current request
+    profile, with the duration reported by the driver.
+    """
+
+    def started(self, event):
+        pass
+
+    def succeeded(self, event):
+        self.record(event)
+
+    def failed(self, event):
+        self.record(event)
+
+    def record(self, event):
+        profile = current_profile.get()
+        if profile is not None:
+            duration = event.duration_micros / 1e6
+            profile.add_span(
+                "mongo",
+                event.command_name,
+                time.perf_counter() - duration,
+                duration,
+            )
+
+
+class StackSampler(threading.Thread):
+    """
+    Thread sampling the stack of another thread at a fixed interval.
+
+    The samples are counted per stack, in the collapsed format read by
+    flamegraph.pl and speedscope: one "root;...;leaf count" line per stack.
+    """
+
+    def __init__(self, thread_id: int, interval: float):
+        super().__init__(daemon=True)
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = Counter()
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is not None:
+                self.stacks[collapse_stack(frame)] += 1
+
+    def stop(self) -> str:
+        self.stopped.set()
+        self.join()
+        return "".join(f"{stack} {count}\n" for stack, count in self.stacks.items())
+
+
+def collapse_stack(frame) -> str:
+    """
+    Render a stack as "root;...;leaf", one "function (file:line)" per frame.
+    """
+    frames = []
+    while frame is not None:
+        code = frame.f_code
+        frames.append(f"{code.co_name} ({code.co_filename}:{code.co_firstlineno})")
+        frame = frame.f_back
+    return ";".join(reversed(frames))
+
+
+class ProfilingMiddleware:
+    """
+    ASGI middleware profiling requests on demand or at a sample rate.
+
+    A request is profiled when it carries PROFILE_HEADER, or else with
+    probability PROFILE_SAMPLE_RATE. The header value may pick the profile
+    format ("collapsed" or "pstats"); PROFILE_FORMAT is used otherwise.
+    Profiles are written to PROFILE_DIR, together with a JSON summary of the
+    request and of its MongoDB and Redis await time, and the response carries
+    their ID in X-Profile-Id. Only the newest PROFILE_MAX_FILES are kept.
+    """
+
+    def __init__(self, app):
+        self.app = app
+        self.header = settings.PROFILE_HEADER.lower().encode("latin-1")
+        self.busy = False  # one profile at a time per worker
+        os.makedirs(settings.PROFILE_DIR, exist_ok=True)
+
+    def requested_format(self, scope) -> Optional[str]:
+        """
+        Return the format to profile the request in, or None to not profile it.
+        """
+        if scope["type"] != "http" or self.busy or current_profile.get():
+            return None
+        for name, value in scope["headers"]:
+            if name == self.header:
+                value = value.decode("latin-1").lower()
+                return value if value in PROFILE_FORMATS else settings.PROFILE_FORMAT
+        if random.random() < settings.PROFILE_SAMPLE_RATE:
+            return settings.PROFILE_FORMAT
+        return None
+
+    async def __call__(self, scope, receive, send):
+        profile_format = self.requested_format(scope)
+        if profile_format is None:
+            await self.app(scope, receive, send)
+            return
+
+        self.busy = True
+        profile_id = f"{time.strftime('%Y%m%dT%H%M%S', time.gmtime())}-{os.getpid()}-{uuid.uuid4().hex[:8]}"
+        status_code = 500
+
+        async def send_with_profile_id(message):
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+                message["headers"] = [
+                    *message.get("headers", []),
+                    (PROFILE_ID_HEADER, profile_id.encode()),
+                ]
+            await send(message)
+
+        profile = RequestProfile()
+        token = current_profile.set(profile)
+        if profile_format == "pstats":
+            profiler = cProfile.Profile()
+            profiler.enable()
+        else:
+            profiler = StackSampler(
+                threading.get_ident(), settings.PROFILE_SAMPLE_INTERVAL
+            )
+            profiler.start()
+        cpu_started = time.thread_time()
+        try:
+            await self.app(scope, receive, send_with_profile_id)
+        finally:
+            cpu_time = time.thread_time() - cpu_started
+            if profile_format == "pstats":
+                profiler.disable()
+                output = profiler
+            else:
+                output = profiler.stop()
+            current_profile.reset(token)
+            self.busy = False
+            summary = {
+                "id": profile_id,
+                "file": f"{profile_id}.{profile_format}",
+                "method": scope["method"],
+                "path": scope["path"],
+                "status": status_code,
+                "wall_ms": round((time.perf_counter() - profile.started) * 1000, 3),
+                "cpu_ms": round(cpu_time * 1000, 3),
+                "await": profile.totals(),
+                "spans": profile.spans,
+            }
+            await asyncio.to_thread(write_profile, summary, output)
+
+
+def write_profile(summary: dict, output) -> None:
+    """
+    Write a profile and its summary to PROFILE_DIR, then prune old profiles.
+
+    Parameters:
+    - summary (dict): The summary written to <id>.json.
+    - output: The cProfile.Profile to dump, or the collapsed stacks as text.
+    """
+    directory = settings.PROFILE_DIR
+    path = os.path.join(directory, summary["file"])
+    if isinstance(output, cProfile.Profile):
+        output.dump_stats(path)
+    else:
+        with open(path, "w") as file:
+            file.write(output)
+    with open(os.path.join(directory, f"{summary['id']}.json"), "w") as file:
+        json.dump(summary, file)
+
+    summaries = sorted(
+        (name for name in os.listdir(directory) if name.endswith(".json")),
+        reverse=True,  # IDs start with their timestamp
+    )
+    for name in summaries[settings.PROFILE_MAX_FILES :]:
+        profile_id = name[: -len(".json")]
+        for extension in ("json", "collapsed", "pstats"):
+            try:
+                os.remove(os.path.join(directory, f"{profile_id}.{extension}"))
+            except FileNotFoundError:
+                pass
+
+
+def read_summaries() -> List[dict]:
+    """
+    Read the summaries of the profiles in PROFILE_DIR, newest first.
+    """
+    directory = settings.PROFILE_DIR
+    summaries = []
+    for name in sorted(os.listdir(directory), reverse=True):
+        if not name.endswith(".json"):
+            continue
+        try:
+            with open(os.path.join(directory, name)) as file:
+                summary = json.load(file)
+        except (OSError, ValueError):
+            continue  # pruned or being written by another worker
+        summary.pop("spans", None)
+        summaries.append(summary)
+    return summaries
+
+
+router = APIRouter()
+
+
+@router.get("/profiles", include_in_schema=False)
+async def list_profiles():
+    """
+    List the profiles written by every worker, newest first.
+
+    Returns:
+    - dict: The summary of each profile, without its spans.
+    """
+    return {"profiles": await asyncio.to_thread(read_summaries)}
+
+
+@router.get("/profiles/{name}", include_in_schema=False)
+async def fetch_profile(name: str):
+    """
+    Download a profile file listed by /profiles, or its JSON summary.
+
+    Parameters:
+    - name (str): The file name, e.g. 20241026T101500-42-1a2b3c4d.collapsed.
+
+    Returns:
+    - FileResponse: The file.
+
+    Raises:
+    - HTTPException: If the profile does not exist.
+    """
+    path = os.path.join(settings.PROFILE_DIR, name)
+    if not PROFILE_FILE_PATTERN.match(name) or not os.path.isfile(path):
+        raise HTTPException(status_code=404, detail="Profile not found")
+    return FileResponse(path)
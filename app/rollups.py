@@ -0,0 +1,286 @@
+import asyncio
+from collections import Counter
+from datetime import date, datetime, timedelta
+from typing import Dict, Iterable, List, Tuple
+
+from fastapi import HTTPException
+from pymongo import UpdateOne
+
+from . import database
+from .archive import history_partitions
+from .keys import as_date
+from .models import (
+    UtilizationBucket,
+    UtilizationResponse,
+    UtilizationSeries,
+    allocation_schema,
+)
+from .utils import settings
+
+# Allocation counts per vehicle and per employee are kept pre-aggregated by
+# week (starting on Monday) and by calendar month, so utilization queries read
+# one document per bucket instead of scanning allocations. Writes adjust the
+# counts with $inc; `python -m app.rollups` rebuilds them from scratch.
+
+GRANULARITIES = ("week", "month")
+
+
+def bucket_start(day: date, granularity: str) -> date:
+    """
+    Return the first day of the week or month containing a date.
+    """
+    if granularity == "week":
+        return day - timedelta(days=day.weekday())
+    return day.replace(day=1)
+
+
+def next_bucket(start: date, granularity: str) -> date:
+    """
+    Return the first day of the bucket following the one starting at `start`.
+    """
+    if granularity == "week":
+        return start + timedelta(days=7)
+    return (start + timedelta(days=32)).replace(day=1)
+
+
+def bucket_starts(start_date: date, end_date: date, granularity: str) -> List[date]:
+    """
+    Return the first day of every bucket overlapping a date range.
+    """
+    starts = []
+    start = bucket_start(start_date, granularity)
+    while start <= end_date:
+        starts.append(start)
+        start = next_bucket(start, granularity)
+    return starts
+
+
+def check_utilization_range(
+    start_date: date, end_date: date, granularity: str
+) -> List[date]:
+    """
+    Validate the date range of a utilization query.
+
+    Returns:
+    - list: The first day of every bucket in the range.
+
+    Raises:
+    - HTTPException: If the range is inverted or spans too many buckets.
+    """
+    if end_date < start_date:
+        raise HTTPException(status_code=400, detail="end_date is before start_date")
+    starts = bucket_starts(start_date, end_date, granularity)
+    if len(starts) > settings.UTILIZATION_MAX_BUCKETS:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Date range exceeds {settings.UTILIZATION_MAX_BUCKETS} buckets",
+        )
+    return starts
+
+
+def rollup_keys(
+    employee_id: str, vehicle_id: str, allocation_date
+) -> List[Tuple[str, str, str, date]]:
+    """
+    Build the keys of the rollup buckets an allocation counts towards.
+
+    Parameters:
+    - employee_id (str): The ID of the employee.
+    - vehicle_id (str): The ID of the vehicle.
+    - allocation_date (date | datetime): The allocation date.
+
+    Returns:
+    - list: (dimension, granularity, entity_id, period start) tuples; add them
+      to a Counter for a new allocation and subtract them for a removed one.
+    """
+    day = as_date(allocation_date)
+    return [
+        (dimension, granularity, entity_id, bucket_start(day, granularity))
+        for dimension, entity_id in (("vehicle", vehicle_id), ("employee", employee_id))
+        for granularity in GRANULARITIES
+    ]
+
+
+def _filter(dimension: str, granularity: str, entity_id: str, period: date) -> dict:
+    return {
+        "dimension": dimension,
+        "granularity": granularity,
+        "entity_id": entity_id,
+        "period": datetime.combine(period, datetime.min.time()),
+    }
+
+
+async def apply_rollups(increments: Counter) -> None:
+    """
+    Apply rollup count changes with one unordered bulk write of $inc upserts.
+
+    Parameters:
+    - increments (Counter): Count change per rollup key; zero entries are skipped.
+    """
+    operations = [
+        UpdateOne(_filter(*key), {"$inc": {"allocations": delta}}, upsert=True)
+        for key, delta in increments.items()
+        if delta
+    ]
+    if operations:
+        await database.rollups_collection.bulk_write(operations, ordered=False)
+
+
+def build_utilization_response(
+    dimension: str,
+    granularity: str,
+    start_date: date,
+    end_date: date,
+    entity_ids: Iterable[str],
+    counts: Dict[Tuple[str, date], int],
+) -> UtilizationResponse:
+    """
+    Build a utilization response from per-bucket allocation counts.
+
+    Parameters:
+    - dimension (str): "vehicle" or "employee".
+    - granularity (str): "week" or "month".
+    - start_date (date): First day of the requested range.
+    - end_date (date): Last day of the requested range.
+    - entity_ids (Iterable[str]): Entities to report, in output order.
+    - counts (dict): Allocation count per (entity_id, period start); missing
+      buckets count as zero.
+
+    Returns:
+    - UtilizationResponse: One series per entity with one entry per bucket.
+    """
+    starts = bucket_starts(start_date, end_date, granularity)
+    series = []
+    for entity_id in entity_ids:
+        buckets = []
+        for start in starts:
+            allocations = counts.get((entity_id, start), 0)
+            days = (next_bucket(start, granularity) - start).days
+            buckets.append(
+                UtilizationBucket(
+                    period_start=start,
+                    allocations=allocations,
+                    utilization=allocations / days,
+                )
+            )
+        series.append(UtilizationSeries(entity_id=entity_id, buckets=buckets))
+    return UtilizationResponse(
+        dimension=dimension,
+        granularity=granularity,
+        start_date=start_date,
+        end_date=end_date,
+        series=series,
+    )
+
+
+async def get_utilization(
+    dimension: str,
+    granularity: str,
+    start_date: date,
+    end_date: date,
+    entity_ids: List[str] = None,
+) -> UtilizationResponse:
+    """
+    Report allocations per week or month from the rollups.
+
+    Only rollup documents are read, so the cost grows with the number of
+    buckets returned rather than with the number of allocations.
+
+    Parameters:
+    - dimension (str): "vehicle" or "employee".
+    - granularity (str): "week" or "month".
+    - start_date (date): First day of the range; widened to its bucket start.
+    - end_date (date): Last day of the range; widened to its bucket end.
+    - entity_ids (List[str], optional): Entities to report; defaults to every
+      entity with allocations in the range.
+
+    Returns:
+    - UtilizationResponse: One series per entity with one entry per bucket.
+
+    Raises:
+    - HTTPException: If the range is inverted or spans too many buckets.
+    """
+    starts = check_utilization_range(start_date, end_date, granularity)
+    query = {
+        "dimension": dimension,
+        "granularity": granularity,
+        "period": {
+            "$gte": datetime.combine(starts[0], datetime.min.time()),
+            "$lte": datetime.combine(starts[-1], datetime.min.time()),
+        },
+    }
+    if entity_ids:
+        query["entity_id"] = {"$in": entity_ids}
+    documents = await database.rollups_collection.find(
+        query, {"_id": 0, "entity_id": 1, "period": 1, "allocations": 1}
+    ).to_list(length=None)
+
+    counts = {
+        (document["entity_id"], as_date(document["period"])): document["allocations"]
+        for document in documents
+    }
+    if not entity_ids:
+        entity_ids = sorted(
+            {entity_id for (entity_id, _), count in counts.items() if count}
+        )
+    return build_utilization_response(
+        dimension, granularity, start_date, end_date, entity_ids, counts
+    )
+
+
+async def rebuild_rollups(batch_size: int = 10000) -> int:
+    """
+    Rebuild every rollup from the allocations collection and its archives.
+
+    The counts are written to a scratch collection that then replaces the
+    rollups collection in one rename, so readers never see partial counts.
+    Writes made while the scan runs are missing from the result, so run it
+    while allocations are not being changed or archived.
+
+    Parameters:
+    - batch_size (int): Cursor batch size used while scanning allocations.
+
+    Returns:
+    - int: Number of rollup buckets written.
+    """
+    counts = Counter()
+    for collection in await history_partitions():
+        cursor = collection.find(
+            {}, {"_id": 0, **allocation_schema.projection()}
+        ).batch_size(batch_size)
+        async for document in cursor:
+            allocation = allocation_schema.from_document(document)
+            counts.update(
+                rollup_keys(
+                    allocation["employee_id"],
+                    allocation["vehicle_id"],
+                    allocation["allocation_date"],
+                )
+            )
+
+    name = database.rollups_collection.name
+    scratch = database.database.get_collection(f"{name}_rebuild")
+    await scratch.drop()
+    await scratch.create_indexes(database.ROLLUP_INDEXES)
+    documents = [{**_filter(*key), "allocations": n} for key, n in counts.items()]
+    for offset in range(0, len(documents), batch_size):
+        await scratch.insert_many(documents[offset : offset + batch_size])
+    if documents:
+        await scratch.rename(name, dropTarget=True)
+    else:
+        await database.rollups_collection.delete_many({})
+    return len(documents)
+
+
+async def main():
+    await database.connect()
+    try:
+        buckets = await rebuild_rollups()
+    finally:
+        await database.disconnect()
+    print(f"Rebuilt {buckets} utilization rollup buckets")
+
+
+if __name__ == "__main__":
+    # Usage: python -m app.rollups
+    asyncio.run(main())
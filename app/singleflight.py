@@ -0,0 +1,144 @@
+import asyncio
+import secrets
+import time
+from typing import Any, Awaitable, Callable, Optional
+
+from . import database
+from .keys import lookup_lock_key, stale_key
+from .metrics import COALESCED_LOOKUPS
+from .utils import settings
+
+# Seconds between checks for the value another worker is loading
+LOCK_POLL_INTERVAL = 0.01
+
+# Delete the lock only if it still holds our token, i.e. it has not expired and
+# been taken over by another worker
+_RELEASE_SCRIPT = """
+if redis.call("get", KEYS[1]) == ARGV[1] then
+    return redis.call("del", KEYS[1])
+end
+return 0
+"""
+
+
+class SingleFlight:
+    """
+    Deduplicates concurrent loads of the same key within a worker.
+
+    The first caller for a key runs the load; callers arriving while it is in
+    flight await the same result (or exception) instead of loading again.
+    """
+
+    def __init__(self):
+        self._in_flight = {}  # key -> Future of the running load
+
+    async def run(self, key: str, load: Callable[[], Awaitable[Any]]) -> Any:
+        """
+        Return the result of load(), sharing it with concurrent callers for key.
+
+        Parameters:
+        - key (str): Identifies the value being loaded.
+        - load (Callable): Coroutine function performing the load.
+
+        Returns:
+        - Any: The loaded value.
+        """
+        while key in self._in_flight:
+            future = self._in_flight[key]
+            COALESCED_LOOKUPS.labels("local").inc()
+            try:
+                return await asyncio.shield(future)
+            except asyncio.CancelledError:
+                # The loading request was cancelled, not this one: load again
+                if not future.cancelled():
+                    raise
+
+        future = asyncio.get_running_loop().create_future()
+        self._in_flight[key] = future
+        try:
+            result = await load()
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except Exception as exc:
+            future.set_exception(exc)
+            # Mark the exception retrieved in case nobody was waiting
+            future.exception()
+            raise
+        else:
+            future.set_result(result)
+            return result
+        finally:
+            if self._in_flight.get(key) is future:
+                del self._in_flight[key]
+
+    def forget(self, keys) -> None:
+        """
+        Stop sharing in-flight loads of the given keys, e.g. after a write.
+
+        Loads already running still complete for their callers, but later
+        callers start a new load instead of joining one that began before the write.
+        """
+        for key in keys:
+            self._in_flight.pop(key, None)
+
+    def __len__(self) -> int:
+        return len(self._in_flight)
+
+
+# Vehicle/date lookups currently loading from MongoDB in this worker
+lookup_flights = SingleFlight()
+
+
+async def acquire_lookup_lock(cache_key: str) -> Optional[str]:
+    """
+    Try to become the worker that reloads a cache key from MongoDB.
+
+    Parameters:
+    - cache_key (str): The vehicle/date cache key.
+
+    Returns:
+    - str: A token for release_lookup_lock, or None if another worker holds the lock.
+    """
+    token = secrets.token_hex(8)
+    acquired = await database.redis.set(
+        lookup_lock_key(cache_key),
+        token,
+        nx=True,
+        px=int(settings.LOOKUP_LOCK_TTL * 1000),
+    )
+    return token if acquired else None
+
+
+async def release_lookup_lock(cache_key: str, token: str) -> None:
+    """
+    Release a lock taken by acquire_lookup_lock.
+    """
+    await database.redis.eval(_RELEASE_SCRIPT, 1, lookup_lock_key(cache_key), token)
+
+
+async def wait_for_fill(cache_key: str) -> Any:
+    """
+    Wait for another worker to reload a cache key, serving its stale copy if any.
+
+    The stale copy outlives the cache entry when it merely expires, but is
+    deleted together with it on invalidation, so it never hides a write.
+
+    Parameters:
+    - cache_key (str): The vehicle/date cache key.
+
+    Returns:
+    - bytes: The raw cache entry, or None if the lock expired first.
+    """
+    deadline = time.monotonic() + settings.LOOKUP_LOCK_TTL
+    while True:
+        fresh, stale = await database.redis_binary.mget(cache_key, stale_key(cache_key))
+        if fresh is not None:
+            COALESCED_LOOKUPS.labels("redis_wait").inc()
+            return fresh
+        if stale is not None:
+            COALESCED_LOOKUPS.labels("redis_stale").inc()
+            return stale
+        if time.monotonic() >= deadline:
+            return None
+        await asyncio.sleep(LOCK_POLL_INTERVAL)
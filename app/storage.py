@@ -0,0 +1,223 @@
+import asyncio
+from abc import ABC, abstractmethod
+from contextlib import suppress
+from datetime import date
+from typing import AsyncIterator, List
+
+from . import crud, database, rollups
+from .archive import run_archiver
+from .cache import listen_for_invalidations
+from .models import (
+    AllocationLookup,
+    AllocationLookupResponse,
+    AllocationModel,
+    AllocationUpdateModel,
+    AvailabilityResponse,
+    BulkAllocationResponse,
+    CreateResponseModel,
+    RangeAllocationModel,
+    RangeAllocationResponse,
+    UtilizationResponse,
+)
+from .utils import settings
+from .warmup import run_warmup
+
+# The API talks to storage only through the backend selected by the
+# STORAGE_BACKEND setting. Every backend returns allocation documents shaped
+# like the MongoDB ones ("_id" as an ObjectId, "allocation_date" as a midnight
+# datetime), whether they come from a cache or not, and raises the same
+# HTTPExceptions, so the routes cannot tell them apart.
+
+
+class StorageBackend(ABC):
+    """
+    Interface of the allocation storage backends.
+
+    Every query method is abstract, so a backend missing one cannot be created.
+
+    The parameters, results and errors of each method are those of the function
+    of the same name in app.crud.
+    """
+
+    async def start(self) -> None:
+        """
+        Prepare the backend before the application serves requests.
+        """
+
+    async def stop(self) -> None:
+        """
+        Release the resources acquired by start().
+        """
+
+    @abstractmethod
+    async def get_allocation_by_vehicle_date(
+        self, vehicle_id: str, allocation_date: date
+    ):
+        raise NotImplementedError
+
+    @abstractmethod
+    async def get_allocations_by_vehicle_dates(
+        self, lookups: List[AllocationLookup]
+    ) -> AllocationLookupResponse:
+        raise NotImplementedError
+
+    @abstractmethod
+    async def create_allocation(
+        self, allocation: AllocationModel
+    ) -> CreateResponseModel:
+        raise NotImplementedError
+
+    @abstractmethod
+    async def create_allocations_bulk(
+        self, allocations: List[AllocationModel]
+    ) -> BulkAllocationResponse:
+        raise NotImplementedError
+
+    @abstractmethod
+    async def create_range_allocation(
+        self, allocation: RangeAllocationModel
+    ) -> RangeAllocationResponse:
+        raise NotImplementedError
+
+    @abstractmethod
+    async def update_allocation(
+        self, allocation_id: str, update_data: AllocationUpdateModel
+    ) -> dict:
+        raise NotImplementedError
+
+    @abstractmethod
+    async def delete_allocation(self, allocation_id: str) -> None:
+        raise NotImplementedError
+
+    @abstractmethod
+    async def get_availability(
+        self, start_date: date, end_date: date = None, vehicle_ids: List[str] = None
+    ) -> AvailabilityResponse:
+        raise NotImplementedError
+
+    @abstractmethod
+    async def get_allocation_history(
+        self,
+        employee_id: str = None,
+        vehicle_id: str = None,
+        start_date: date = None,
+        end_date: date = None,
+        skip: int = 0,
+        limit: int = 10,
+    ) -> bytes:
+        raise NotImplementedError
+
+    @abstractmethod
+    async def get_allocation_history_page(
+        self,
+        employee_id: str = None,
+        vehicle_id: str = None,
+        start_date: date = None,
+        end_date: date = None,
+        cursor: str = None,
+        limit: int = 10,
+        include_total: bool = False,
+    ) -> bytes:
+        raise NotImplementedError
+
+    @abstractmethod
+    def export_allocation_history(
+        self,
+        employee_id: str = None,
+        vehicle_id: str = None,
+        start_date: date = None,
+        end_date: date = None,
+        fields: List[str] = None,
+        export_format: str = "ndjson",
+    ) -> AsyncIterator[str]:
+        raise NotImplementedError
+
+    @abstractmethod
+    async def get_utilization(
+        self,
+        dimension: str,
+        granularity: str,
+        start_date: date,
+        end_date: date,
+        entity_ids: List[str] = None,
+    ) -> UtilizationResponse:
+        """
+        Report allocations per week or month; see app.rollups.get_utilization.
+        """
+        raise NotImplementedError
+
+
+class MongoRedisBackend(StorageBackend):
+    """
+    MongoDB as the system of record with the Redis caches in front of it.
+    """
+
+    get_allocation_by_vehicle_date = staticmethod(crud.get_allocation_by_vehicle_date)
+    get_allocations_by_vehicle_dates = staticmethod(
+        crud.get_allocations_by_vehicle_dates
+    )
+    create_allocation = staticmethod(crud.create_allocation)
+    create_allocations_bulk = staticmethod(crud.create_allocations_bulk)
+    create_range_allocation = staticmethod(crud.create_range_allocation)
+    update_allocation = staticmethod(crud.update_allocation)
+    delete_allocation = staticmethod(crud.delete_allocation)
+    get_availability = staticmethod(crud.get_availability)
+    get_allocation_history = staticmethod(crud.get_allocation_history)
+    get_allocation_history_page = staticmethod(crud.get_allocation_history_page)
+    export_allocation_history = staticmethod(crud.export_allocation_history)
+    get_utilization = staticmethod(rollups.get_utilization)
+
+    def __init__(self):
+        self._tasks = []
+
+    async def start(self) -> None:
+        """
+        Connect to MongoDB and Redis, bootstrap the indexes, keep this worker's
+        local cache subscribed to invalidations and schedule the archiver and
+        the cache warm-up when they are enabled.
+        """
+        await database.connect()
+        await database.ensure_indexes()
+        self._tasks.append(asyncio.create_task(listen_for_invalidations()))
+        if settings.ARCHIVE_INTERVAL:
+            self._tasks.append(asyncio.create_task(run_archiver()))
+        if settings.WARMUP_DAYS:
+            self._tasks.append(asyncio.create_task(run_warmup()))
+
+    async def stop(self) -> None:
+        """
+        Stop the background tasks and close the connection pools.
+        """
+        for task in self._tasks:
+            task.cancel()
+            with suppress(asyncio.CancelledError):
+                await task
+        self._tasks = []
+        await database.disconnect()
+
+
+def create_backend(name: str) -> StorageBackend:
+    """
+    Create the storage backend with the given name.
+
+    Parameters:
+    - name (str): "mongo" for MongoDB with Redis, or "memory" for the
+      in-process engine.
+
+    Returns:
+    - StorageBackend: A new, not yet started backend.
+
+    Raises:
+    - ValueError: If the name is unknown.
+    """
+    if name == "mongo":
+        return MongoRedisBackend()
+    if name == "memory":
+        from .memory_storage import MemoryBackend
+
+        return MemoryBackend()
+    raise ValueError(f"Unknown storage backend {name!r}")
+
+
+# Backend used by the API; read it through this module (storage.backend)
+backend = create_backend(settings.STORAGE_BACKEND)
@@ -1,27 +1,65 @@
-from datetime import datetime, timezone, timedelta
+import asyncio
+import json
+import pstats
+from datetime import date, datetime, timezone, timedelta
+from types import SimpleNamespace
 
 import pytest
 import pytest_asyncio
+from fastapi import FastAPI
 from bson import ObjectId
 from httpx import AsyncClient, ASGITransport
+from prometheus_client import REGISTRY
 
+from app.admission import AdmissionMiddleware
+from app.idempotency import IdempotencyMiddleware
+from app.archive import archive_allocations, archive_collection
+from app.availability import rebuild_availability
+from app.cache import MISSING, LocalCache, invalidate, local_cache, server_time
+from app.cache_codecs import CODECS, decode_cached
+from app.crud import build_history_query, get_allocation_by_vehicle_date, page_pipeline
+from app.keys import ARCHIVE_MONTHS_KEY, lookup_lock_key, stale_key, vehicle_date_key
 from app.main import app
-from .database import database as db, redis as redis_client
+from app.memory_storage import MemoryBackend
+from app.metrics import MongoCommandMetrics
+from app.migrate_schema import contract_allocations, expand_allocations
+from app.models import CursorPaginatedResponse, PaginatedResponse, allocation_schema
+from app.profiling import ProfiledRedis, ProfilingMiddleware
+from app.profiling import router as profiling_router
+from app.rollups import rebuild_rollups
+from app.utils import settings
+from app.warmup import fill_cache, warm_cache
+from . import crud, database, storage
 
 
-@pytest_asyncio.fixture(scope="session", autouse=True)
+@pytest_asyncio.fixture(scope="session")
 async def setup_test_db():
     """
-    Clean up MongoDB and Redis databases before and after each test.
+    Clean up MongoDB and Redis databases before and after the test session.
     """
+    # ASGITransport does not run the lifespan handler, so connect here
+    await database.connect()
     # Clean the MongoDB and Redis databases before the test
-    await db.drop_collection("allocations")
-    await redis_client.flushdb()
+    await database.database.drop_collection("allocations")
+    await database.database.drop_collection("utilization_rollups")
+    await database.redis.flushdb()
+    await database.ensure_indexes()
 
     yield  # Run the test
     # Clean up after the test
-    await db.drop_collection("allocations")
-    await redis_client.flushdb()
+    await database.database.drop_collection("allocations")
+    await database.database.drop_collection("utilization_rollups")
+    await database.redis.flushdb()
+    await database.disconnect()
+
+
+@pytest.fixture(autouse=True)
+def services(request):
+    """
+    Connect to MongoDB and Redis for every test not marked no_services.
+    """
+    if request.node.get_closest_marker("no_services") is None:
+        request.getfixturevalue("setup_test_db")
 
 
 @pytest.mark.asyncio(scope="session")
@@ -42,6 +80,217 @@ async def test_create_allocation():
         assert response.json() is not None
 
 
+@pytest.mark.asyncio(scope="session")
+async def test_create_duplicate_allocation():
+    """
+    Test that a vehicle cannot be allocated twice for the same date.
+    """
+    async with AsyncClient(
+        transport=ASGITransport(app=app), base_url="http://test"
+    ) as client:
+        payload = {
+            "employee_id": "123",
+            "vehicle_id": "XYZ",
+            "allocation_date": "2024-10-27",
+        }
+        response = await client.post("/allocate/", json=payload)
+        assert response.status_code == 201
+
+        payload["employee_id"] = "456"
+        response = await client.post("/allocate/", json=payload)
+        assert response.status_code == 400
+        assert response.json()["detail"] == "Vehicle already allocated for this date"
+
+
+@pytest.mark.asyncio(scope="session")
+async def test_create_allocations_bulk():
+    """
+    Test bulk allocation with conflicts inside the batch and against existing data.
+    """
+    async with AsyncClient(
+        transport=ASGITransport(app=app), base_url="http://test"
+    ) as client:
+        payload = [
+            {"employee_id": "1", "vehicle_id": "BULK", "allocation_date": "2024-12-01"},
+            {"employee_id": "2", "vehicle_id": "BULK", "allocation_date": "2024-12-02"},
+            {"employee_id": "3", "vehicle_id": "BULK", "allocation_date": "2024-12-01"},
+            # Already booked by test_create_duplicate_allocation
+            {"employee_id": "4", "vehicle_id": "XYZ", "allocation_date": "2024-10-27"},
+        ]
+        response = await client.post("/allocate/bulk", json=payload)
+        assert response.status_code == 200
+        body = response.json()
+        assert [result["status"] for result in body["results"]] == [
+            "created",
+            "created",
+            "conflict",
+            "conflict",
+        ]
+        assert body["created"] == 2
+        assert body["conflicts"] == 2
+
+
+@pytest.mark.asyncio(scope="session")
+async def test_create_range_allocation():
+    """
+    Test that a date range is booked entirely or not at all.
+    """
+    async with AsyncClient(
+        transport=ASGITransport(app=app), base_url="http://test"
+    ) as client:
+        payload = {
+            "employee_id": "range-emp",
+            "vehicle_id": "range-veh",
+            "start_date": "2030-03-01",
+            "end_date": "2030-03-03",
+        }
+        response = await client.post("/allocate/range", json=payload)
+        assert response.status_code == 201
+        assert len(response.json()["ids"]) == 3
+
+        # Overlaps 2030-03-03 only; none of the other days may be booked
+        payload.update(start_date="2030-03-03", end_date="2030-03-06")
+        response = await client.post("/allocate/range", json=payload)
+        assert response.status_code == 400
+        assert response.json()["detail"] == "Vehicle already allocated on 2030-03-03"
+        assert (
+            await database.allocations_collection.count_documents(
+                allocation_schema.match(vehicle_id="range-veh")
+            )
+            == 3
+        )
+
+        payload.update(start_date="2030-03-06", end_date="2030-03-05")
+        response = await client.post("/allocate/range", json=payload)
+        assert response.status_code == 400
+
+        response = await client.get(
+            "/availability/",
+            params={
+                "start_date": "2030-03-01",
+                "end_date": "2030-03-04",
+                "vehicle_id": "range-veh",
+            },
+        )
+        [calendar] = response.json()["calendars"]
+        assert calendar["booked_dates"] == ["2030-03-01", "2030-03-02", "2030-03-03"]
+
+
+@pytest.mark.asyncio(scope="session")
+async def test_idempotency_key():
+    """
+    Test that retries with an Idempotency-Key replay the first response.
+    """
+    async with AsyncClient(
+        transport=ASGITransport(app=app), base_url="http://test"
+    ) as client:
+        payload = {
+            "employee_id": "idem-emp",
+            "vehicle_id": "idem-veh",
+            "allocation_date": "2030-04-01",
+        }
+        headers = {"Idempotency-Key": "idem-1"}
+        first = await client.post("/allocate/", json=payload, headers=headers)
+        retry = await client.post("/allocate/", json=payload, headers=headers)
+        assert first.status_code == retry.status_code == 201
+        assert retry.content == first.content
+
+        # The same key cannot be reused for a different request
+        response = await client.post(
+            "/allocate/",
+            json={**payload, "allocation_date": "2030-04-02"},
+            headers=headers,
+        )
+        assert response.status_code == 422
+
+        # Concurrent duplicates wait for the first one instead of running again
+        payload["allocation_date"] = "2030-04-03"
+        responses = await asyncio.gather(
+            *(
+                client.post(
+                    "/allocate/", json=payload, headers={"Idempotency-Key": "idem-2"}
+                )
+                for _ in range(5)
+            )
+        )
+        assert {response.status_code for response in responses} == {201}
+        assert len({response.content for response in responses}) == 1
+        assert (
+            await database.allocations_collection.count_documents(
+                allocation_schema.match(vehicle_id="idem-veh")
+            )
+            == 2
+        )
+
+
+@pytest.mark.asyncio(scope="session")
+async def test_idempotency_key_held_by_slow_request(monkeypatch):
+    """
+    Test that a request running longer than IDEMPOTENCY_LOCK_TTL keeps its key,
+    so a retry sent meanwhile does not run the write again.
+    """
+    monkeypatch.setattr(settings, "IDEMPOTENCY_LOCK_TTL", 0.3)
+    runs = []
+
+    async def slow_app(scope, receive, send):
+        runs.append(await receive())
+        await asyncio.sleep(2)
+        await send({"type": "http.response.start", "status": 201, "headers": []})
+        await send({"type": "http.response.body", "body": b'{"id": "slow"}'})
+
+    headers = {"Idempotency-Key": f"slow-{ObjectId()}"}
+    async with AsyncClient(
+        transport=ASGITransport(app=IdempotencyMiddleware(slow_app)),
+        base_url="http://test",
+    ) as client:
+
+        async def retry_later():
+            # Past the TTL, even rounded up to whole seconds as Redis EX would
+            await asyncio.sleep(1.2)
+            return await client.post("/allocate/", json={}, headers=headers)
+
+        first, retry = await asyncio.gather(
+            client.post("/allocate/", json={}, headers=headers), retry_later()
+        )
+        assert first.status_code == 201
+        assert retry.status_code == 409
+        replay = await client.post("/allocate/", json={}, headers=headers)
+        assert replay.status_code == 201 and replay.content == first.content
+    assert len(runs) == 1
+
+
+@pytest.mark.asyncio(scope="session")
+async def test_get_availability():
+    """
+    Test the availability calendar after allocating and freeing vehicles.
+    """
+    async with AsyncClient(
+        transport=ASGITransport(app=app), base_url="http://test"
+    ) as client:
+        # Booked by test_create_allocations_bulk
+        response = await client.get("/availability/", params={"date": "2024-12-01"})
+        assert response.status_code == 200
+        body = response.json()
+        assert "BULK" not in body["free_vehicles"]
+        assert "XYZ" in body["free_vehicles"]
+        assert body["calendars"] is None
+
+        response = await client.get(
+            "/availability/",
+            params={
+                "start_date": "2024-11-30",
+                "end_date": "2024-12-03",
+                "vehicle_id": "BULK",
+            },
+        )
+        assert response.status_code == 200
+        body = response.json()
+        assert body["free_vehicles"] == []
+        assert body["calendars"] == [
+            {"vehicle_id": "BULK", "booked_dates": ["2024-12-01", "2024-12-02"]}
+        ]
+
+
 @pytest.mark.asyncio(scope="session")
 async def test_get_allocation_history():
     """
@@ -63,6 +312,218 @@ async def test_get_allocation_history():
         assert "data" in response.json()
 
 
+@pytest.mark.asyncio(scope="session")
+async def test_get_allocation_history_cursor():
+    """
+    Test walking the allocation history with cursor pagination.
+    """
+    async with AsyncClient(
+        transport=ASGITransport(app=app), base_url="http://test"
+    ) as client:
+        # Inserted out of date order, so pages must be sorted to be in order
+        for day in reversed(range(1, 6)):
+            payload = {
+                "employee_id": "cursor-emp",
+                "vehicle_id": "cursor-veh",
+                "allocation_date": f"2024-11-0{day}",
+            }
+            response = await client.post("/allocate/", json=payload)
+            assert response.status_code == 201
+
+        params = {
+            "employee_id": "cursor-emp",
+            "pagination": "cursor",
+            "limit": 2,
+            "include_total": True,
+        }
+        dates = []
+        while True:
+            response = await client.get("/history/", params=params)
+            assert response.status_code == 200
+            page = response.json()
+            assert page["total"] == 5
+            dates.extend(item["allocation_date"] for item in page["data"])
+            if not page["has_more"]:
+                assert page["next_cursor"] is None
+                break
+            params["cursor"] = page["next_cursor"]
+
+        assert dates == [f"2024-11-0{day}" for day in range(1, 6)]
+
+        # Offset pages follow the same order
+        offset_dates = []
+        for skip in range(0, 5, 2):
+            response = await client.get(
+                "/history/",
+                params={"employee_id": "cursor-emp", "skip": skip, "limit": 2},
+            )
+            assert response.status_code == 200
+            offset_dates.extend(
+                item["allocation_date"] for item in response.json()["data"]
+            )
+        assert offset_dates == dates
+
+        response = await client.get("/history/", params={"cursor": "not-a-cursor"})
+        assert response.status_code == 400
+
+
+def winning_plan_stages(explain) -> set:
+    """
+    Collect the stage names of the winning plans in explain() output.
+    """
+    stages = set()
+    if isinstance(explain, dict):
+        if "winningPlan" in explain:
+            stages |= plan_stages(explain["winningPlan"])
+        for value in explain.values():
+            stages |= winning_plan_stages(value)
+    elif isinstance(explain, list):
+        for value in explain:
+            stages |= winning_plan_stages(value)
+    return stages
+
+
+def plan_stages(plan) -> set:
+    """
+    Collect the stage names of a query plan and of its inputs.
+    """
+    stages = set()
+    if isinstance(plan, dict):
+        if "stage" in plan:
+            stages.add(plan["stage"])
+        for value in plan.values():
+            stages |= plan_stages(value)
+    elif isinstance(plan, list):
+        for value in plan:
+            stages |= plan_stages(value)
+    return stages
+
+
+@pytest.mark.asyncio(scope="session")
+async def test_history_queries_read_index_order():
+    """
+    Test that history pages are read in (allocation_date, _id) index order,
+    with no in-memory sort, whatever the filters.
+    """
+    collection = database.allocations_collection
+    date_field = allocation_schema.field("allocation_date")
+    for filters in ({}, {"employee_id": "plan-emp"}, {"vehicle_id": "plan-veh"}):
+        query = build_history_query(
+            **filters, start_date=date(2024, 1, 1), end_date=date(2024, 12, 31)
+        )
+        explain = await (
+            collection.find(query, allocation_schema.projection())
+            .sort([(date_field, 1), ("_id", 1)])
+            .limit(11)
+            .explain()
+        )
+        stages = winning_plan_stages(explain)
+        assert "IXSCAN" in stages and "SORT" not in stages, (filters, stages)
+
+        explain = await database.database.command(
+            "aggregate",
+            collection.name,
+            pipeline=page_pipeline(query, skip=20, limit=10),
+            explain=True,
+        )
+        stages = winning_plan_stages(explain)
+        assert "IXSCAN" in stages and "SORT" not in stages, (filters, stages)
+
+
+@pytest.mark.asyncio(scope="session")
+async def test_history_pages_match_response_models():
+    """
+    Test that pre-encoded history pages are exactly what the response models produce.
+    """
+    async with AsyncClient(
+        transport=ASGITransport(app=app), base_url="http://test"
+    ) as client:
+        # Allocations created by test_get_allocation_history_cursor
+        for model, params in (
+            (PaginatedResponse, {"employee_id": "cursor-emp", "limit": 3}),
+            (
+                CursorPaginatedResponse,
+                {"employee_id": "cursor-emp", "limit": 3, "pagination": "cursor"},
+            ),
+        ):
+            for _ in range(2):  # the database, then the cache
+                response = await client.get("/history/", params=params)
+                assert response.status_code == 200
+                assert response.headers["content-type"] == "application/json"
+                page = model.model_validate_json(response.content)
+                assert len(page.data) == 3
+                assert response.content == page.model_dump_json(by_alias=True).encode()
+
+        # The schema is still documented by the response models
+        schema = app.openapi()["paths"]["/history/"]["get"]["responses"]["200"]
+        refs = json.dumps(schema["content"]["application/json"]["schema"])
+        assert "PaginatedResponse" in refs and "CursorPaginatedResponse" in refs
+
+
+@pytest.mark.asyncio(scope="session")
+async def test_history_cache_invalidated_by_writes():
+    """
+    Test that history pages are served from cache until a write bumps a generation.
+    """
+    async with AsyncClient(
+        transport=ASGITransport(app=app), base_url="http://test"
+    ) as client:
+        params = {"employee_id": "gen-emp"}
+        response = await client.get("/history/", params=params)
+        assert response.json()["total"] == 0
+
+        # A write that bypasses the CRUD layer is not seen: the page is cached
+        await database.database.get_collection("allocations").insert_one(
+            allocation_schema.to_document(
+                {
+                    "employee_id": "gen-emp",
+                    "vehicle_id": "gen-veh",
+                    "allocation_date": datetime(2024, 12, 24),
+                }
+            )
+        )
+        response = await client.get("/history/", params=params)
+        assert response.json()["total"] == 0
+
+        # Writes through the API bump the employee's generation
+        payload = {
+            "employee_id": "gen-emp",
+            "vehicle_id": "gen-veh",
+            "allocation_date": "2024-12-25",
+        }
+        response = await client.post("/allocate/", json=payload)
+        assert response.status_code == 201
+        response = await client.get("/history/", params=params)
+        assert response.json()["total"] == 2
+
+
+@pytest.mark.asyncio(scope="session")
+async def test_export_allocation_history():
+    """
+    Test streaming the allocation history as NDJSON and CSV.
+    """
+    async with AsyncClient(
+        transport=ASGITransport(app=app), base_url="http://test"
+    ) as client:
+        # Allocations created by test_get_allocation_history_cursor
+        params = {"employee_id": "cursor-emp", "end_date": "2024-11-02"}
+        response = await client.get("/history/export", params=params)
+        assert response.status_code == 200
+        assert response.headers["content-type"] == "application/x-ndjson"
+        rows = [json.loads(line) for line in response.text.splitlines()]
+        assert [row["allocation_date"] for row in rows] == ["2024-11-01", "2024-11-02"]
+        assert set(rows[0]) == {"id", "employee_id", "vehicle_id", "allocation_date"}
+
+        params.update(format="csv", fields=["vehicle_id", "allocation_date"])
+        response = await client.get("/history/export", params=params)
+        assert response.status_code == 200
+        assert response.text.splitlines() == [
+            "vehicle_id,allocation_date",
+            "cursor-veh,2024-11-01",
+            "cursor-veh,2024-11-02",
+        ]
+
+
 @pytest.mark.asyncio(scope="session")
 async def test_delete_allocation():
     """
@@ -80,8 +541,10 @@ async def test_delete_allocation():
             ),
         }
         # Insert the allocation into MongoDB
-        allocations_collection = db.get_collection("allocations")
-        insert_result = await allocations_collection.insert_one(allocation_data)
+        allocations_collection = database.database.get_collection("allocations")
+        insert_result = await allocations_collection.insert_one(
+            allocation_schema.to_document(allocation_data)
+        )
         allocation_id = str(insert_result.inserted_id)
 
         # Act: Delete the allocation using the DELETE endpoint
@@ -99,8 +562,10 @@ async def test_delete_allocation():
             ),
         }
         # Insert the allocation into MongoDB
-        allocations_collection = db.get_collection("allocations")
-        insert_result = await allocations_collection.insert_one(allocation_data)
+        allocations_collection = database.database.get_collection("allocations")
+        insert_result = await allocations_collection.insert_one(
+            allocation_schema.to_document(allocation_data)
+        )
         allocation_id = str(insert_result.inserted_id)
 
         # Act: Delete the allocation using the DELETE endpoint
@@ -116,9 +581,10 @@ async def test_delete_allocation():
         assert allocation_in_db is None
 
         # Verify that the allocation is also removed from Redis
-        allocation_in_redis = await redis_client.get(
-            f"vehicle:{allocation_data['vehicle_id']}"
-            f":date:{allocation_data['allocation_date']}"
+        allocation_in_redis = await database.redis.get(
+            vehicle_date_key(
+                allocation_data["vehicle_id"], allocation_data["allocation_date"]
+            )
         )
         assert allocation_in_redis is None
 
@@ -134,15 +600,17 @@ async def test_update_allocation():
         # Arrange: Directly insert an allocation into MongoDB for testing
         allocation_data = {
             "employee_id": "emp123",
-            "vehicle_id": "veh456",
+            "vehicle_id": "veh789",
             "allocation_date": datetime.combine(
                 datetime.now(timezone.utc).date(), datetime.min.time()
             ),
         }
 
         # Insert the allocation into MongoDB
-        allocations_collection = db.get_collection("allocations")
-        insert_result = await allocations_collection.insert_one(allocation_data)
+        allocations_collection = database.database.get_collection("allocations")
+        insert_result = await allocations_collection.insert_one(
+            allocation_schema.to_document(allocation_data)
+        )
         allocation_id = str(insert_result.inserted_id)
 
         # Act: Attempt to update the allocation with a present date
@@ -160,15 +628,17 @@ async def test_update_allocation():
         # Now, update with a future date
         allocation_data = {
             "employee_id": "emp123",
-            "vehicle_id": "veh456",
+            "vehicle_id": "veh789",
             "allocation_date": datetime.combine(
                 datetime.now(timezone.utc).date() + timedelta(days=2),
                 datetime.min.time(),
             ),
         }
         # Insert the allocation into MongoDB
-        allocations_collection = db.get_collection("allocations")
-        insert_result = await allocations_collection.insert_one(allocation_data)
+        allocations_collection = database.database.get_collection("allocations")
+        insert_result = await allocations_collection.insert_one(
+            allocation_schema.to_document(allocation_data)
+        )
         allocation_id = str(insert_result.inserted_id)
 
         # Act: Update the allocation using the PATCH endpoint
@@ -176,17 +646,1068 @@ async def test_update_allocation():
             f"/allocation/{allocation_id}/", json=updated_data
         )
 
-        # Assert the update response
+        # Assert the update response is the stored document
         assert update_response.status_code == 200
+        assert update_response.json() == {
+            "_id": allocation_id,
+            "employee_id": "emp789",
+            "vehicle_id": "veh789",
+            "allocation_date": allocation_data["allocation_date"].date().isoformat(),
+        }
+
+        # Moving onto a date the vehicle is already booked for is rejected
+        conflict_date = allocation_data["allocation_date"] + timedelta(days=1)
+        await allocations_collection.insert_one(
+            allocation_schema.to_document(
+                {
+                    "employee_id": "emp456",
+                    "vehicle_id": "veh789",
+                    "allocation_date": conflict_date,
+                }
+            )
+        )
+        conflict_response = await client.patch(
+            f"/allocation/{allocation_id}/",
+            json={"allocation_date": conflict_date.date().isoformat()},
+        )
+        assert conflict_response.status_code == 400
+        assert (
+            await client.patch(f"/allocation/{ObjectId()}/", json={})
+        ).status_code == 404
+        assert (
+            await client.patch("/allocation/not-an-id/", json={})
+        ).status_code == 404
 
         # Verify that the allocation is updated in the database (MongoDB)
-        updated_allocation = await allocations_collection.find_one(
-            {"_id": ObjectId(allocation_id)}
+        updated_allocation = allocation_schema.from_document(
+            await allocations_collection.find_one({"_id": ObjectId(allocation_id)})
         )
         assert updated_allocation["employee_id"] == updated_data["employee_id"]
 
-        allocation_in_redis = await redis_client.get(
-            f"vehicle:{allocation_data['vehicle_id']}"
-            f":date:{allocation_data['allocation_date']}"
+        allocation_in_redis = await database.redis.get(
+            vehicle_date_key(
+                allocation_data["vehicle_id"], allocation_data["allocation_date"]
+            )
         )
         assert allocation_in_redis is None
+
+
+@pytest.mark.asyncio(scope="session")
+async def test_write_paths_invalidate_lookup_keys():
+    """
+    Test that create, update and delete each clear exactly the key lookups read.
+    """
+    async with AsyncClient(
+        transport=ASGITransport(app=app), base_url="http://test"
+    ) as client:
+        vehicle_id = "cache-veh"
+        first_date = datetime.now(timezone.utc).date() + timedelta(days=5)
+        second_date = first_date + timedelta(days=1)
+        first_key = vehicle_date_key(vehicle_id, first_date)
+        second_key = vehicle_date_key(vehicle_id, second_date)
+
+        async def cached(key):
+            return (
+                await database.redis.exists(key) or local_cache.get(key) is not MISSING
+            )
+
+        # Create: the negative entry cached by a lookup is cleared
+        assert await get_allocation_by_vehicle_date(vehicle_id, first_date) is None
+        negative_entry = await database.redis_binary.get(first_key)
+        assert negative_entry is not None and decode_cached(negative_entry) is None
+        response = await client.post(
+            "/allocate/",
+            json={
+                "employee_id": "cache-emp",
+                "vehicle_id": vehicle_id,
+                "allocation_date": first_date.isoformat(),
+            },
+        )
+        assert response.status_code == 201
+        assert not await cached(first_key)
+        allocation_id = response.json()["id"]
+
+        # Update: both the old and the new date are cleared
+        assert await get_allocation_by_vehicle_date(vehicle_id, first_date)
+        assert await get_allocation_by_vehicle_date(vehicle_id, second_date) is None
+        response = await client.patch(
+            f"/allocation/{allocation_id}/",
+            json={"allocation_date": second_date.isoformat()},
+        )
+        assert response.status_code == 200
+        assert not await cached(first_key)
+        assert not await cached(second_key)
+
+        # Delete: the allocation's date is cleared
+        assert await get_allocation_by_vehicle_date(vehicle_id, second_date)
+        response = await client.delete(f"/allocation/{allocation_id}/")
+        assert response.status_code == 204
+        assert not await cached(second_key)
+        assert await get_allocation_by_vehicle_date(vehicle_id, second_date) is None
+
+
+@pytest.mark.asyncio(scope="session")
+async def test_warmup_disabled_by_default(monkeypatch):
+    """
+    Test that the backend schedules the cache warm-up only when WARMUP_DAYS is set.
+    """
+    warmups = []
+
+    async def run_warmup():
+        warmups.append(True)
+
+    async def do_nothing():
+        pass  # the session fixture owns the connection and its listener
+
+    monkeypatch.setattr(storage, "run_warmup", run_warmup)
+    monkeypatch.setattr(storage, "listen_for_invalidations", do_nothing)
+    monkeypatch.setattr(database, "connect", do_nothing)
+    monkeypatch.setattr(database, "disconnect", do_nothing)
+    assert settings.WARMUP_DAYS == 0
+    for days, expected in ((0, []), (2, [True])):
+        monkeypatch.setattr(settings, "WARMUP_DAYS", days)
+        backend = storage.MongoRedisBackend()
+        await backend.start()
+        await asyncio.sleep(0)
+        await backend.stop()
+        assert warmups == expected
+
+
+@pytest.mark.asyncio(scope="session")
+async def test_warm_cache(monkeypatch):
+    """
+    Test that the warm-up caches upcoming allocations and that writes update
+    the caches and availability bitmaps in one Redis pipeline.
+    """
+    pipelines = []
+    pipeline = database.redis_binary.pipeline
+
+    def counting_pipeline(*args, **kwargs):
+        pipelines.append(args)
+        return pipeline(*args, **kwargs)
+
+    async with AsyncClient(
+        transport=ASGITransport(app=app), base_url="http://test"
+    ) as client:
+        today = datetime.now(timezone.utc).date()
+        ids = {}
+        for days in (1, 3):
+            day = today + timedelta(days=days)
+            response = await client.post(
+                "/allocate/",
+                json={
+                    "employee_id": "warm-emp",
+                    "vehicle_id": "warm-veh",
+                    "allocation_date": day.isoformat(),
+                },
+            )
+            assert response.status_code == 201
+            ids[day] = response.json()["id"]
+        keys = {day: vehicle_date_key("warm-veh", day) for day in ids}
+        await database.redis.delete(*keys.values())
+
+        assert await warm_cache(days=2) >= 1
+        tomorrow, later = sorted(ids)
+        cached = await database.redis_binary.get(keys[tomorrow])
+        assert cached is not None
+        assert decode_cached(cached)["employee_id"] == "warm-emp"
+        assert await database.redis_binary.get(keys[later]) is None
+
+        monkeypatch.setattr(database.redis_binary, "pipeline", counting_pipeline)
+        response = await client.delete(f"/allocation/{ids[tomorrow]}/")
+        assert response.status_code == 204
+        assert len(pipelines) == 1
+        assert await database.redis_binary.get(keys[tomorrow]) is None
+        response = await client.get(
+            "/availability/", params={"date": tomorrow.isoformat()}
+        )
+        assert "warm-veh" in response.json()["free_vehicles"]
+
+
+@pytest.mark.asyncio(scope="session")
+async def test_utilization_rollups():
+    """
+    Test that writes keep the utilization rollups current and a rebuild agrees.
+    """
+    monday = datetime.now(timezone.utc).date() + timedelta(days=7)
+    monday -= timedelta(days=monday.weekday())
+    async with AsyncClient(
+        transport=ASGITransport(app=app), base_url="http://test"
+    ) as client:
+        ids = []
+        for offset in (0, 1, 2):
+            response = await client.post(
+                "/allocate/",
+                json={
+                    "employee_id": "util-emp",
+                    "vehicle_id": "util-veh",
+                    "allocation_date": str(monday + timedelta(days=offset)),
+                },
+            )
+            ids.append(response.json()["id"])
+        # Move one allocation into the next week and delete another
+        await client.patch(
+            f"/allocation/{ids[1]}/",
+            json={"allocation_date": str(monday + timedelta(days=7))},
+        )
+        await client.delete(f"/allocation/{ids[2]}/")
+
+        params = {
+            "start_date": str(monday),
+            "end_date": str(monday + timedelta(days=13)),
+            "entity_id": "util-veh",
+        }
+        response = await client.get("/stats/utilization", params=params)
+        assert response.status_code == 200
+        [series] = response.json()["series"]
+        assert [bucket["period_start"] for bucket in series["buckets"]] == [
+            str(monday),
+            str(monday + timedelta(days=7)),
+        ]
+        assert [bucket["allocations"] for bucket in series["buckets"]] == [1, 1]
+        assert series["buckets"][0]["utilization"] == 1 / 7
+
+        await rebuild_rollups()
+        assert (await client.get("/stats/utilization", params=params)).json() == (
+            response.json()
+        )
+
+        response = await client.get(
+            "/stats/utilization",
+            params={"start_date": str(monday), "end_date": str(monday - timedelta(1))},
+        )
+        assert response.status_code == 400
+
+
+@pytest.mark.asyncio(scope="session")
+async def test_lookup_misses_are_coalesced(monkeypatch):
+    """
+    Test that concurrent misses share one MongoDB query and that a locked,
+    expired key is answered from its stale copy.
+    """
+    async with AsyncClient(
+        transport=ASGITransport(app=app), base_url="http://test"
+    ) as client:
+        await client.post(
+            "/allocate/",
+            json={
+                "employee_id": "flight-emp",
+                "vehicle_id": "flight-veh",
+                "allocation_date": "2030-05-01",
+            },
+        )
+    day = datetime(2030, 5, 1).date()
+    key = vehicle_date_key("flight-veh", day)
+    queries = []
+    find_one = database.allocations_collection.find_one
+
+    async def counting_find_one(*args, **kwargs):
+        queries.append(args)
+        await asyncio.sleep(0.01)
+        return await find_one(*args, **kwargs)
+
+    monkeypatch.setattr(database.allocations_collection, "find_one", counting_find_one)
+
+    def coalesced(source):
+        return (
+            REGISTRY.get_sample_value("coalesced_lookups_total", {"source": source})
+            or 0
+        )
+
+    local_before = coalesced("local")
+    results = await asyncio.gather(
+        *(get_allocation_by_vehicle_date("flight-veh", day) for _ in range(10))
+    )
+    assert len(queries) == 1
+    assert all(result["employee_id"] == "flight-emp" for result in results)
+    assert coalesced("local") == local_before + 9
+
+    # Another worker holds the reload lock of the expired key
+    monkeypatch.setattr(settings, "LOOKUP_LOCK_TTL", 0.5)
+    stale = CODECS["json"].encode({**results[0], "employee_id": "stale-emp"})
+    await database.redis_binary.set(stale_key(key), stale)
+    await database.redis_binary.delete(key)
+    await database.redis.set(lookup_lock_key(key), "other-worker")
+    local_cache.clear()
+    stale_before = coalesced("redis_stale")
+    allocation = await get_allocation_by_vehicle_date("flight-veh", day)
+    assert allocation["employee_id"] == "stale-emp"
+    assert len(queries) == 1
+    assert coalesced("redis_stale") == stale_before + 1
+
+    # Invalidation removes the stale copy along with the entry
+    await invalidate(key)
+    assert await database.redis_binary.get(stale_key(key)) is None
+    await database.redis.delete(lookup_lock_key(key))
+
+
+@pytest.mark.asyncio(scope="session")
+async def test_lookup_shape_same_on_cache_hit_and_miss(monkeypatch):
+    """
+    Test that a lookup returns the same document from MongoDB, Redis and the
+    local cache, with every cache codec.
+    """
+    day = datetime.now(timezone.utc).date() + timedelta(days=70)
+    key = vehicle_date_key("shape-veh", day)
+    async with AsyncClient(
+        transport=ASGITransport(app=app), base_url="http://test"
+    ) as client:
+        response = await client.post(
+            "/allocate/",
+            json={
+                "employee_id": "shape-emp",
+                "vehicle_id": "shape-veh",
+                "allocation_date": str(day),
+            },
+        )
+        assert response.status_code == 201
+    for codec in CODECS.values():
+        monkeypatch.setattr(crud, "cache_codec", codec)
+        await invalidate(key)
+        miss = await get_allocation_by_vehicle_date("shape-veh", day)
+        local_hit = await get_allocation_by_vehicle_date("shape-veh", day)
+        local_cache.clear()
+        redis_hit = await get_allocation_by_vehicle_date("shape-veh", day)
+        assert miss == local_hit == redis_hit
+        assert isinstance(redis_hit["_id"], ObjectId)
+        assert redis_hit["allocation_date"] == datetime(day.year, day.month, day.day)
+
+
+@pytest.mark.asyncio(scope="session")
+async def test_cache_fill_skipped_after_invalidation(monkeypatch):
+    """
+    Test that a lookup or warm-up that read MongoDB before a write does not
+    cache the old allocation after the write's invalidation.
+    """
+    day = datetime.now(timezone.utc).date() + timedelta(days=60)
+    key = vehicle_date_key("race-veh", day)
+    async with AsyncClient(
+        transport=ASGITransport(app=app), base_url="http://test"
+    ) as client:
+        response = await client.post(
+            "/allocate/",
+            json={
+                "employee_id": "race-emp",
+                "vehicle_id": "race-veh",
+                "allocation_date": str(day),
+            },
+        )
+        allocation_id = response.json()["id"]
+        await invalidate(key)
+
+        find_one = database.allocations_collection.find_one
+        writes = []
+
+        async def find_one_then_write(*args, **kwargs):
+            document = await find_one(*args, **kwargs)
+            if not writes:
+                # The allocation moves away after the lookup read it
+                writes.append(
+                    await client.patch(
+                        f"/allocation/{allocation_id}/",
+                        json={"allocation_date": str(day + timedelta(days=1))},
+                    )
+                )
+            return document
+
+        monkeypatch.setattr(
+            database.allocations_collection, "find_one", find_one_then_write
+        )
+        allocation = await get_allocation_by_vehicle_date("race-veh", day)
+        assert writes[0].status_code == 200
+        assert allocation["employee_id"] == "race-emp"
+        assert await database.redis_binary.get(key) is None
+        assert local_cache.get(key) is MISSING
+        assert await get_allocation_by_vehicle_date("race-veh", day) is None
+
+    # A warm-up batch read before an invalidation is not cached either
+    started = await server_time()
+    await invalidate(key)
+    assert await fill_cache([allocation], started) == 0
+    assert await database.redis_binary.get(key) is None
+    await invalidate(key)
+    assert await fill_cache([allocation], await server_time()) == 1
+    assert decode_cached(await database.redis_binary.get(key)) == allocation
+    await invalidate(key)
+
+
+@pytest.mark.asyncio(scope="session")
+async def test_lookup_allocations(monkeypatch):
+    """
+    Test that a batch of lookups costs one MongoDB query, then none once cached.
+    """
+    find = database.allocations_collection.find
+    finds = []
+
+    def counting_find(*args, **kwargs):
+        finds.append(args)
+        return find(*args, **kwargs)
+
+    first_day = datetime.now(timezone.utc).date() + timedelta(days=40)
+    probes = [
+        {
+            "vehicle_id": vehicle_id,
+            "allocation_date": str(first_day + timedelta(days=n)),
+        }
+        for vehicle_id in ("lookup-veh", "lookup-other")
+        for n in range(25)
+    ]
+    async with AsyncClient(
+        transport=ASGITransport(app=app), base_url="http://test"
+    ) as client:
+        booked = []
+        for probe in (probes[0], probes[3]):
+            response = await client.post(
+                "/allocate/", json={**probe, "employee_id": "lookup-emp"}
+            )
+            booked.append(response.json()["id"])
+
+        monkeypatch.setattr(database.allocations_collection, "find", counting_find)
+        response = await client.post("/allocations/lookup", json=probes)
+        assert response.status_code == 200
+        results = response.json()["results"]
+        assert len(finds) == 1
+        assert len(results) == 50
+        assert [
+            result["allocation"]["_id"] for result in results if result["allocation"]
+        ] == booked
+        assert (
+            results[3]["allocation"]["allocation_date"] == probes[3]["allocation_date"]
+        )
+
+        # Served by one MGET once this worker's cache is cleared
+        local_cache.clear()
+        cached = await client.post("/allocations/lookup", json=probes)
+        assert cached.json() == response.json()
+        assert len(finds) == 1
+
+        # Booking a pair clears its cached miss
+        await client.post("/allocate/", json={**probes[1], "employee_id": "lookup-emp"})
+        response = await client.post("/allocations/lookup", json=probes[:2])
+        assert all(result["allocation"] for result in response.json()["results"])
+
+        assert (await client.post("/allocations/lookup", json=[])).status_code == 422
+
+
+@pytest.mark.asyncio(scope="session")
+async def test_admission_control(monkeypatch):
+    """
+    Test that rate limited and overloaded write requests are shed with Retry-After.
+    """
+    monkeypatch.setattr(settings, "RATE_LIMIT_PER_SECOND", 0.5)
+    monkeypatch.setattr(settings, "RATE_LIMIT_BURST", 2)
+    async with AsyncClient(
+        transport=ASGITransport(app=app), base_url="http://test"
+    ) as client:
+        headers = {"X-Client-Id": f"client-{ObjectId()}"}
+        statuses = [
+            (await client.post("/allocate/", json={}, headers=headers)).status_code
+            for _ in range(3)
+        ]
+        assert statuses == [422, 422, 429]
+        response = await client.post("/allocate/", json={}, headers=headers)
+        assert int(response.headers["Retry-After"]) >= 1
+        # Reads are not rate limited, including the batch lookup sent with POST
+        assert (await client.get("/cache/stats/", headers=headers)).status_code == 200
+        lookup = [{"vehicle_id": "admit-veh", "allocation_date": "2030-01-01"}]
+        for _ in range(3):
+            response = await client.post(
+                "/allocations/lookup", json=lookup, headers=headers
+            )
+            assert response.status_code == 200
+
+    async def slow_app(scope, receive, send):
+        await asyncio.sleep(0.2)
+        await send({"type": "http.response.start", "status": 204, "headers": []})
+        await send({"type": "http.response.body", "body": b""})
+
+    monkeypatch.setattr(settings, "RATE_LIMIT_PER_SECOND", 0)
+    monkeypatch.setattr(settings, "ADMISSION_MAX_IN_FLIGHT", 1)
+    monkeypatch.setattr(settings, "ADMISSION_MAX_QUEUE_DELAY", 0.05)
+    capped = AdmissionMiddleware(slow_app, router=app.router)
+    labels = {
+        "route": "DELETE /allocation/{allocation_id}/",
+        "reason": "worker_overloaded",
+    }
+    before = REGISTRY.get_sample_value("shed_requests_total", labels) or 0
+    async with AsyncClient(
+        transport=ASGITransport(app=capped), base_url="http://test"
+    ) as client:
+        responses = await asyncio.gather(
+            client.delete(f"/allocation/{ObjectId()}/"),
+            client.delete(f"/allocation/{ObjectId()}/"),
+        )
+    assert sorted(response.status_code for response in responses) == [204, 503]
+    assert REGISTRY.get_sample_value("shed_requests_total", labels) == before + 1
+
+
+@pytest.mark.asyncio(scope="session")
+async def test_profiling(monkeypatch, tmp_path):
+    """
+    Test that profiled requests write a profile with MongoDB and Redis await spans.
+    """
+    # Profiling is not installed unless PROFILE_DIR is set
+    installed = [middleware.cls for middleware in app.user_middleware]
+    assert (ProfilingMiddleware in installed) == bool(settings.PROFILE_DIR)
+
+    monkeypatch.setattr(settings, "PROFILE_DIR", str(tmp_path))
+    monkeypatch.setattr(settings, "PROFILE_SAMPLE_RATE", 0)
+    monkeypatch.setattr(
+        database, "redis", ProfiledRedis(connection_pool=database.redis.connection_pool)
+    )
+    index = FastAPI()
+    index.include_router(profiling_router)
+    profiled = ProfilingMiddleware(app)
+    async with AsyncClient(
+        transport=ASGITransport(app=profiled), base_url="http://test"
+    ) as client:
+        params = {"employee_id": "profile-emp"}
+        response = await client.get("/history/", params=params)
+        assert "X-Profile-Id" not in response.headers
+
+        response = await client.get(
+            "/history/", params=params, headers={"X-Profile": "1"}
+        )
+        assert response.status_code == 200
+        collapsed_id = response.headers["X-Profile-Id"]
+        response = await client.post(
+            "/allocate/",
+            json={
+                "employee_id": "profile-emp",
+                "vehicle_id": "profile-veh",
+                "allocation_date": "2030-05-01",
+            },
+            headers={"X-Profile": "pstats"},
+        )
+        assert response.status_code == 201
+        pstats_id = response.headers["X-Profile-Id"]
+
+    pstats.Stats(str(tmp_path / f"{pstats_id}.pstats"))  # a valid pstats dump
+    async with AsyncClient(
+        transport=ASGITransport(app=index), base_url="http://test"
+    ) as client:
+        summaries = (await client.get("/profiles")).json()["profiles"]
+        assert [summary["id"] for summary in summaries] == sorted(
+            [collapsed_id, pstats_id], reverse=True
+        )
+        summary = next(s for s in summaries if s["id"] == collapsed_id)
+        assert summary["path"] == "/history/" and summary["status"] == 200
+        assert summary["await"]["redis"]["count"] > 0
+
+        response = await client.get(f"/profiles/{collapsed_id}.json")
+        assert any(span["kind"] == "redis" for span in response.json()["spans"])
+        response = await client.get(f"/profiles/{collapsed_id}.collapsed")
+        assert response.status_code == 200
+        assert (await client.get("/profiles/..%2Fsecrets")).status_code == 404
+
+
+@pytest.mark.asyncio(scope="session")
+async def test_archive_allocations(monkeypatch):
+    """
+    Test that past allocations move to monthly archives and stay readable and booked.
+    """
+    hot = database.database.get_collection("allocations_hot")
+    rollups = database.database.get_collection("utilization_rollups_hot")
+    await hot.drop()
+    monkeypatch.setattr(database, "allocations_collection", hot)
+    future_day = (datetime.now(timezone.utc).date() + timedelta(days=5)).isoformat()
+    days = ["2024-01-10", "2024-01-11", "2024-02-05", future_day]
+    try:
+        async with AsyncClient(
+            transport=ASGITransport(app=app), base_url="http://test"
+        ) as client:
+            await database.ensure_indexes()
+            ids = []
+            for day in days:
+                payload = {
+                    "employee_id": "arch-emp",
+                    "vehicle_id": "arch-veh",
+                    "allocation_date": day,
+                }
+                response = await client.post("/allocate/", json=payload)
+                ids.append(response.json()["id"])
+
+            assert await archive_allocations(batch_size=2) == 3
+            assert await hot.count_documents({}) == 1
+            assert await archive_collection("2024_01").count_documents({}) == 2
+            assert await archive_collection("2024_02").count_documents({}) == 1
+            # Archive months are found in MongoDB when Redis has lost them
+            await database.redis.delete(ARCHIVE_MONTHS_KEY)
+
+            # Lookups and conflict checks of past dates read the archive
+            allocation = await get_allocation_by_vehicle_date(
+                "arch-veh", date(2024, 1, 10)
+            )
+            assert str(allocation["_id"]) == ids[0]
+            payload["allocation_date"] = "2024-01-10"
+            assert (await client.post("/allocate/", json=payload)).status_code == 400
+            payload["allocation_date"] = "2024-02-05"
+            response = await client.post("/allocate/bulk", json=[payload])
+            assert response.json()["conflicts"] == 1
+            response = await client.post(
+                "/allocate/range",
+                json={
+                    "employee_id": "arch-emp",
+                    "vehicle_id": "arch-veh",
+                    "start_date": "2024-01-09",
+                    "end_date": "2024-01-11",
+                },
+            )
+            assert response.json()["detail"] == (
+                "Vehicle already allocated on 2024-01-10, 2024-01-11"
+            )
+            # Archived allocations cannot be changed
+            assert (await client.delete(f"/allocation/{ids[0]}/")).status_code == 400
+
+            # History fans out to the archives only when the dates require it
+            params = {"vehicle_id": "arch-veh"}
+            response = await client.get("/history/", params=params)
+            assert response.json()["total"] == 4
+            response = await client.get("/history/", params={**params, "skip": 1})
+            assert [row["allocation_date"] for row in response.json()["data"]] == [
+                days[1],
+                days[2],
+                days[3],
+            ]
+            response = await client.get(
+                "/history/", params={**params, "start_date": future_day}
+            )
+            assert response.json()["total"] == 1
+
+            cursor, seen = None, []
+            while True:
+                page_params = {
+                    **params,
+                    "pagination": "cursor",
+                    "limit": 3,
+                    "include_total": True,
+                }
+                if cursor:
+                    page_params["cursor"] = cursor
+                body = (await client.get("/history/", params=page_params)).json()
+                assert body["total"] == 4
+                seen += [row["allocation_date"] for row in body["data"]]
+                cursor = body["next_cursor"]
+                if not cursor:
+                    break
+            assert seen == days
+
+            response = await client.get(
+                "/history/export", params={**params, "fields": ["allocation_date"]}
+            )
+            rows = [json.loads(line) for line in response.text.splitlines()]
+            assert [row["allocation_date"] for row in rows] == days
+
+            # Offset pages merge the partitions: a copy left in the hot
+            # collection mid-move is read once, and past allocations not
+            # archived yet are read in date order
+            moving = await archive_collection("2024_01").find_one(
+                {"_id": ObjectId(ids[1])}
+            )
+            late = allocation_schema.to_document(
+                {
+                    "_id": ObjectId(),
+                    "employee_id": "arch-emp",
+                    "vehicle_id": "arch-veh",
+                    "allocation_date": date(2024, 1, 20),
+                }
+            )
+            await hot.insert_many([moving, late])
+            expected = [days[0], days[1], "2024-01-20", days[2], days[3]]
+            response = await client.get("/history/", params={**params, "limit": 5})
+            assert response.json()["total"] == 5
+            assert [row["allocation_date"] for row in response.json()["data"]] == (
+                expected
+            )
+            response = await client.get(
+                "/history/", params={**params, "skip": 2, "limit": 2}
+            )
+            assert [row["allocation_date"] for row in response.json()["data"]] == (
+                expected[2:4]
+            )
+            assert response.json()["has_more"]
+            await hot.delete_many({"_id": {"$in": [moving["_id"], late["_id"]]}})
+
+            # Rebuilds count archived allocations too
+            monkeypatch.setattr(database, "rollups_collection", rollups)
+            await rebuild_rollups()
+            bucket = await rollups.find_one(
+                {
+                    "dimension": "vehicle",
+                    "granularity": "month",
+                    "entity_id": "arch-veh",
+                    "period": datetime(2024, 1, 1),
+                }
+            )
+            assert bucket["allocations"] == 2
+            await rebuild_availability()
+            response = await client.get(
+                "/availability/",
+                params={
+                    "start_date": "2024-01-09",
+                    "end_date": "2024-02-05",
+                    "vehicle_id": "arch-veh",
+                },
+            )
+            [calendar] = response.json()["calendars"]
+            assert calendar["booked_dates"] == days[:3]
+    finally:
+        await hot.drop()
+        await rollups.drop()
+        for month in ("2024_01", "2024_02"):
+            await archive_collection(month).drop()
+        await database.redis.delete(ARCHIVE_MONTHS_KEY)
+
+
+@pytest.mark.asyncio(scope="session")
+async def test_migrate_schema(monkeypatch):
+    """
+    Test converting legacy allocations to the compact schema while serving requests.
+    """
+
+    def use_schema(name):
+        monkeypatch.setattr(settings, "ALLOCATION_SCHEMA", name)
+        monkeypatch.setattr(allocation_schema, "name", name)
+        monkeypatch.setattr(allocation_schema, "compact", name == "compact")
+
+    collection = database.database.get_collection("allocations_migration")
+    await collection.drop()
+    monkeypatch.setattr(database, "allocations_collection", collection)
+    first_day = datetime.now(timezone.utc).date() + timedelta(days=30)
+    payloads = [
+        {
+            "employee_id": "mig-emp",
+            "vehicle_id": "mig-veh",
+            "allocation_date": (first_day + timedelta(days=offset)).isoformat(),
+        }
+        for offset in range(6)
+    ]
+    try:
+        async with AsyncClient(
+            transport=ASGITransport(app=app), base_url="http://test"
+        ) as client:
+            use_schema("legacy")
+            await database.ensure_indexes()
+            for payload in payloads[:3]:
+                assert (
+                    await client.post("/allocate/", json=payload)
+                ).status_code == 201
+
+            # Writes made during the migration carry both layouts
+            use_schema("dual")
+            await database.ensure_indexes()
+            assert "v_d_unique_sparse" in await collection.index_information()
+            assert (
+                await client.post("/allocate/", json=payloads[3])
+            ).status_code == 201
+            assert await expand_allocations(batch_size=2) == 3
+            assert await collection.count_documents({"d": {"$exists": False}}) == 0
+
+            # Compact-only documents written before contract do not collide
+            # v_d_unique replaces the sparse index on the same keys, which
+            # MongoDB would otherwise reject as an index options conflict
+            use_schema("compact")
+            await database.ensure_indexes()
+            index_names = set(await collection.index_information())
+            assert "v_d_unique" in index_names
+            assert "v_d_unique_sparse" not in index_names
+            for payload in payloads[4:]:
+                assert (
+                    await client.post("/allocate/", json=payload)
+                ).status_code == 201
+            assert await contract_allocations(batch_size=3) == 4
+            documents = await collection.find({}, {"_id": 0}).to_list(length=None)
+            assert all(set(document) == {"e", "v", "d"} for document in documents)
+            index_names = set(await collection.index_information())
+            assert index_names == {"_id_", "v_d_unique", "v_d_id", "e_d_id", "d_id"}
+
+            # The API shape is unchanged, and double bookings are still rejected
+            response = await client.get("/history/", params={"vehicle_id": "mig-veh"})
+            assert [row["allocation_date"] for row in response.json()["data"]] == [
+                payload["allocation_date"] for payload in payloads
+            ]
+            assert (
+                await client.post("/allocate/", json=payloads[0])
+            ).status_code == 400
+    finally:
+        await collection.drop()
+
+
+@pytest.mark.asyncio(scope="session")
+async def test_unique_index_reports_duplicates():
+    """
+    Test that duplicate bookings blocking the unique index are reported.
+    """
+    collection = database.database["allocations_duplicates"]
+    ids = [ObjectId(), ObjectId()]
+    await collection.insert_many(
+        [
+            allocation_schema.to_document(
+                {
+                    "_id": _id,
+                    "employee_id": employee_id,
+                    "vehicle_id": "dup-veh",
+                    "allocation_date": date(2024, 10, 26),
+                }
+            )
+            for _id, employee_id in zip(ids, ("dup-emp-1", "dup-emp-2"))
+        ]
+    )
+    try:
+        with pytest.raises(RuntimeError) as error:
+            await database.ensure_allocation_indexes(collection)
+        assert all(str(_id) in str(error.value) for _id in ids)
+
+        await collection.delete_one({"_id": ids[1]})
+        await database.ensure_allocation_indexes(collection)
+    finally:
+        await collection.drop()
+
+
+@pytest.mark.asyncio(scope="session")
+async def test_metrics():
+    """
+    Test that request, MongoDB and cache metrics are exposed for Prometheus.
+    """
+    async with AsyncClient(
+        transport=ASGITransport(app=app), base_url="http://test"
+    ) as client:
+        response = await client.get("/metrics")
+        assert response.status_code == 200
+        assert response.headers["content-type"].startswith("text/plain")
+        assert 'route="/allocation/{allocation_id}/"' in response.text
+        assert "# TYPE mongodb_command_duration_seconds histogram" in response.text
+        assert 'cache_lookups_total{result="miss",tier="local"}' in response.text
+
+
+@pytest.mark.no_services
+def test_local_cache_eviction_and_ttl():
+    """
+    Test LRU eviction, TTL expiry and counters of the in-process cache.
+    """
+    cache = LocalCache(max_size=2, ttl=60)
+    cache.set("a", 1)
+    cache.set("b", 2)
+    assert cache.get("a") == 1  # "b" is now least recently used
+    cache.set("c", 3)
+    assert cache.get("b") is MISSING
+    assert cache.get("c") == 3
+
+    cache.invalidate(["a"])
+    assert cache.get("a") is MISSING
+
+    # Values loaded before an invalidation are not stored
+    generation = cache.generation
+    cache.invalidate(["c"])
+    cache.set("c", 3, generation)
+    assert cache.get("c") is MISSING
+
+    expired = LocalCache(max_size=2, ttl=-1)
+    expired.set("a", 1)
+    assert expired.get("a") is MISSING
+
+    assert cache.stats() == {
+        "size": 0,
+        "max_size": 2,
+        "hits": 2,
+        "misses": 3,
+        "evictions": 1,
+        "invalidations": 2,
+    }
+
+
+@pytest.mark.no_services
+def test_cache_codecs_round_trip():
+    """
+    Test that every cache codec decodes to the same shape, including legacy JSON.
+    """
+    allocation = {
+        "_id": ObjectId(),
+        "employee_id": "emp-1",
+        "vehicle_id": "veh-1",
+        "allocation_date": datetime(2024, 10, 26),
+    }
+    for codec in CODECS.values():
+        # Entries decode to the document shape read from MongoDB
+        assert decode_cached(codec.encode(allocation)) == allocation
+        assert decode_cached(codec.encode(None)) is None
+        # Entries read back from the cache can be re-encoded unchanged
+        decoded = decode_cached(codec.encode(allocation))
+        assert decode_cached(codec.encode(decoded)) == allocation
+    # JSON entries written with the API string forms still decode
+    legacy = json.dumps(
+        {
+            "_id": str(allocation["_id"]),
+            "employee_id": "emp-1",
+            "vehicle_id": "veh-1",
+            "allocation_date": "2024-10-26T00:00:00",
+        }
+    )
+    assert decode_cached(legacy.encode()) == allocation
+
+    assert len(CODECS["binary"].encode(allocation)) < len(
+        CODECS["json"].encode(allocation)
+    )
+
+
+@pytest.mark.no_services
+def test_mongo_command_metrics_listener():
+    """
+    Test that the MongoDB command listener records command durations.
+    """
+    labels = {"command": "ping", "outcome": "succeeded"}
+    before = (
+        REGISTRY.get_sample_value("mongodb_command_duration_seconds_count", labels) or 0
+    )
+    MongoCommandMetrics().succeeded(
+        SimpleNamespace(command_name="ping", duration_micros=1500)
+    )
+    assert (
+        REGISTRY.get_sample_value("mongodb_command_duration_seconds_count", labels)
+        == before + 1
+    )
+
+
+@pytest.mark.no_services
+def test_storage_backend_requires_every_method():
+    """
+    Test that a backend missing a query method cannot be created.
+    """
+
+    class IncompleteBackend(storage.StorageBackend):
+        async def get_allocation_by_vehicle_date(self, vehicle_id, allocation_date):
+            return None
+
+    with pytest.raises(TypeError):
+        IncompleteBackend()
+    assert isinstance(MemoryBackend(), storage.StorageBackend)
+    assert isinstance(storage.MongoRedisBackend(), storage.StorageBackend)
+
+
+@pytest.mark.no_services
+@pytest.mark.asyncio(scope="session")
+async def test_memory_backend(monkeypatch):
+    """
+    Test the API end to end on the in-memory storage engine.
+    """
+    backend = MemoryBackend()
+    monkeypatch.setattr(storage, "backend", backend)
+    tomorrow = datetime.now(timezone.utc).date() + timedelta(days=1)
+    async with AsyncClient(
+        transport=ASGITransport(app=app), base_url="http://test"
+    ) as client:
+        ids = []
+        for offset in range(3):
+            response = await client.post(
+                "/allocate/",
+                json={
+                    "employee_id": "mem-emp",
+                    "vehicle_id": "mem-veh",
+                    "allocation_date": str(tomorrow + timedelta(days=offset)),
+                },
+            )
+            assert response.status_code == 201
+            ids.append(response.json()["id"])
+        response = await client.post(
+            "/allocate/",
+            json={
+                "employee_id": "other-emp",
+                "vehicle_id": "mem-veh",
+                "allocation_date": str(tomorrow),
+            },
+        )
+        assert response.status_code == 400
+
+        allocation = await backend.get_allocation_by_vehicle_date("mem-veh", tomorrow)
+        assert str(allocation["_id"]) == ids[0]
+
+        # Moving onto a booked date conflicts; moving onto a free one succeeds
+        response = await client.patch(
+            f"/allocation/{ids[0]}/",
+            json={"allocation_date": str(tomorrow + timedelta(days=1))},
+        )
+        assert response.status_code == 400
+        response = await client.patch(
+            f"/allocation/{ids[0]}/",
+            json={"allocation_date": str(tomorrow + timedelta(days=5))},
+        )
+        assert response.status_code == 200
+        assert await backend.get_allocation_by_vehicle_date("mem-veh", tomorrow) is None
+        response = await client.post(
+            "/allocations/lookup",
+            json=[
+                {"vehicle_id": "mem-veh", "allocation_date": str(tomorrow)},
+                {
+                    "vehicle_id": "mem-veh",
+                    "allocation_date": str(tomorrow + timedelta(days=5)),
+                },
+            ],
+        )
+        assert [
+            result["allocation"] and result["allocation"]["_id"]
+            for result in response.json()["results"]
+        ] == [None, ids[0]]
+
+        response = await client.get(
+            "/history/", params={"employee_id": "mem-emp", "skip": 1, "limit": 1}
+        )
+        assert response.json()["total"] == 3
+        assert [item["_id"] for item in response.json()["data"]] == [ids[2]]
+
+        seen, cursor = [], None
+        while True:
+            params = {"vehicle_id": "mem-veh", "pagination": "cursor", "limit": 2}
+            if cursor:
+                params["cursor"] = cursor
+            page = (await client.get("/history/", params=params)).json()
+            seen += [item["_id"] for item in page["data"]]
+            cursor = page["next_cursor"]
+            if not cursor:
+                break
+        assert seen == [ids[1], ids[2], ids[0]]
+
+        response = await client.get(
+            "/availability/",
+            params={"start_date": str(tomorrow), "end_date": str(tomorrow)},
+        )
+        assert response.json()["free_vehicles"] == ["mem-veh"]
+
+        response = await client.get(
+            "/history/export", params={"employee_id": "mem-emp", "fields": "id"}
+        )
+        assert response.text.splitlines() == [
+            json.dumps({"id": allocation_id}) for allocation_id in seen
+        ]
+
+        response = await client.delete(f"/allocation/{ids[1]}/")
+        assert response.status_code == 204
+        response = await client.delete(f"/allocation/{ids[1]}/")
+        assert response.status_code == 404
+
+        payload = {
+            "employee_id": "mem-emp",
+            "vehicle_id": "mem-veh",
+            "start_date": str(tomorrow + timedelta(days=4)),
+            "end_date": str(tomorrow + timedelta(days=6)),
+        }
+        response = await client.post("/allocate/range", json=payload)
+        assert response.status_code == 400
+        assert (
+            await backend.get_allocation_by_vehicle_date(
+                "mem-veh", tomorrow + timedelta(days=4)
+            )
+            is None
+        )
+
+        response = await client.get(
+            "/stats/utilization",
+            params={
+                "start_date": str(tomorrow),
+                "end_date": str(tomorrow + timedelta(days=5)),
+                "group_by": "employee",
+                "bucket": "month",
+            },
+        )
+        [series] = response.json()["series"]
+        assert series["entity_id"] == "mem-emp"
+        assert sum(bucket["allocations"] for bucket in series["buckets"]) == 2
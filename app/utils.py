@@ -1,12 +1,110 @@
+import base64
 import json
-from datetime import datetime
+from datetime import date, datetime
+from typing import Dict, List, Literal, Optional
 from bson import ObjectId
+from bson.errors import InvalidId
 from pydantic_settings import BaseSettings
 
 
 class Settings(BaseSettings):
     MONGO_URL: str
     REDIS_URL: str
+    # "mongo" (MongoDB with the Redis caches) or "memory" (in-process, one worker)
+    STORAGE_BACKEND: Literal["mongo", "memory"] = "mongo"
+    # Layout of allocation documents: "legacy" (full field names and datetimes),
+    # "compact" (short field names and day numbers), or "dual" (writes both and
+    # reads legacy) while `python -m app.migrate_schema` converts a collection
+    ALLOCATION_SCHEMA: Literal["legacy", "dual", "compact"] = "legacy"
+    # MongoDB connection pool, per worker process
+    MONGO_MAX_POOL_SIZE: int = 100
+    MONGO_MIN_POOL_SIZE: int = 10
+    MONGO_MAX_CONNECTING: int = 2  # connections opened concurrently
+    MONGO_CONNECT_TIMEOUT_MS: int = 5000
+    MONGO_SERVER_SELECTION_TIMEOUT_MS: int = 5000
+    MONGO_WAIT_QUEUE_TIMEOUT_MS: Optional[int] = None  # wait for a free connection
+    # Redis connection pools (one text, one binary), per worker process
+    REDIS_MAX_CONNECTIONS: int = 50
+    REDIS_POOL_TIMEOUT: float = 5  # seconds to wait for a free connection
+    REDIS_SOCKET_TIMEOUT: float = 5
+    REDIS_CONNECT_TIMEOUT: float = 2
+    REDIS_WARM_CONNECTIONS: int = 5  # connections opened at startup
+    # Seconds a cached history count is reused by cursor pagination
+    HISTORY_COUNT_TTL: int = 60
+    # Maximum number of items accepted by POST /allocate/bulk
+    BULK_ALLOCATION_MAX: int = 1000
+    # Maximum number of vehicle/date pairs accepted by POST /allocations/lookup
+    LOOKUP_BATCH_MAX: int = 100
+    # Longest date range accepted by POST /allocate/range
+    RANGE_ALLOCATION_MAX_DAYS: int = 31
+    # Longest date range accepted by GET /availability/
+    AVAILABILITY_MAX_DAYS: int = 366
+    # In-process cache in front of Redis; a size of 0 disables it
+    L1_CACHE_MAX_SIZE: int = 10000
+    L1_CACHE_TTL: float = 30
+    # Seconds a "vehicle is free on this date" lookup result is cached
+    NEGATIVE_CACHE_TTL: int = 60
+    # Seconds one worker may spend reloading an expired lookup while the others
+    # serve a stale copy or wait for it; 0 disables the cross-worker lock
+    LOOKUP_LOCK_TTL: float = 0
+    # Seconds a stale copy outlives its lookup entry when the lock is enabled
+    LOOKUP_STALE_TTL: int = 300
+    # Seconds an invalidated lookup key keeps rejecting cache fills from loads
+    # that began before the invalidation; must exceed the slowest load
+    INVALIDATION_MARK_TTL: int = 60
+    # Rows fetched per MongoDB batch and written per chunk by history exports
+    EXPORT_BATCH_SIZE: int = 1000
+    # Seconds a history page stays cached; 0 disables the history cache
+    HISTORY_CACHE_TTL: int = 300
+    # Most week or month buckets per series returned by GET /stats/utilization
+    UTILIZATION_MAX_BUCKETS: int = 120
+    # Seconds the response to a request with an Idempotency-Key is replayed
+    IDEMPOTENCY_TTL: int = 86400
+    # Seconds duplicates wait for the first request before getting a 409, and
+    # a reservation outlives a crashed worker; running requests keep extending it
+    IDEMPOTENCY_LOCK_TTL: float = 30
+    # Admission control, applied to requests using these methods
+    ADMISSION_METHODS: List[str] = ["POST", "PATCH", "DELETE"]
+    # Read-only routes using those methods, which admission control lets through
+    ADMISSION_EXEMPT_ROUTES: List[str] = ["POST /allocations/lookup"]
+    # In-flight requests per worker; 0 disables the cap
+    ADMISSION_MAX_IN_FLIGHT: int = 0
+    # In-flight requests per worker and route, e.g. {"POST /allocate/": 20}
+    ADMISSION_ROUTE_LIMITS: Dict[str, int] = {}
+    # Seconds a request may wait for a free slot before it is shed with a 503
+    ADMISSION_MAX_QUEUE_DELAY: float = 0.5
+    ADMISSION_RETRY_AFTER: int = 1
+    # Token bucket per client: sustained requests per second (0 disables) and burst
+    RATE_LIMIT_PER_SECOND: float = 0
+    RATE_LIMIT_BURST: int = 20
+    # Header identifying the client; the client address is used without it
+    RATE_LIMIT_CLIENT_HEADER: str = "X-Client-Id"
+    # Seconds between runs of the archiver moving past allocations to monthly
+    # archive collections; 0 disables the schedule (see `python -m app.archive`)
+    ARCHIVE_INTERVAL: int = 0
+    # Past days whose allocations stay in the live collection
+    ARCHIVE_KEEP_DAYS: int = 0
+    # Allocations moved per batch by the archiver
+    ARCHIVE_BATCH_SIZE: int = 1000
+    # Directory receiving request profiles; empty disables profiling entirely
+    PROFILE_DIR: str = ""
+    # Fraction of requests profiled; requests with PROFILE_HEADER always are
+    PROFILE_SAMPLE_RATE: float = 0
+    PROFILE_HEADER: str = "X-Profile"
+    # "collapsed" (sampled stacks, for flame graphs) or "pstats" (cProfile)
+    PROFILE_FORMAT: Literal["collapsed", "pstats"] = "collapsed"
+    # Seconds between stack samples of collapsed profiles
+    PROFILE_SAMPLE_INTERVAL: float = 0.001
+    # Profiles kept in PROFILE_DIR; older ones are deleted
+    PROFILE_MAX_FILES: int = 200
+    # Days ahead, from today, whose allocations are cached in Redis at startup
+    # and every WARMUP_INTERVAL seconds by one worker; 0 disables the warm-up
+    WARMUP_DAYS: int = 0
+    WARMUP_INTERVAL: int = 3600
+    # Cache entries written per Redis pipeline by the warm-up
+    WARMUP_BATCH_SIZE: int = 1000
+    # Encoding of new vehicle/date cache entries; both formats are always readable
+    CACHE_CODEC: Literal["json", "binary"] = "json"
 
     class Config:
         env_file = ".env"
@@ -18,11 +116,11 @@ settings = Settings()
 class CustomJSONEncoder(json.JSONEncoder):
     """
     Custom JSON encoder that extends the default JSONEncoder to handle
-    additional types, specifically ObjectId and datetime.
+    additional types, specifically ObjectId, datetime and date.
 
     This encoder converts:
     - ObjectId to its string representation.
-    - datetime to its ISO 8601 string format.
+    - datetime and date to their ISO 8601 string format.
     """
 
     def default(self, obj):
@@ -34,14 +132,50 @@ class CustomJSONEncoder(json.JSONEncoder):
         - obj: The object to serialize.
 
         Returns:
-        - str: The string representation of ObjectId or ISO format of datetime.
+        - str: The string representation of ObjectId or ISO format of datetime/date.
         - super: Calls the default method for all other types.
         """
         if isinstance(obj, ObjectId):
             # Convert ObjectId to string for JSON serialization
             return str(obj)
-        if isinstance(obj, datetime):
-            # Convert datetime to ISO 8601 string format for JSON serialization
+        if isinstance(obj, (datetime, date)):
+            # Convert datetime/date to ISO 8601 string format for JSON serialization
             return obj.isoformat()
         # Call the default method for all other objects
         return super().default(obj)
+
+
+def encode_cursor(allocation_date: datetime, allocation_id: ObjectId) -> str:
+    """
+    Encode the sort key of the last document on a page into an opaque cursor.
+
+    Parameters:
+    - allocation_date (datetime): The allocation date of the last document.
+    - allocation_id (ObjectId): The ID of the last document.
+
+    Returns:
+    - str: A URL-safe cursor string.
+    """
+    payload = json.dumps([allocation_date.isoformat(), str(allocation_id)])
+    return base64.urlsafe_b64encode(payload.encode()).decode().rstrip("=")
+
+
+def decode_cursor(cursor: str) -> tuple[datetime, ObjectId]:
+    """
+    Decode a cursor produced by encode_cursor.
+
+    Parameters:
+    - cursor (str): The opaque cursor string.
+
+    Returns:
+    - tuple: The allocation date and ObjectId the next page starts after.
+
+    Raises:
+    - ValueError: If the cursor is malformed.
+    """
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        allocation_date, allocation_id = json.loads(base64.urlsafe_b64decode(padded))
+        return datetime.fromisoformat(allocation_date), ObjectId(allocation_id)
+    except (ValueError, TypeError, InvalidId) as exc:
+        raise ValueError("Invalid cursor") from exc
@@ -0,0 +1,134 @@
+import argparse
+import asyncio
+import logging
+from datetime import timedelta
+
+from . import database
+from .archive import today
+from .cache import server_time
+from .crud import queue_cache_fill
+from .keys import WARMUP_LOCK_KEY, vehicle_date_key
+from .metrics import WARMED_ALLOCATIONS
+from .models import allocation_schema
+from .utils import settings
+
+logger = logging.getLogger(__name__)
+
+# After a Redis restart or flush, every vehicle/date lookup would miss until
+# traffic refilled the cache. The warm-up loads the allocations of the next
+# WARMUP_DAYS days into Redis ahead of the lookups, at startup and every
+# WARMUP_INTERVAL seconds. Its lock lives in Redis too, so a flush also clears
+# the lock and the cache is warmed again at the next check.
+
+# Seconds between checks of the warm-up lock
+CHECK_INTERVAL = 60
+
+# Days warmed by `python -m app.warmup` when WARMUP_DAYS is not set
+DEFAULT_DAYS = 7
+
+
+async def warm_cache(days: int = None, batch_size: int = None) -> int:
+    """
+    Cache the allocations of the next days in Redis.
+
+    The allocations are read with one range query on the allocation date
+    index and written to Redis with one pipeline per batch, with the same
+    entries and TTLs as lookups. Entries invalidated since the query began
+    are skipped, since the allocation read may predate the write.
+
+    Parameters:
+    - days (int, optional): Days to warm, from today; defaults to WARMUP_DAYS.
+    - batch_size (int, optional): Entries written per pipeline; defaults to WARMUP_BATCH_SIZE.
+
+    Returns:
+    - int: Number of allocations cached.
+    """
+    days = days or settings.WARMUP_DAYS
+    batch_size = batch_size or settings.WARMUP_BATCH_SIZE
+    start = today()
+    end = start + timedelta(days=days)
+    started = await server_time()
+    cursor = database.allocations_collection.find(
+        {
+            allocation_schema.field("allocation_date"): {
+                "$gte": allocation_schema.value("allocation_date", start),
+                "$lt": allocation_schema.value("allocation_date", end),
+            }
+        },
+        allocation_schema.projection(),
+    ).batch_size(batch_size)
+    warmed = 0
+    batch = []
+    async for document in cursor:
+        batch.append(allocation_schema.from_document(document))
+        if len(batch) == batch_size:
+            warmed += await fill_cache(batch, started)
+            batch = []
+    if batch:
+        warmed += await fill_cache(batch, started)
+    return warmed
+
+
+async def fill_cache(allocations: list, started: int) -> int:
+    """
+    Write lookup entries for allocations to Redis in one pipeline.
+
+    Parameters:
+    - allocations (list): The allocations to cache.
+    - started (int): The server_time() read before querying them.
+
+    Returns:
+    - int: Number of entries written.
+    """
+    async with database.redis_binary.pipeline(transaction=False) as pipe:
+        for allocation in allocations:
+            cache_key = vehicle_date_key(
+                allocation["vehicle_id"], allocation["allocation_date"]
+            )
+            queue_cache_fill(pipe, cache_key, allocation, started)
+        written = sum(await pipe.execute())
+    WARMED_ALLOCATIONS.inc(written)
+    return written
+
+
+async def run_warmup() -> None:
+    """
+    Run warm_cache at startup and then every WARMUP_INTERVAL seconds.
+
+    Runs for the lifetime of the worker. A Redis lock held for one interval
+    lets a single worker warm the cache per interval however many are running.
+    """
+    while True:
+        try:
+            if await database.redis.set(
+                WARMUP_LOCK_KEY, "1", nx=True, ex=settings.WARMUP_INTERVAL
+            ):
+                warmed = await warm_cache()
+                logger.info("Warmed the cache with %d upcoming allocations", warmed)
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            logger.exception("Warming the cache failed")
+        await asyncio.sleep(min(CHECK_INTERVAL, settings.WARMUP_INTERVAL))
+
+
+async def main():
+    parser = argparse.ArgumentParser(
+        description="Cache the allocations of the next days in Redis."
+    )
+    parser.add_argument(
+        "--days", type=int, default=settings.WARMUP_DAYS or DEFAULT_DAYS
+    )
+    args = parser.parse_args()
+
+    await database.connect()
+    try:
+        warmed = await warm_cache(days=args.days)
+    finally:
+        await database.disconnect()
+    print(f"Warmed the cache with {warmed} upcoming allocations")
+
+
+if __name__ == "__main__":
+    # Usage: python -m app.warmup [--days N]
+    asyncio.run(main())
@@ -0,0 +1,54 @@
+"""
+Micro-benchmark of the vehicle/date cache codecs.
+
+Usage:
+    python -m benchmarks.codec_benchmark [--iterations N]
+
+Reports the encoded size of a typical allocation and the time to encode and
+decode it with each codec in app.cache_codecs.
+"""
+
+import argparse
+import os
+import timeit
+from datetime import datetime
+
+from bson import ObjectId
+
+# The codecs only need Settings to choose a default; no services are contacted
+os.environ.setdefault("MONGO_URL", "mongodb://localhost:27017/benchmark")
+os.environ.setdefault("REDIS_URL", "redis://localhost:6379/0")
+
+from app.cache_codecs import CODECS, decode_cached  # noqa: E402
+
+SAMPLE_ALLOCATION = {
+    "_id": ObjectId(),
+    "employee_id": "emp-004211",
+    "vehicle_id": "VH-2231",
+    "allocation_date": datetime(2024, 10, 26),
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--iterations", type=int, default=200_000)
+    args = parser.parse_args()
+
+    print(f"{'codec':<8} {'bytes':>6} {'encode us':>10} {'decode us':>10}")
+    for name, codec in CODECS.items():
+        encoded = codec.encode(SAMPLE_ALLOCATION)
+        encode_time = timeit.timeit(
+            lambda: codec.encode(SAMPLE_ALLOCATION), number=args.iterations
+        )
+        decode_time = timeit.timeit(
+            lambda: decode_cached(encoded), number=args.iterations
+        )
+        print(
+            f"{name:<8} {len(encoded):>6} "
+            f"{encode_time / args.iterations * 1e6:>10.2f} "
+            f"{decode_time / args.iterations * 1e6:>10.2f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,90 @@
+"""
+Micro-benchmark of history page serialization.
+
+Usage:
+    python -m benchmarks.history_benchmark [--iterations N]
+
+Reports the CPU time per page of the previous path (validating the page into
+its response model, then serializing it again for the response, as FastAPI
+does with a response_model) and of encode_history_page, for pages of 10, 100
+and 1000 allocations.
+"""
+
+import argparse
+import os
+import time
+from datetime import datetime, timedelta
+
+from bson import ObjectId
+
+# Serialization only needs Settings to be importable; no services are contacted
+os.environ.setdefault("MONGO_URL", "mongodb://localhost:27017/benchmark")
+os.environ.setdefault("REDIS_URL", "redis://localhost:6379/0")
+
+from fastapi.encoders import jsonable_encoder  # noqa: E402
+from fastapi.responses import JSONResponse  # noqa: E402
+
+from app.history_cache import encode_history_page  # noqa: E402
+from app.models import PaginatedResponse  # noqa: E402
+
+LIMITS = (10, 100, 1000)
+
+
+def sample_page(limit: int) -> list:
+    """
+    Build a page of allocations in the shape read from MongoDB.
+    """
+    return [
+        {
+            "_id": ObjectId(),
+            "employee_id": f"emp-{index:06d}",
+            "vehicle_id": f"VH-{index % 500:04d}",
+            "allocation_date": datetime(2024, 10, 26) + timedelta(days=index),
+        }
+        for index in range(limit)
+    ]
+
+
+def model_path(history: list, limit: int) -> bytes:
+    # What the route did before: build the model, let FastAPI validate it
+    # against the response_model again, then encode it to JSON
+    page = PaginatedResponse(
+        data=history, total=10_000, skip=0, limit=limit, has_more=True
+    )
+    content = PaginatedResponse.model_validate(page.model_dump(by_alias=True))
+    return JSONResponse(jsonable_encoder(content, by_alias=True)).body
+
+
+def bytes_path(history: list, limit: int) -> bytes:
+    return encode_history_page(
+        history, total=10_000, skip=0, limit=limit, has_more=True
+    )
+
+
+def cpu_time_per_call(function, history: list, limit: int, iterations: int) -> float:
+    start = time.process_time()
+    for _ in range(iterations):
+        function(history, limit)
+    return (time.process_time() - start) / iterations
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--iterations", type=int, default=20_000)
+    args = parser.parse_args()
+
+    print(f"{'limit':>6} {'model us':>10} {'bytes us':>10} {'speedup':>8}")
+    for limit in LIMITS:
+        history = sample_page(limit)
+        # Fewer iterations for larger pages, so every limit takes similar time
+        iterations = max(10, args.iterations // limit)
+        before = cpu_time_per_call(model_path, history, limit, iterations)
+        after = cpu_time_per_call(bytes_path, history, limit, iterations)
+        print(
+            f"{limit:>6} {before * 1e6:>10.1f} {after * 1e6:>10.1f} "
+            f"{before / after:>7.1f}x"
+        )
+
+
+if __name__ == "__main__":
+    main()
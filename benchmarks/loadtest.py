@@ -0,0 +1,378 @@
+"""
+Load test of the allocation API with a configurable mix of requests.
+
+Usage:
+    python -m benchmarks.loadtest [--target asgi|uvicorn|URL] [--requests N]
+        [--concurrency N] [--mix allocate=40,update=20,delete=10,history=30]
+        [--trace FILE.jsonl] [--save-baseline FILE] [--compare FILE]
+        [--backend mongo|memory]
+
+The API runs against the MongoDB and Redis given by MONGO_URL and REDIS_URL
+(or --mongo-url/--redis-url); point them at local throwaway instances, e.g.
+`docker compose up -d mongo redis`, never at production data. Targets:
+
+- asgi: drive the FastAPI app in-process through httpx.ASGITransport.
+- uvicorn: start `uvicorn app.main:app` on a free port and drive it over HTTP.
+- any http(s) URL: drive an already running server.
+
+--backend memory runs the API on the in-process storage engine instead, which
+needs neither MongoDB nor Redis (asgi target, or uvicorn with one worker).
+
+A trace file holds one request per line:
+    {"op": "history", "method": "GET", "path": "/history/", "params": {...}}
+    {"op": "allocate", "method": "POST", "path": "/allocate/", "json": {...}}
+
+The report lists throughput, p50/p95/p99 latency per operation and the Redis
+cache hit rate. --save-baseline writes it as JSON; --compare exits non-zero if
+throughput or any p95 latency regressed by more than --tolerance.
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import time
+from collections import defaultdict
+from datetime import date, timedelta
+
+import httpx
+
+DEFAULT_MIX = "allocate=40,update=20,delete=10,history=30"
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--target", default="asgi")
+    parser.add_argument("--requests", type=int, default=2000)
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument("--mix", default=DEFAULT_MIX)
+    parser.add_argument("--trace", help="Replay requests from a JSONL trace")
+    parser.add_argument("--vehicles", type=int, default=200)
+    parser.add_argument("--employees", type=int, default=500)
+    parser.add_argument("--days", type=int, default=90)
+    parser.add_argument("--workers", type=int, default=1, help="uvicorn workers")
+    parser.add_argument("--mongo-url")
+    parser.add_argument("--redis-url")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--save-baseline")
+    parser.add_argument("--compare")
+    parser.add_argument("--tolerance", type=float, default=0.10)
+    parser.add_argument("--backend", choices=("mongo", "memory"), default="mongo")
+    return parser.parse_args(argv)
+
+
+def parse_mix(mix: str) -> dict:
+    weights = {}
+    for item in mix.split(","):
+        op, _, weight = item.partition("=")
+        weights[op.strip()] = float(weight)
+    unknown = set(weights) - {"allocate", "update", "delete", "history"}
+    if unknown:
+        raise SystemExit(f"Unknown operations in --mix: {', '.join(sorted(unknown))}")
+    return weights
+
+
+class Workload:
+    """
+    Generates synthetic requests, remembering created allocations so that
+    updates and deletes target allocations that exist and are in the future.
+    """
+
+    def __init__(self, args):
+        self.random = random.Random(args.seed)
+        self.vehicles = [f"bench-veh-{i}" for i in range(args.vehicles)]
+        self.employees = [f"bench-emp-{i}" for i in range(args.employees)]
+        self.days = args.days
+        self.weights = parse_mix(args.mix)
+        self.allocation_ids = []
+
+    def _future_date(self) -> str:
+        offset = self.random.randint(1, self.days)
+        return (date.today() + timedelta(days=offset)).isoformat()
+
+    def next_request(self) -> dict:
+        op = self.random.choices(list(self.weights), list(self.weights.values()))[0]
+        if op in ("update", "delete") and not self.allocation_ids:
+            op = "allocate"
+        if op == "allocate":
+            return {
+                "op": op,
+                "method": "POST",
+                "path": "/allocate/",
+                "json": {
+                    "employee_id": self.random.choice(self.employees),
+                    "vehicle_id": self.random.choice(self.vehicles),
+                    "allocation_date": self._future_date(),
+                },
+            }
+        if op == "update":
+            allocation_id = self.random.choice(self.allocation_ids)
+            return {
+                "op": op,
+                "method": "PATCH",
+                "path": f"/allocation/{allocation_id}/",
+                "json": {"employee_id": self.random.choice(self.employees)},
+            }
+        if op == "delete":
+            index = self.random.randrange(len(self.allocation_ids))
+            allocation_id = self.allocation_ids.pop(index)
+            return {
+                "op": op,
+                "method": "DELETE",
+                "path": f"/allocation/{allocation_id}/",
+            }
+        params = self.random.choice(
+            [
+                {"employee_id": self.random.choice(self.employees)},
+                {"vehicle_id": self.random.choice(self.vehicles)},
+                {"start_date": date.today().isoformat(), "limit": 50},
+            ]
+        )
+        return {"op": "history", "method": "GET", "path": "/history/", "params": params}
+
+    def record(self, request: dict, response: httpx.Response):
+        if request["op"] == "allocate" and response.status_code == 201:
+            self.allocation_ids.append(response.json()["id"])
+
+
+def load_trace(path: str) -> list:
+    with open(path) as trace:
+        return [json.loads(line) for line in trace if line.strip()]
+
+
+def percentile(samples: list, fraction: float) -> float:
+    """
+    Nearest-rank percentile of an already sorted list.
+    """
+    if not samples:
+        return 0.0
+    rank = max(0, min(len(samples) - 1, round(fraction * len(samples)) - 1))
+    return samples[rank]
+
+
+async def redis_hit_counters(redis_url: str) -> tuple:
+    import aioredis
+
+    redis = aioredis.from_url(redis_url, decode_responses=True)
+    try:
+        stats = await redis.info("stats")
+        return stats["keyspace_hits"], stats["keyspace_misses"]
+    finally:
+        await redis.close()
+
+
+async def drive(client: httpx.AsyncClient, requests, workload, concurrency: int):
+    """
+    Send requests with bounded concurrency and collect latencies per operation.
+    """
+    latencies = defaultdict(list)
+    statuses = defaultdict(lambda: defaultdict(int))
+    errors = defaultdict(int)
+    queue = asyncio.Queue()
+    for request in requests:
+        queue.put_nowait(request)
+
+    async def worker():
+        while True:
+            try:
+                request = queue.get_nowait()
+            except asyncio.QueueEmpty:
+                return
+            if callable(request):
+                request = request()
+            started = time.perf_counter()
+            try:
+                response = await client.request(
+                    request["method"],
+                    request["path"],
+                    params=request.get("params"),
+                    json=request.get("json"),
+                )
+            except httpx.HTTPError:
+                errors[request["op"]] += 1
+                continue
+            latencies[request["op"]].append(time.perf_counter() - started)
+            statuses[request["op"]][response.status_code] += 1
+            if response.status_code >= 500:
+                errors[request["op"]] += 1
+            if workload:
+                workload.record(request, response)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    return latencies, statuses, errors, time.perf_counter() - started
+
+
+def build_report(latencies, statuses, errors, elapsed, cache) -> dict:
+    total = sum(len(samples) for samples in latencies.values())
+    endpoints = {}
+    for op, samples in sorted(latencies.items()):
+        samples.sort()
+        endpoints[op] = {
+            "requests": len(samples),
+            "errors": errors.get(op, 0),
+            "statuses": {str(code): n for code, n in sorted(statuses[op].items())},
+            "p50_ms": percentile(samples, 0.50) * 1000,
+            "p95_ms": percentile(samples, 0.95) * 1000,
+            "p99_ms": percentile(samples, 0.99) * 1000,
+        }
+    return {
+        "requests": total,
+        "elapsed_s": elapsed,
+        "throughput_rps": total / elapsed if elapsed else 0.0,
+        "cache_hit_rate": cache,
+        "endpoints": endpoints,
+    }
+
+
+def print_report(report: dict):
+    print(
+        f"{report['requests']} requests in {report['elapsed_s']:.2f}s "
+        f"({report['throughput_rps']:.1f} req/s)"
+    )
+    if report["cache_hit_rate"] is not None:
+        print(f"Redis cache hit rate: {report['cache_hit_rate']:.1%}")
+    print(
+        f"{'operation':<10} {'requests':>8} {'errors':>6} "
+        f"{'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8}"
+    )
+    for op, stats in report["endpoints"].items():
+        print(
+            f"{op:<10} {stats['requests']:>8} {stats['errors']:>6} "
+            f"{stats['p50_ms']:>8.2f} {stats['p95_ms']:>8.2f} {stats['p99_ms']:>8.2f}"
+        )
+
+
+def compare(report: dict, baseline: dict, tolerance: float) -> list:
+    """
+    Return a description of every metric that regressed beyond the tolerance.
+    """
+    regressions = []
+    if report["throughput_rps"] < baseline["throughput_rps"] * (1 - tolerance):
+        regressions.append(
+            f"throughput {report['throughput_rps']:.1f} req/s < "
+            f"baseline {baseline['throughput_rps']:.1f} req/s"
+        )
+    for op, stats in report["endpoints"].items():
+        base = baseline["endpoints"].get(op)
+        if base and stats["p95_ms"] > base["p95_ms"] * (1 + tolerance):
+            regressions.append(
+                f"{op} p95 {stats['p95_ms']:.2f} ms > "
+                f"baseline {base['p95_ms']:.2f} ms"
+            )
+    return regressions
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+async def wait_until_ready(url: str, process: subprocess.Popen, timeout: float = 30):
+    deadline = time.monotonic() + timeout
+    async with httpx.AsyncClient(base_url=url) as client:
+        while time.monotonic() < deadline:
+            if process.poll() is not None:
+                raise SystemExit("uvicorn exited before it was ready")
+            try:
+                await client.get("/openapi.json")
+                return
+            except httpx.TransportError:
+                await asyncio.sleep(0.2)
+    raise SystemExit("uvicorn did not start in time")
+
+
+async def run(args) -> dict:
+    if args.trace:
+        requests, workload = load_trace(args.trace), None
+    else:
+        workload = Workload(args)
+        requests = [workload.next_request for _ in range(args.requests)]
+
+    use_redis = args.backend == "mongo"
+    if use_redis:
+        hits_before = await redis_hit_counters(os.environ["REDIS_URL"])
+    if args.target == "asgi":
+        from app.main import app
+
+        # ASGITransport does not send lifespan events, so run them here
+        async with app.router.lifespan_context(app):
+            transport = httpx.ASGITransport(app=app)
+            async with httpx.AsyncClient(
+                transport=transport, base_url="http://bench"
+            ) as client:
+                results = await drive(client, requests, workload, args.concurrency)
+    else:
+        process = None
+        url = args.target
+        if args.target == "uvicorn":
+            port = free_port()
+            url = f"http://127.0.0.1:{port}"
+            process = subprocess.Popen(
+                [
+                    sys.executable,
+                    "-m",
+                    "uvicorn",
+                    "app.main:app",
+                    "--port",
+                    str(port),
+                    "--workers",
+                    str(args.workers),
+                    "--log-level",
+                    "warning",
+                ]
+            )
+        try:
+            if process:
+                await wait_until_ready(url, process)
+            limits = httpx.Limits(max_connections=args.concurrency)
+            async with httpx.AsyncClient(base_url=url, limits=limits) as client:
+                results = await drive(client, requests, workload, args.concurrency)
+        finally:
+            if process:
+                process.terminate()
+                process.wait()
+    if not use_redis:
+        return build_report(*results, None)
+    hits_after = await redis_hit_counters(os.environ["REDIS_URL"])
+
+    hits = hits_after[0] - hits_before[0]
+    lookups = hits + hits_after[1] - hits_before[1]
+    return build_report(*results, hits / lookups if lookups else None)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    # Settings are read from the environment when app modules are imported
+    os.environ["STORAGE_BACKEND"] = args.backend
+    if args.mongo_url:
+        os.environ["MONGO_URL"] = args.mongo_url
+    if args.redis_url:
+        os.environ["REDIS_URL"] = args.redis_url
+    if "REDIS_URL" not in os.environ:
+        from app.utils import settings
+
+        os.environ["REDIS_URL"] = settings.REDIS_URL
+
+    report = asyncio.run(run(args))
+    print_report(report)
+
+    if args.save_baseline:
+        with open(args.save_baseline, "w") as baseline:
+            json.dump(report, baseline, indent=2)
+    if args.compare:
+        with open(args.compare) as baseline:
+            regressions = compare(report, json.load(baseline), args.tolerance)
+        for regression in regressions:
+            print(f"REGRESSION: {regression}")
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,25 @@
+# Gunicorn settings for production, e.g.:
+#   PROMETHEUS_MULTIPROC_DIR=/tmp/prometheus gunicorn app.main:app -c gunicorn.conf.py
+import multiprocessing
+import os
+import shutil
+
+bind = "0.0.0.0:8000"
+workers = multiprocessing.cpu_count() * 2 + 1
+worker_class = "uvicorn.workers.UvicornWorker"
+
+
+def on_starting(server):
+    # Metric files left by a previous run would be aggregated into /metrics
+    directory = os.environ.get("PROMETHEUS_MULTIPROC_DIR")
+    if directory:
+        shutil.rmtree(directory, ignore_errors=True)
+        os.makedirs(directory)
+
+
+def child_exit(server, worker):
+    # Stop reporting live gauges of workers that have exited
+    if os.environ.get("PROMETHEUS_MULTIPROC_DIR"):
+        from prometheus_client import multiprocess
+
+        multiprocess.mark_process_dead(worker.pid)